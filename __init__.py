@@ -7,18 +7,55 @@
 """
 from trytond.pool import Pool
 from tree import (
-    Product, Node, ProductNodeRelationship,
+    Product, Template, Node, ProductNodeRelationship,
     Website, WebsiteTreeNode,
 )
+import feed
+import listing
+import instrumentation
+import thumbnail
+import warmup
+import stats
+import subtree
+import aggregate
+import product_sitemap
+import packed
+import rule
+from revision import TreeRevision
+from job import TreeJob
 
 
 def register():
     Pool.register(
         Product,
+        Template,
         Node,
         ProductNodeRelationship,
         Website,
         WebsiteTreeNode,
+        TreeRevision,
+        TreeJob,
+        feed.Node,
+        listing.Node,
+        instrumentation.Node,
+        thumbnail.Node,
+        warmup.Node,
+        stats.NodeHit,
+        stats.NodeTraffic,
+        stats.Node,
+        subtree.Node,
+        aggregate.TreeAggregate,
+        aggregate.Node,
+        aggregate.ProductNodeRelationship,
+        aggregate.Product,
+        aggregate.Template,
+        product_sitemap.Node,
+        packed.PackedListing,
+        packed.Node,
+        packed.TreeRevision,
+        rule.Node,
+        rule.Product,
+        rule.Template,
         module='nereid_catalog_tree',
         type_='model'
     )
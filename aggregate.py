@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Aggregates of the products listed in the subtree of each node
+
+    The number of products, the range of their prices and the date of the
+    newest product of each subtree are stored, so category pages and menus
+    do not aggregate the whole subtree to show them. When the products or
+    the tree change, the recomputation of the nodes affected is queued as
+    a tree job. Jobs are coalesced, and each node and its ancestors are
+    recomputed once per run whatever the number of changes.
+
+    The list prices are properties of the company. The jobs run without a
+    company in the context, so the prices are read as the company of the
+    first website, which is the company of the catalog in the usual setup
+    of a single company.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+from sql import Column
+
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+
+__all__ = [
+    'TreeAggregate', 'Node', 'ProductNodeRelationship', 'Product',
+    'Template',
+]
+__metaclass__ = PoolMeta
+
+AGGREGATES = ('product_count', 'min_price', 'max_price', 'newest_date')
+
+# The fields of each model whose change may change the aggregates
+NODE_FIELDS = set(['parent', 'active', 'type_', 'display'])
+PRODUCT_FIELDS = set(['displayed_on_eshop', 'template'])
+TEMPLATE_FIELDS = set(['active', 'list_price', 'products'])
+
+
+def written_fields(values, args):
+    "Return the set of the fields written by a call of write"
+    return set(values).union(*[set(v) for v in args[1::2]])
+
+
+def queue_recompute(node_ids):
+    """
+    Queue the recomputation of the aggregates of the given nodes and of
+    their ancestors
+    """
+    Job = Pool().get('product.tree_node.job')
+
+    if node_ids:
+        Job.enqueue(
+            TreeAggregate.__name__, 'recompute', map(str, set(node_ids))
+        )
+
+
+class TreeAggregate(ModelSQL):
+    "Tree Node Aggregate"
+    __name__ = 'product.tree_node.aggregate'
+
+    node = fields.Many2One(
+        'product.tree_node', 'Node', required=True, select=True,
+        readonly=True, ondelete='CASCADE'
+    )
+    product_count = fields.Integer('Product Count', readonly=True)
+    min_price = fields.Numeric('Min Price', digits=(16, 4), readonly=True)
+    max_price = fields.Numeric('Max Price', digits=(16, 4), readonly=True)
+    newest_date = fields.DateTime('Newest Product Date', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TreeAggregate, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'node_uniq', 'UNIQUE(node)',
+                'The aggregates of a node are stored once.'
+            ),
+        ]
+
+    @classmethod
+    def get_price_company(cls):
+        """
+        Return the id of the company whose list prices are aggregated: the
+        company of the context, or else the company of the first website
+        """
+        Website = Pool().get('nereid.website')
+
+        company_id = Transaction().context.get('company')
+        if company_id:
+            return company_id
+        websites = Website.search([], order=[('id', 'ASC')], limit=1)
+        if websites:
+            return websites[0].company.id
+        return None
+
+    @classmethod
+    def compute(cls, node):
+        """
+        Return a dictionary of the aggregates of the products listed by the
+        node and all of its branches
+
+        :param node: Active record of the node
+        """
+        Template = Pool().get('product.template')
+        cursor = Transaction().cursor
+
+        Model, query, table = node._get_products()
+        query.columns = [table.id]
+        query.group_by = [table.id]
+        query.order_by = []
+
+        record = Model.__table__()
+        if Model.__name__ == 'product.product':
+            template = record.template
+        else:
+            template = record.id
+        cursor.execute(*record.select(
+            template, record.create_date, where=record.id.in_(query)
+        ))
+        rows = cursor.fetchall()
+
+        # The prices are company properties and cannot be aggregated in SQL
+        with Transaction().set_context(company=cls.get_price_company()):
+            prices = [
+                t['list_price'] for t in Template.read(
+                    list(set(row[0] for row in rows)), ['list_price']
+                ) if t['list_price'] is not None
+            ]
+        return {
+            'product_count': len(rows),
+            'min_price': min(prices) if prices else None,
+            'max_price': max(prices) if prices else None,
+            'newest_date': max(row[1] for row in rows) if rows else None,
+        }
+
+    @classmethod
+    def get_aggregates(cls, node_ids):
+        """
+        Return a dictionary mapping each node id to the dictionary of the
+        aggregates of its subtree. The aggregates of the nodes which were
+        never computed are computed, but not stored.
+
+        :param node_ids: The list of node ids
+        """
+        Node = Pool().get('product.tree_node')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        result = {}
+        for i in range(0, len(node_ids), cursor.IN_MAX):
+            sub_ids = node_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.node, *[Column(table, name) for name in AGGREGATES],
+                where=table.node.in_(sub_ids)
+            ))
+            for row in cursor.fetchall():
+                result[row[0]] = dict(zip(AGGREGATES, row[1:]))
+
+        for node in Node.browse([i for i in node_ids if i not in result]):
+            result[node.id] = cls.compute(node)
+        return result
+
+    @classmethod
+    def recompute(cls, keys):
+        """
+        Recompute and store the aggregates of the given nodes and of their
+        ancestors. This is the handler of the tree jobs.
+
+        :param keys: The ids of the nodes, as strings
+        """
+        Node = Pool().get('product.tree_node')
+
+        with Transaction().set_context(active_test=False):
+            nodes = Node.search([('id', 'in', map(int, keys))])
+
+            # The ancestors are found from the parent links, as the nested
+            # set may be waiting for a rebuild
+            to_compute = {}
+            for node in nodes:
+                while node and node.id not in to_compute:
+                    to_compute[node.id] = node
+                    node = node.parent
+
+        values = [
+            dict(cls.compute(n), node=n.id) for n in to_compute.itervalues()
+        ]
+        cls.delete(cls.search([('node', 'in', to_compute.keys())]))
+        cls.create(values)
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    subtree_product_count = fields.Function(
+        fields.Integer('Products in Subtree'), 'get_subtree_aggregate'
+    )
+    subtree_min_price = fields.Function(
+        fields.Numeric('Min Price in Subtree', digits=(16, 4)),
+        'get_subtree_aggregate'
+    )
+    subtree_max_price = fields.Function(
+        fields.Numeric('Max Price in Subtree', digits=(16, 4)),
+        'get_subtree_aggregate'
+    )
+    subtree_newest_date = fields.Function(
+        fields.DateTime('Newest Product in Subtree'), 'get_subtree_aggregate'
+    )
+
+    @classmethod
+    def get_subtree_aggregate(cls, nodes, names):
+        """
+        Return the stored aggregates of the subtrees of the nodes, read in
+        bulk
+        """
+        aggregates = TreeAggregate.get_aggregates([n.id for n in nodes])
+        return dict(
+            (name, dict(
+                (node.id, aggregates[node.id][name[len('subtree_'):]])
+                for node in nodes
+            ))
+            for name in names
+        )
+
+    @classmethod
+    def create(cls, vlist):
+        nodes = super(Node, cls).create(vlist)
+        queue_recompute([n.id for n in nodes])
+        return nodes
+
+    @classmethod
+    def write(cls, nodes, values, *args):
+        if not written_fields(values, args) & NODE_FIELDS:
+            return super(Node, cls).write(nodes, values, *args)
+
+        all_nodes = nodes + sum(args[::2], [])
+        # The former ancestors of moved nodes lose their products
+        parent_ids = [n.parent.id for n in all_nodes if n.parent]
+        super(Node, cls).write(nodes, values, *args)
+        queue_recompute(parent_ids + [n.id for n in all_nodes])
+
+    @classmethod
+    def delete(cls, nodes):
+        parent_ids = [n.parent.id for n in nodes if n.parent]
+        super(Node, cls).delete(nodes)
+        queue_recompute(parent_ids)
+
+    @classmethod
+    def clone_subtree(cls, node, parent=None, name=None):
+        clone = super(Node, cls).clone_subtree(node, parent, name)
+        queue_recompute(clone._get_descendant_ids())
+        return clone
+
+    @classmethod
+    def delete_subtree(cls, nodes):
+        parent_ids = [n.parent.id for n in nodes if n.parent]
+        super(Node, cls).delete_subtree(nodes)
+        queue_recompute(parent_ids)
+
+    @classmethod
+    def archive_subtree(cls, nodes, active=False):
+        super(Node, cls).archive_subtree(nodes, active)
+        queue_recompute([n.id for n in nodes])
+
+
+class ProductNodeRelationship:
+    __name__ = 'product.product-product.tree_node'
+
+    @classmethod
+    def create(cls, vlist):
+        relationships = super(ProductNodeRelationship, cls).create(vlist)
+        queue_recompute([r.node.id for r in relationships])
+        return relationships
+
+    @classmethod
+    def write(cls, relationships, values, *args):
+        all_relationships = relationships + sum(args[::2], [])
+        node_ids = [r.node.id for r in all_relationships]
+        super(ProductNodeRelationship, cls).write(
+            relationships, values, *args
+        )
+        queue_recompute(node_ids + [
+            r.node.id for r in cls.browse([r.id for r in all_relationships])
+        ])
+
+    @classmethod
+    def delete(cls, relationships):
+        node_ids = [r.node.id for r in relationships]
+        super(ProductNodeRelationship, cls).delete(relationships)
+        queue_recompute(node_ids)
+
+
+class Product:
+    __name__ = 'product.product'
+
+    @classmethod
+    def write(cls, products, values, *args):
+        Relationship = Pool().get('product.product-product.tree_node')
+
+        super(Product, cls).write(products, values, *args)
+        if not written_fields(values, args) & PRODUCT_FIELDS:
+            return
+        queue_recompute(Relationship.get_product_node_ids([
+            p.id for p in products + sum(args[::2], [])
+        ]))
+
+    @classmethod
+    def delete(cls, products):
+        Relationship = Pool().get('product.product-product.tree_node')
+
+        node_ids = Relationship.get_product_node_ids([p.id for p in products])
+        super(Product, cls).delete(products)
+        queue_recompute(node_ids)
+
+
+class Template:
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, templates, values, *args):
+        Relationship = Pool().get('product.product-product.tree_node')
+
+        super(Template, cls).write(templates, values, *args)
+        if not written_fields(values, args) & TEMPLATE_FIELDS:
+            return
+        queue_recompute(Relationship.get_product_node_ids([
+            p.id for t in templates + sum(args[::2], []) for p in t.products
+        ]))
+
+    @classmethod
+    def delete(cls, templates):
+        Relationship = Pool().get('product.product-product.tree_node')
+
+        node_ids = Relationship.get_product_node_ids([
+            p.id for t in templates for p in t.products
+        ])
+        super(Template, cls).delete(templates)
+        queue_recompute(node_ids)
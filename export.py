@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Static export of the catalog pages, for CDN hosting and as a fallback
+    when the application is down. Meant to be run from cron, for example::
+
+        python -m trytond.modules.nereid_catalog_tree.export \\
+            myproject.application:app /var/www/catalog \\
+            --language en_US --language fr_FR --processes 4
+
+    Every page of every active catalog node is rendered for each language,
+    along with the sitemaps of the tree. The pages are requested through a
+    test client of the application, so they are rendered as for any other
+    request. The pages are rendered by a pool of processes, each exporting
+    whole subtrees. The fingerprints and the files of the subtrees exported
+    are kept in a manifest in the output directory. The next run only
+    exports again the subtrees whose fingerprint changed, and deletes the
+    files it did not write again, like the pages of deleted nodes.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import os
+import json
+import math
+import time
+import logging
+import argparse
+import resource
+import multiprocessing
+from itertools import chain
+
+from werkzeug.utils import import_string
+from nereid import request, url_for
+from sql import Literal
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+logger = logging.getLogger('nereid_catalog_tree.export')
+
+# The file of the output directory in which the exported revisions are kept
+MANIFEST = '.export-manifest.json'
+
+# The number of nodes listed in each page of the tree sitemap
+SITEMAP_PAGE_SIZE = 50000
+
+# The options of the export, set in each process of the pool
+WORKER = {}
+
+
+def write_file(path, data):
+    """
+    Write the data to the path, through a temporary file renamed in place
+    so that a partially written page is never served
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + '.tmp', 'wb') as fileobj:
+        fileobj.write(data)
+    os.rename(path + '.tmp', path)
+
+
+def peak_memory():
+    "Return the peak resident memory of the process, in megabytes"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def init_worker(options):
+    """
+    Load the application once in each process of the pool
+    """
+    WORKER.update(options)
+    WORKER['app'] = import_string(options['app'])
+
+
+def export_subtree(node_ids):
+    """
+    Render and write all the pages of the given nodes in every language.
+    Runs in a process of the pool. Returns the number of pages and bytes
+    written, the peak memory of the process and the paths written.
+    """
+    app = WORKER['app']
+    pages = size = 0
+    paths = []
+
+    with Transaction().start(app.database_name, 0):
+        with app.test_request_context(base_url=WORKER['base_url']):
+            website = request.nereid_website
+            with Transaction().set_user(website.application_user.id):
+                urls = [
+                    (os.path.join(language, path), url)
+                    for language, locale in WORKER['locales']
+                    for path, url in get_node_pages(node_ids, locale)
+                ]
+
+    # The application starts the transaction of each request itself
+    for path, data in iter_pages(app, urls, WORKER['base_url']):
+        write_file(os.path.join(WORKER['output_dir'], path), data)
+        paths.append(path)
+        pages += 1
+        size += len(data)
+    return pages, size, peak_memory(), paths
+
+
+def get_node_pages(node_ids, locale=None):
+    """
+    Return the path and the url of each page of the given catalog nodes.
+    The first page is also written at the url of the node without page.
+
+    :param locale: The code of the locale of the website in which the
+                   pages are requested
+    """
+    Node = Pool().get('product.tree_node')
+
+    kwargs = {'locale': locale} if locale else {}
+    pages = []
+    for node in Node.browse(node_ids):
+        count = node.get_products().count
+        last_page = max(
+            1, int(math.ceil(count / float(node.products_per_page)))
+        )
+        base = os.path.join('nodes', str(node.id), node.slug)
+        for page in xrange(1, last_page + 1):
+            url = node.get_absolute_url(page=page, **kwargs)
+            pages.append((os.path.join(base, str(page), 'index.html'), url))
+            if page == 1:
+                pages.append((os.path.join(base, 'index.html'), url))
+    return pages
+
+
+def iter_pages(app, pages, base_url=None):
+    """
+    Yield the path and content of the pages, requested through a test
+    client of the application, so that the callbacks registered for the
+    request run as they do online. A page which is not rendered is logged
+    and skipped.
+
+    :param pages: A list of the paths and urls of the pages
+    """
+    client = app.test_client()
+    kwargs = {'base_url': base_url} if base_url else {}
+    last_url = response = None
+    for path, url in pages:
+        # The first page of a node is written twice but requested once
+        if url != last_url:
+            response = client.get(url, **kwargs)
+            last_url = url
+        if response.status_code != 200:
+            logger.warning('Skipped %s: %s', url, response.status)
+            continue
+        yield path, response.data
+
+
+def get_locales(website, languages):
+    """
+    Return the code of each language with the code of the locale of the
+    website in which its pages are requested, as nereid selects the
+    language of a request from its locale. A language without locale on
+    the website is logged and skipped.
+    """
+    codes = dict(
+        (locale.language.code, locale.code)
+        for locale in list(website.locales) + [website.default_locale]
+    )
+    locales = []
+    for language in languages:
+        if language not in codes:
+            logger.warning('No locale of the website in %s', language)
+            continue
+        locales.append((language, codes[language]))
+    return locales
+
+
+def get_subtrees(root_ids):
+    """
+    Return the tasks of the export of the given trees, as the id of the
+    top node of each task and the ids of the nodes it exports: the root of
+    each tree and each branch below it are exported separately, so that a
+    large tree is shared by the processes of the pool, and a branch is
+    exported again only when it changed.
+    """
+    Node = Pool().get('product.tree_node')
+
+    tasks = []
+    for root in Node.browse(root_ids):
+        tasks.append((root.id, [root.id]))
+        for child in root.children:
+            tasks.append((child.id, map(int, Node.search(
+                child._get_subtree_domain() + [('type_', '=', 'catalog')]
+            ))))
+    return [task for task in tasks if task[1]]
+
+
+def get_fingerprint(node_id):
+    """
+    Return the fingerprint of the data rendered in the pages of the subtree
+    of the node: the number and the last change of the nodes of the subtree
+    and its ancestors, and of the products listed in the subtree
+    """
+    pool = Pool()
+    Node = pool.get('product.tree_node')
+    Relationship = pool.get('product.product-product.tree_node')
+    Product = pool.get('product.product')
+    Template = pool.get('product.template')
+    cursor = Transaction().cursor
+
+    def last_change(table):
+        return Max(Coalesce(table.write_date, table.create_date))
+
+    node = Node(node_id)
+    ancestor_ids = Node._get_ancestor_ids([node.id])[node.id]
+    node_table = Node.__table__()
+    cursor.execute(*node_table.select(
+        Count(Literal(1)), last_change(node_table),
+        where=(
+            node._get_subtree_condition(node_table) |
+            node_table.id.in_(ancestor_ids)
+        )
+    ))
+    fingerprint = list(cursor.fetchone())
+
+    relationship = Relationship.__table__()
+    product = Product.__table__()
+    template = Template.__table__()
+    node_table = Node.__table__()
+    cursor.execute(*relationship.join(
+        node_table, condition=(relationship.node == node_table.id)
+    ).join(
+        product, condition=(relationship.product == product.id)
+    ).join(
+        template, condition=(product.template == template.id)
+    ).select(
+        Count(Literal(1)), last_change(relationship), last_change(product),
+        last_change(template),
+        where=node._get_subtree_condition(node_table)
+    ))
+    fingerprint.extend(cursor.fetchone())
+    return '|'.join(map(unicode, fingerprint))
+
+
+def read_manifest(output_dir):
+    """
+    Return the manifest of the last export to the directory, with the
+    languages exported and the fingerprint and the files of each subtree
+    """
+    path = os.path.join(output_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {'languages': [], 'fingerprints': {}, 'files': {}}
+    with open(path) as fileobj:
+        manifest = json.load(fileobj)
+    manifest.setdefault('files', {})
+    manifest.setdefault('fingerprints', {})
+    return manifest
+
+
+def prune_files(output_dir, old_files, new_files):
+    """
+    Delete the files of the last export which were not written again, like
+    the pages of deleted nodes, and return their number
+
+    :param old_files: The files of the last export, by subtree
+    :param new_files: The files of this export, by subtree
+    """
+    keep = set(chain.from_iterable(new_files.itervalues()))
+    pruned = 0
+    for path in set(chain.from_iterable(old_files.itervalues())) - keep:
+        try:
+            os.remove(os.path.join(output_dir, path))
+        except OSError:
+            continue
+        pruned += 1
+    return pruned
+
+
+def get_sitemap_pages():
+    """
+    Return the path and the url of the sitemap index and the sitemaps of
+    the tree
+    """
+    Node = Pool().get('product.tree_node')
+
+    count = Node.search([('active', '=', True)], count=True)
+    pages = [(
+        os.path.join('sitemaps', 'tree-index.xml'),
+        url_for('product.tree_node.sitemap_index')
+    )]
+    last_page = int(math.ceil(count / float(SITEMAP_PAGE_SIZE)))
+    for page in xrange(1, last_page + 1):
+        pages.append((
+            os.path.join('sitemaps', 'tree-%d.xml' % page),
+            url_for('product.tree_node.sitemap', page=page)
+        ))
+    return pages
+
+
+def export(app_path, output_dir, languages=None, base_url=None,
+           processes=None, full=False):
+    """
+    Export the catalog to the output directory and return the statistics
+    of the export
+
+    :param app_path: The import path of the nereid application
+    :param output_dir: The directory to which the pages are written
+    :param languages: The codes of the languages in which pages are
+                      written, the language of the website by default
+    :param base_url: The url at which the export is served
+    :param processes: The number of processes rendering the pages
+    :param full: Export all the subtrees, even when they are unchanged
+    """
+    app = import_string(app_path)
+    base_url = base_url or 'http://localhost/'
+
+    start = time.time()
+    with Transaction().start(app.database_name, 0):
+        with app.test_request_context(base_url=base_url):
+            website = request.nereid_website
+            with Transaction().set_user(website.application_user.id):
+                Node = Pool().get('product.tree_node')
+
+                if not languages:
+                    languages = [website.default_locale.language.code]
+                locales = get_locales(website, languages)
+                manifest = read_manifest(output_dir)
+                exported = {}
+                if not full and manifest['languages'] == sorted(languages):
+                    exported = manifest['fingerprints']
+
+                # The fingerprints are read before rendering, a subtree
+                # changed during the export is exported again by the next
+                # run
+                fingerprints, tasks = {}, []
+                roots = Node.search([
+                    ('parent', '=', None),
+                    ('type_', '=', 'catalog'),
+                ])
+                for top_id, node_ids in get_subtrees(map(int, roots)):
+                    key = str(top_id)
+                    fingerprints[key] = get_fingerprint(top_id)
+                    if exported.get(key) != fingerprints[key]:
+                        tasks.append((key, node_ids))
+                changed = set(key for key, _ in tasks)
+                files = dict(
+                    (key, manifest['files'].get(key, []))
+                    for key in fingerprints if key not in changed
+                )
+                sitemap_pages = get_sitemap_pages()
+
+    files['sitemaps'] = []
+    for path, data in iter_pages(app, sitemap_pages, base_url):
+        write_file(os.path.join(output_dir, path), data)
+        files['sitemaps'].append(path)
+
+    # The processes of the pool connect to the database themselves, the
+    # connections of this process must not be inherited through the fork
+    backend.get('Database')(app.database_name).close()
+
+    pool = multiprocessing.Pool(processes, init_worker, ({
+        'app': app_path,
+        'output_dir': output_dir,
+        'locales': locales,
+        'base_url': base_url,
+    },))
+    try:
+        results = pool.map(export_subtree, [ids for _, ids in tasks])
+    finally:
+        pool.close()
+        pool.join()
+    for (key, _), result in zip(tasks, results):
+        files.setdefault(key, []).extend(result[3])
+    pruned = prune_files(output_dir, manifest['files'], files)
+    elapsed = time.time() - start
+
+    write_file(os.path.join(output_dir, MANIFEST), json.dumps({
+        'languages': sorted(languages),
+        'fingerprints': fingerprints,
+        'files': files,
+    }, indent=2, sort_keys=True))
+
+    pages = sum(result[0] for result in results)
+    stats = {
+        'subtrees': len(tasks),
+        'skipped': len(fingerprints) - len(tasks),
+        'pages': pages,
+        'bytes': sum(result[1] for result in results),
+        'pruned': pruned,
+        'elapsed': elapsed,
+        'throughput': pages / elapsed if elapsed else pages,
+        'peak_memory': max(
+            [peak_memory()] + [result[2] for result in results]
+        ),
+    }
+    logger.info(
+        'Exported %(pages)d pages of %(subtrees)d subtrees (%(skipped)d '
+        'unchanged, %(pruned)d files deleted) in %(elapsed).2fs, '
+        '%(throughput).1f pages/s, peak memory %(peak_memory).1f MB per '
+        'process', stats
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export the catalog tree pages to a static directory'
+    )
+    parser.add_argument(
+        'app', help='Import path of the nereid application'
+    )
+    parser.add_argument('output_dir', help='Directory of the export')
+    parser.add_argument(
+        '-l', '--language', action='append', dest='languages',
+        help='Code of a language to export, repeat for more languages'
+    )
+    parser.add_argument(
+        '-p', '--processes', type=int, default=multiprocessing.cpu_count()
+    )
+    parser.add_argument('--base-url', default='http://localhost/')
+    parser.add_argument(
+        '--full', action='store_true',
+        help='Export all the subtrees, even those unchanged since the '
+        'last run'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    export(
+        args.app, args.output_dir, args.languages, args.base_url,
+        args.processes, args.full
+    )
+
+
+if __name__ == '__main__':
+    main()
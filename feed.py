@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Merchant product feeds for catalog tree nodes
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import os
+import csv
+import gzip
+import time
+import logging
+import argparse
+import tempfile
+from urlparse import urljoin
+from xml.sax.saxutils import escape
+
+from flask import send_file
+from werkzeug.utils import import_string
+from nereid import abort, request, route
+
+from trytond.exceptions import UserError
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from instrumentation import instrumented
+
+
+__all__ = ['Node']
+__metaclass__ = PoolMeta
+
+logger = logging.getLogger('nereid_catalog_tree.feed')
+
+
+class XMLFeedWriter(object):
+    """
+    Writes a RSS 2.0 feed using the google merchant namespace
+    """
+    mimetype = 'application/xml'
+
+    def __init__(self, fileobj, title, link):
+        self.fileobj = fileobj
+        self.title = title
+        self.link = link
+
+    def _element(self, tag, value):
+        return u'<%s>%s</%s>' % (tag, escape(value or u''), tag)
+
+    def _write(self, value):
+        self.fileobj.write(value.encode('utf-8'))
+
+    def start(self):
+        self._write(
+            u'<?xml version="1.0" encoding="UTF-8"?>\n'
+            u'<rss version="2.0" xmlns:g="http://base.google.com/ns/1.0">\n'
+            u'<channel>%s%s\n' % (
+                self._element('title', self.title),
+                self._element('link', self.link),
+            )
+        )
+
+    def write(self, item):
+        self._write(u'<item>%s</item>\n' % u''.join([
+            self._element('g:id', item['id']),
+            self._element('title', item['title']),
+            self._element('link', item['link']),
+            self._element('g:price', item['price']),
+            self._element('g:image_link', item['image_link']),
+            self._element('g:availability', item['availability']),
+        ]))
+
+    def end(self):
+        self._write(u'</channel>\n</rss>\n')
+
+
+class CSVFeedWriter(object):
+    """
+    Writes a comma separated feed with a header row
+    """
+    mimetype = 'text/csv'
+    columns = ('id', 'title', 'link', 'price', 'image_link', 'availability')
+
+    def __init__(self, fileobj, title, link):
+        self.writer = csv.writer(fileobj)
+
+    def start(self):
+        self.writer.writerow(self.columns)
+
+    def write(self, item):
+        self.writer.writerow([
+            (item[column] or u'').encode('utf-8')
+            for column in self.columns
+        ])
+
+    def end(self):
+        pass
+
+
+FEED_WRITERS = {
+    'xml': XMLFeedWriter,
+    'csv': CSVFeedWriter,
+}
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    def _get_feed_product(self, record):
+        """
+        Return the product variant which represents the record in the feed,
+        or None if a template has no active variant displayed on the eshop.
+        This is separated for easy subclassing.
+        """
+        if record.__name__ == 'product.template':
+            for product in record.products:
+                if product.active and product.displayed_on_eshop:
+                    return product
+            return None
+        return record
+
+    def get_feed_availability(self, product):
+        """
+        Return the availability of the product for the feed. Products listed
+        by the node are always displayed on the eshop and hence in stock.
+        Modules which track stock are expected to override this.
+        """
+        return u'in stock'
+
+    def get_feed_item(self, record, currency):
+        """
+        Return a dictionary with the feed data of a product, or None if the
+        record has no product to list in the feed
+
+        :param record: Active record of the product or template listed
+        :param currency: Active record of the currency of the prices
+        """
+        product = self._get_feed_product(record)
+        if product is None:
+            return None
+        image = product.default_image
+        return {
+            'id': unicode(product.id),
+            'title': product.name,
+            'link': product.get_absolute_url(_external=True),
+            'price': u'%s %s' % (product.template.list_price, currency.code),
+            'image_link': image and urljoin(request.host_url, image.url),
+            'availability': self.get_feed_availability(product),
+        }
+
+    def write_feed(self, fileobj, format='xml', chunk_size=1000):
+        """
+        Write the product feed of the tree and all of its branches to the
+        given file object. The products are streamed from the database in
+        chunks, so the feed is never held in memory.
+
+        Returns the number of products written.
+
+        :param fileobj: File like object to write the feed to
+        :param format: One of the keys of `FEED_WRITERS`
+        :param chunk_size: The number of products read in each batch
+        """
+        currency = request.nereid_website.company.currency
+        writer = FEED_WRITERS[format](
+            fileobj, self.name, self.get_absolute_url(_external=True)
+        )
+
+        start = time.time()
+        count = 0
+        writer.start()
+        for record in self.iter_products(chunk_size=chunk_size):
+            item = self.get_feed_item(record, currency)
+            if item is None:
+                continue
+            writer.write(item)
+            count += 1
+        writer.end()
+
+        elapsed = time.time() - start
+        logger.info(
+            'Feed of node %s: %d products in %.2fs (%.0f products/s)',
+            self.id, count, elapsed, count / elapsed if elapsed else count
+        )
+        return count
+
+    @route('/nodes/<int:active_id>/<slug>/feed.<format>')
+    @instrumented
+    def render_feed(self, slug=None, format='xml'):
+        """
+        Renders the product feed of the tree and all of its branches
+
+        :param slug: slug of the browse node
+        :param format: `xml` or `csv`
+        """
+        try:
+            self.slug
+        except UserError:
+            abort(404)
+
+        if self.type_ != 'catalog' or format not in FEED_WRITERS:
+            abort(404)
+
+        # The feed is spooled to disk while it is written and sent from
+        # there, instead of being built as a string in memory
+        fileobj = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self.write_feed(fileobj, format)
+        fileobj.seek(0)
+        return send_file(fileobj, mimetype=FEED_WRITERS[format].mimetype)
+
+
+def main():
+    """
+    Write gzipped product feeds of the given nodes. Meant to be run from
+    cron, for example::
+
+        python -m trytond.modules.nereid_catalog_tree.feed \\
+            myproject.application:app 1 2 --base-url http://example.com/
+    """
+    parser = argparse.ArgumentParser(
+        description='Generate merchant product feeds of catalog tree nodes'
+    )
+    parser.add_argument(
+        'app', help='Import path of the nereid application'
+    )
+    parser.add_argument('nodes', type=int, nargs='+', help='Node ids')
+    parser.add_argument(
+        '-f', '--format', choices=sorted(FEED_WRITERS), default='xml'
+    )
+    parser.add_argument('-o', '--output-dir', default='.')
+    parser.add_argument('--base-url', default='http://localhost/')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = import_string(args.app)
+
+    with Transaction().start(app.database_name, 0):
+        with app.test_request_context(base_url=args.base_url):
+            website = request.nereid_website
+            # The prices are company properties, read in the company of the
+            # website as in the requests
+            with Transaction().set_user(website.application_user.id), \
+                    Transaction().set_context(company=website.company.id):
+                Node = Pool().get('product.tree_node')
+                for node in Node.browse(args.nodes):
+                    path = os.path.join(
+                        args.output_dir,
+                        'node-%d.%s.gz' % (node.id, args.format)
+                    )
+                    fileobj = gzip.open(path, 'wb')
+                    try:
+                        node.write_feed(fileobj, args.format)
+                    finally:
+                        fileobj.close()
+
+
+if __name__ == '__main__':
+    main()
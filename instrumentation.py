@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Opt-in SQL and timing instrumentation of the catalog routes
+
+    The instrumentation is enabled with the `CATALOG_TREE_INSTRUMENTATION`
+    setting of the nereid application. Each instrumented request then
+    records the number and time of its queries, the number of rows fetched,
+    the time spent in the view and in rendering the response.
+
+    * In debug mode the figures of a request are sent in the
+      `X-Catalog-Tree-Metrics` response header.
+    * The percentiles per route are served as JSON by
+      `/catalog-tree/metrics` and logged every
+      `CATALOG_TREE_METRICS_LOG_INTERVAL` (default 1000) requests.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+from functools import wraps
+
+from flask import (
+    after_this_request, current_app, g, has_app_context, jsonify
+)
+from nereid import abort, route
+
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+
+__all__ = ['Node']
+__metaclass__ = PoolMeta
+
+logger = logging.getLogger('nereid_catalog_tree.instrumentation')
+
+# The number of requests of each route kept to compute the percentiles
+SAMPLE_SIZE = 1000
+
+
+class Probe(object):
+    """
+    Measures a request by wrapping the cursor of its transaction
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.query_time = 0.0
+        self.rows = 0
+
+    def start(self):
+        self.cursors = []
+        self.attach(Transaction().cursor)
+        if has_app_context():
+            g.catalog_tree_probes = getattr(
+                g, 'catalog_tree_probes', []
+            ) + [self]
+        self.start_time = self.view_end = time.time()
+
+    def attach(self, cursor):
+        """
+        Measure the queries of the cursor too
+        """
+        execute = cursor.execute
+        fetchall = cursor.fetchall
+        fetchmany = cursor.fetchmany
+        fetchone = cursor.fetchone
+
+        def timed_execute(*args, **kwargs):
+            start = time.time()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                self.queries += 1
+                self.query_time += time.time() - start
+
+        def counted_fetchall():
+            rows = fetchall()
+            self.rows += len(rows)
+            return rows
+
+        def counted_fetchmany(*args, **kwargs):
+            rows = fetchmany(*args, **kwargs)
+            self.rows += len(rows)
+            return rows
+
+        def counted_fetchone():
+            row = fetchone()
+            if row is not None:
+                self.rows += 1
+            return row
+
+        cursor.execute = timed_execute
+        cursor.fetchall = counted_fetchall
+        cursor.fetchmany = counted_fetchmany
+        cursor.fetchone = counted_fetchone
+        self.cursors.append(cursor)
+
+    def view_done(self):
+        self.view_end = time.time()
+
+    def stop(self):
+        self.end = time.time()
+        for cursor in self.cursors:
+            for name in ('execute', 'fetchall', 'fetchmany', 'fetchone'):
+                cursor.__dict__.pop(name, None)
+        self.cursors = []
+        if has_app_context():
+            g.catalog_tree_probes = [
+                probe for probe in getattr(g, 'catalog_tree_probes', [])
+                if probe is not self
+            ]
+
+    @property
+    def total_time(self):
+        return self.end - self.start_time
+
+    @property
+    def view_time(self):
+        return self.view_end - self.start_time
+
+    @property
+    def render_time(self):
+        return self.end - self.view_end
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'query_time': self.query_time,
+            'rows': self.rows,
+            'view_time': self.view_time,
+            'render_time': self.render_time,
+            'total_time': self.total_time,
+        }
+
+
+class RouteMetrics(object):
+    """
+    Keeps the measures of the last requests of each route in the process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(lambda: deque(maxlen=SAMPLE_SIZE))
+        self.requests = 0
+
+    def record(self, probe):
+        with self.lock:
+            self.samples[probe.name].append(probe.as_dict())
+            self.requests += 1
+            return self.requests
+
+    def summary(self):
+        """
+        Return the p50, p95 and p99 of the measures of each route
+        """
+        with self.lock:
+            samples = dict(
+                (name, list(values))
+                for name, values in self.samples.iteritems()
+            )
+
+        result = {}
+        for name, values in samples.iteritems():
+            result[name] = {'requests': len(values)}
+            for measure in ('total_time', 'render_time', 'queries'):
+                ordered = sorted(value[measure] for value in values)
+                result[name][measure] = dict(
+                    ('p%d' % p, ordered[min(
+                        len(ordered) - 1, len(ordered) * p // 100
+                    )])
+                    for p in (50, 95, 99)
+                )
+        return result
+
+
+metrics = RouteMetrics()
+
+
+def attach_probes(cursor):
+    """
+    Measure the queries of the cursor to which the transaction of the
+    request switched, like a cursor on the replica, with the probes
+    started in the request
+    """
+    if not has_app_context():
+        return
+    for probe in getattr(g, 'catalog_tree_probes', []):
+        probe.attach(cursor)
+
+
+def instrumented(function):
+    """
+    Instrument a route of a model when the instrumentation is enabled. The
+    decorator must be applied below the route decorators.
+    """
+    @wraps(function)
+    def wrapper(self_or_cls, *args, **kwargs):
+        if not current_app.config.get('CATALOG_TREE_INSTRUMENTATION'):
+            return function(self_or_cls, *args, **kwargs)
+
+        probe = Probe('%s.%s' % (self_or_cls.__name__, function.__name__))
+        probe.start()
+        try:
+            rv = function(self_or_cls, *args, **kwargs)
+        except Exception:
+            probe.stop()
+            raise
+        probe.view_done()
+
+        @after_this_request
+        def finish(response):
+            # The response is rendered by now, including the lazily
+            # rendered templates
+            probe.stop()
+            requests = metrics.record(probe)
+            if current_app.debug:
+                response.headers['X-Catalog-Tree-Metrics'] = ', '.join(
+                    '%s=%s' % item for item in sorted(
+                        probe.as_dict().iteritems()
+                    )
+                )
+            interval = current_app.config.get(
+                'CATALOG_TREE_METRICS_LOG_INTERVAL', 1000
+            )
+            if requests % interval == 0:
+                logger.info('Catalog tree metrics: %s', metrics.summary())
+            return response
+        return rv
+    return wrapper
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    @classmethod
+    @route('/catalog-tree/metrics')
+    def render_metrics(cls):
+        """
+        Return the percentiles of the measures of the instrumented routes
+        in this process
+        """
+        if not current_app.config.get('CATALOG_TREE_INSTRUMENTATION'):
+            abort(404)
+        return jsonify(metrics.summary())
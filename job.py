@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Deferred rebuilds of catalog tree data
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import uuid
+import logging
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+from sql import Null
+
+from trytond import backend
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+__all__ = ['TreeJob']
+
+logger = logging.getLogger('nereid_catalog_tree.job')
+
+# The number of failed runs after which a job is left aside
+MAX_ATTEMPTS = 5
+
+# The time after which the jobs of a run which never finished are claimed
+# again by the next run, in seconds
+CLAIM_TIMEOUT = 60 * 60
+
+
+class TreeJob(ModelSQL):
+    """
+    Catalog Tree Job
+
+    A pending call of a rebuild method. Jobs are coalesced: enqueuing a
+    job which is already pending does nothing, so a burst of writes ends
+    up in a single rebuild. The jobs are processed by the `run` cron task,
+    outside of the transactions of the editors.
+
+    A run claims the pending jobs in a short transaction of its own, then
+    calls each method in a transaction of its own, which deletes the jobs
+    of the call if it succeeds. A job enqueued while a run holds the same
+    key is not coalesced into the claimed job but queued again for the
+    next run, so enqueuing never waits on a run. A call which fails is
+    rolled back alone, and its jobs are released for the next run up to
+    `MAX_ATTEMPTS` times.
+    """
+    __name__ = 'product.tree_node.job'
+
+    model = fields.Char('Model', required=True, select=True, readonly=True)
+    method = fields.Char('Method', required=True, select=True, readonly=True)
+    key = fields.Char('Key', required=True, readonly=True)
+    run = fields.Char('Run', select=True, readonly=True)
+    claimed_at = fields.DateTime('Claimed At', readonly=True)
+    attempts = fields.Integer('Attempts', required=True, readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+
+        super(TreeJob, cls).__register__(module_name)
+
+        # Migration: a key may be queued again while a run holds it
+        table.drop_constraint('job_uniq')
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def enqueue(cls, model, method, keys):
+        """
+        Queue calls of `method` of `model` for the given keys. The method
+        is called with the list of keys queued for it.
+
+        :param model: Name of the model of the method
+        :param method: Name of a classmethod taking a list of keys
+        :param keys: List of keys (strings) of the jobs
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        keys = sorted(set(keys))
+        queued = set()
+        for i in range(0, len(keys), cursor.IN_MAX):
+            sub_keys = keys[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.key, where=(
+                    (table.model == model) &
+                    (table.method == method) &
+                    (table.run == Null) &
+                    table.key.in_(sub_keys)
+                )
+            ))
+            queued.update(row[0] for row in cursor.fetchall())
+        cls.create([
+            {'model': model, 'method': method, 'key': key}
+            for key in keys if key not in queued
+        ])
+
+    @classmethod
+    def is_pending(cls, model, method):
+        """
+        Return True if a call of the method is waiting to be processed or
+        being processed
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.select(
+            table.id, where=(
+                (table.model == model) & (table.method == method)
+            ), limit=1
+        ))
+        return cursor.fetchone() is not None
+
+    @classmethod
+    def claim(cls):
+        """
+        Claim the pending jobs for a new run. Returns the id of the run and
+        a dictionary mapping each (model, method) to the sorted keys of its
+        call. The jobs of a run which did not finish within `CLAIM_TIMEOUT`
+        are claimed again.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        run_id = uuid.uuid4().hex
+        now = datetime.now()
+        cursor.execute(*table.update(
+            columns=[table.run, table.claimed_at],
+            values=[run_id, now],
+            where=(
+                (
+                    (table.run == Null) |
+                    (table.claimed_at < now - timedelta(seconds=CLAIM_TIMEOUT))
+                ) & (table.attempts < MAX_ATTEMPTS)
+            )
+        ))
+        cursor.execute(*table.select(
+            table.model, table.method, table.key,
+            where=(table.run == run_id)
+        ))
+        calls = defaultdict(set)
+        for model, method, key in cursor.fetchall():
+            calls[(model, method)].add(key)
+        return run_id, dict(
+            (call, sorted(keys)) for call, keys in calls.iteritems()
+        )
+
+    @classmethod
+    def _get_call_condition(cls, table, run_id, model, method):
+        return (
+            (table.run == run_id) &
+            (table.model == model) &
+            (table.method == method)
+        )
+
+    @classmethod
+    def run_call(cls, run_id, model, method, keys):
+        """
+        Call the method with the keys claimed by the run and delete the
+        jobs of the call
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        logger.info('Running %s.%s for %d keys', model, method, len(keys))
+        getattr(Pool().get(model), method)(keys)
+        cursor.execute(*table.delete(
+            where=cls._get_call_condition(table, run_id, model, method)
+        ))
+
+    @classmethod
+    def release(cls, run_id, model, method):
+        """
+        Release the jobs of a failed call for the next run
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.update(
+            columns=[table.run, table.claimed_at, table.attempts],
+            values=[Null, Null, table.attempts + 1],
+            where=cls._get_call_condition(table, run_id, model, method)
+        ))
+
+    @classmethod
+    def process(cls, commit=False):
+        """
+        Claim and run the pending jobs. Jobs queued meanwhile, even by the
+        methods called, are left for the next run.
+
+        :param commit: Claim the jobs and run each call in a transaction of
+                       its own, committed when it ends, instead of running
+                       everything in the current transaction
+        """
+        if not commit:
+            run_id, calls = cls.claim()
+            for (model, method), keys in sorted(calls.iteritems()):
+                cls.run_call(run_id, model, method, keys)
+            return
+
+        with Transaction().new_cursor():
+            run_id, calls = cls.claim()
+            Transaction().cursor.commit()
+        for (model, method), keys in sorted(calls.iteritems()):
+            with Transaction().new_cursor():
+                try:
+                    cls.run_call(run_id, model, method, keys)
+                    Transaction().cursor.commit()
+                except Exception:
+                    Transaction().cursor.rollback()
+                    logger.exception(
+                        'Running %s.%s failed, its jobs are released',
+                        model, method
+                    )
+                    cls.release(run_id, model, method)
+                    Transaction().cursor.commit()
+
+    @classmethod
+    def run(cls):
+        """
+        Process the queued jobs. This is called by cron.
+        """
+        cls.process(commit=True)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Lightweight JSON listing of the products of tree nodes
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import json
+import tempfile
+
+from flask import send_file
+from nereid import abort, request, route, url_for
+from sql.aggregate import Min
+
+from trytond.exceptions import UserError
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from instrumentation import instrumented
+
+
+__all__ = ['Node']
+__metaclass__ = PoolMeta
+
+# The maximum number of products returned by a request of the listing
+MAX_LIMIT = 5000
+
+# The number of products read from the database in each batch
+BATCH_SIZE = 200
+
+
+def keyset_condition(columns, values):
+    """
+    Return the SQL condition of the rows which come after the given values
+    of the columns, in the ascending order of the columns
+    """
+    condition = None
+    for column, value in reversed(zip(columns, values)):
+        if condition is None:
+            condition = column > value
+        else:
+            condition = (column > value) | ((column == value) & condition)
+    return condition
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    def _get_listing_rows(self, after=None, limit=BATCH_SIZE):
+        """
+        Return the (sort key..., id) rows of the products listed by the node
+        which come after the given cursor, in the order of the listing. A
+        product listed more than once in the tree comes at its first
+        position.
+
+        :param after: The sort key and id of the last product already
+                      listed, or None to start from the first product
+        :param limit: The maximum number of rows to return
+        """
+        cursor = Transaction().cursor
+
+        query = self._get_product_ids_query()
+        columns = [order.expression for order in query.order_by]
+        query.columns = columns
+        if after is not None:
+            query.having = keyset_condition(columns, after)
+        query.limit = limit
+        cursor.execute(*query)
+        return cursor.fetchall()
+
+    def get_listing_items(self, ids):
+        """
+        Return the listing data of the given products or templates, in the
+        same order. The fields are read in one batch per model, without
+        instantiating the records.
+
+        :param ids: The ids of the records listed by the node
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        StaticFile = pool.get('nereid.static.file')
+        cursor = Transaction().cursor
+
+        if self.display == 'product.template':
+            # A template is represented by its first variant on the eshop
+            table = Product.__table__()
+            cursor.execute(*table.select(
+                table.template, Min(table.id),
+                where=table.template.in_(ids) & table.displayed_on_eshop,
+                group_by=[table.template]
+            ))
+            product_ids = dict(cursor.fetchall())
+        else:
+            product_ids = dict((id_, id_) for id_ in ids)
+
+        products = dict(
+            (product['id'], product) for product in Product.read(
+                product_ids.values(), ['uri', 'template', 'default_image']
+            )
+        )
+        templates = dict(
+            (template['id'], template) for template in Template.read(
+                list(set(p['template'] for p in products.itervalues())),
+                ['name', 'list_price']
+            )
+        )
+        images = dict(
+            (image['id'], image['url']) for image in StaticFile.read(
+                filter(None, set(
+                    p['default_image'] for p in products.itervalues()
+                )), ['url']
+            )
+        )
+
+        items = []
+        for id_ in ids:
+            product = products[product_ids[id_]]
+            template = templates[product['template']]
+            price = template['list_price']
+            items.append({
+                'id': id_,
+                'name': template['name'],
+                'url': url_for('product.product.render', uri=product['uri']),
+                'image': images.get(product['default_image']),
+                'price': unicode(price) if price is not None else None,
+            })
+        return items
+
+    def write_listing(self, fileobj, after=None, limit=BATCH_SIZE):
+        """
+        Write the JSON listing of the products of the node to the file
+        object, reading the products in batches. Returns the cursor of the
+        next products, or None if the listing is complete.
+
+        :param fileobj: File like object to write the listing to
+        :param after: The cursor returned by the previous request
+        :param limit: The number of products to write
+        """
+        currency = request.nereid_website.company.currency
+
+        fileobj.write('{"currency": %s, "products": [' % json.dumps(
+            currency.code
+        ))
+        next_cursor = after
+        written = 0
+        while written < limit:
+            batch_size = min(BATCH_SIZE, limit - written)
+            rows = self._get_listing_rows(next_cursor, batch_size)
+            for item in self.get_listing_items([row[-1] for row in rows]):
+                if written:
+                    fileobj.write(', ')
+                fileobj.write(json.dumps(item))
+                written += 1
+            if len(rows) < batch_size:
+                next_cursor = None
+                break
+            next_cursor = tuple(rows[-1])
+        fileobj.write('], "next": %s}' % json.dumps(
+            next_cursor and '.'.join(map(str, next_cursor))
+        ))
+        return next_cursor
+
+    @route('/nodes/<int:active_id>/<slug>/products.json')
+    @instrumented
+    def render_listing(self, slug=None):
+        """
+        Renders a JSON listing of the products of the tree and all of its
+        branches, for widgets which do not need the full page. The products
+        are paginated with the `after` cursor returned in `next` by the
+        previous request.
+
+        :param slug: slug of the browse node
+        """
+        try:
+            self.slug
+        except UserError:
+            abort(404)
+
+        if self.type_ != 'catalog':
+            abort(403)
+
+        limit = request.args.get('limit', self.products_per_page, type=int)
+        if limit < 1:
+            abort(400)
+        limit = min(limit, MAX_LIMIT)
+
+        after = request.args.get('after')
+        if after is not None:
+            try:
+                after = tuple(int(value) for value in after.split('.'))
+            except ValueError:
+                abort(400)
+            # The cursor has a value for each column of the sort key
+            if len(after) != len(self._get_product_ids_query().order_by):
+                abort(400)
+
+        fileobj = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self.write_listing(fileobj, after, limit)
+        fileobj.seek(0)
+        return send_file(fileobj, mimetype='application/json')
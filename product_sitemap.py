@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Sitemaps of the products listed in each tree
+
+    The products of each root node of a website are listed with the url
+    of their canonical category path (`/product/<path>/<uri>`), in gzipped
+    sitemaps of up to `SITEMAP_SIZE` urls, written to the data directory.
+
+    The sitemaps are written by a tree job, queued by the request of the
+    sitemap index when the revision of their tree changed. Until the job
+    is run, the sitemaps written last are served. As the job runs outside
+    of any request, the index keeps the url of the product route of each
+    website, with placeholders, in the sitemap directory, and the job fills
+    it for each product.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import os
+import re
+import json
+import gzip
+import tempfile
+from xml.sax.saxutils import escape
+
+from flask import current_app, send_file
+from werkzeug.urls import url_quote
+from nereid import abort, request, route, url_for
+
+from trytond.config import CONFIG
+from trytond.exceptions import UserError
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from instrumentation import instrumented
+from revision import node_scope
+
+
+__all__ = ['Node']
+__metaclass__ = PoolMeta
+
+# The maximum number of urls in a sitemap
+SITEMAP_SIZE = 50000
+
+# The number of products read from the database in each batch
+CHUNK_SIZE = 1000
+
+# The placeholders of the url of the product route filled by the job
+URL_PLACEHOLDER = re.compile('__(path|uri)__')
+
+
+def get_sitemap_directory():
+    """
+    Return the directory of the product sitemaps of the current database
+    """
+    return os.path.join(
+        CONFIG['data_path'], Transaction().cursor.database_name,
+        'nereid_catalog_tree', 'sitemaps'
+    )
+
+
+def write_file(path, data):
+    "Write the data to the path through a temporary file renamed in place"
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as fileobj:
+        fileobj.write(data)
+    os.rename(tmp_path, path)
+
+
+def get_url_template_path(website_id):
+    """
+    Return the path of the file keeping the url of the product route of
+    the website, with `__path__` and `__uri__` placeholders
+    """
+    return os.path.join(
+        get_sitemap_directory(), 'products-%d.url' % website_id
+    )
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    def iter_sitemap_product_ids(self, chunk_size=CHUNK_SIZE):
+        """
+        Iterate over chunks of the ids of the product variants listed in the
+        tree and all of its branches, whatever the display of the node. The
+        listing is read with `iter_product_ids`, and the templates listed by
+        a node displaying templates are expanded to their variants.
+        """
+        Product = Pool().get('product.product')
+
+        Model = self._get_products()[0]
+        for ids in self.iter_product_ids(chunk_size):
+            if Model.__name__ != 'product.product':
+                ids = [p.id for p in Product.search([
+                    ('template', 'in', ids),
+                    ('displayed_on_eshop', '=', True),
+                ], order=[('id', 'ASC')])]
+            if ids:
+                yield ids
+
+    def get_sitemap_urls(self, url_template):
+        """
+        Iterate over the urls of the products listed in the tree, with the
+        slugs of their shallowest category path in the tree
+
+        :param url_template: The external url of the product route, with
+                             `__path__` and `__uri__` placeholders
+        """
+        Product = Pool().get('product.product')
+
+        slugs = dict(
+            (node.id, node.slug)
+            for node in self.search(self._get_subtree_domain())
+        )
+        for ids in self.iter_sitemap_product_ids():
+            paths = Product.get_node_paths(ids)
+            for product in Product.read(ids, ['uri']):
+                path = next((
+                    p for p in paths[product['id']]
+                    if all(node_id in slugs for node_id in p)
+                ), None)
+                if path is None:
+                    continue
+                values = {
+                    'path': url_quote(
+                        '/'.join(slugs[node_id] for node_id in path)
+                    ),
+                    'uri': url_quote(product['uri']),
+                }
+                yield URL_PLACEHOLDER.sub(
+                    lambda match: values[match.group(1)], url_template
+                )
+
+    def _get_sitemap_path(self, website_id, name):
+        return os.path.join(
+            get_sitemap_directory(), 'products-%d-%d%s' % (
+                website_id, self.id, name
+            )
+        )
+
+    def write_product_sitemaps(self, website_id, url_template):
+        """
+        Write the gzipped product sitemaps of the tree for the website and
+        return their number. The sitemaps are written to temporary files
+        renamed in place, so a sitemap being written is never served.
+        """
+        directory = get_sitemap_directory()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        pages = 0
+        fileobj = None
+        count = SITEMAP_SIZE
+        for url in self.get_sitemap_urls(url_template):
+            if count == SITEMAP_SIZE:
+                if fileobj is not None:
+                    self._close_sitemap(fileobj, website_id, pages)
+                pages += 1
+                fileobj = self._open_sitemap()
+                count = 0
+            fileobj.write('<url><loc>%s</loc></url>\n' % escape(url))
+            count += 1
+        if fileobj is not None:
+            self._close_sitemap(fileobj, website_id, pages)
+        return pages
+
+    def _open_sitemap(self):
+        fd, path = tempfile.mkstemp(dir=get_sitemap_directory())
+        os.close(fd)
+        fileobj = gzip.open(path, 'wb')
+        fileobj.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        )
+        return fileobj
+
+    def _close_sitemap(self, fileobj, website_id, page):
+        fileobj.write('</urlset>\n')
+        path = fileobj.name
+        fileobj.close()
+        os.rename(
+            path, self._get_sitemap_path(website_id, '-%d.xml.gz' % page)
+        )
+
+    def get_product_sitemaps(self, website_id):
+        """
+        Return the number of the product sitemaps of the tree written for
+        the website, and whether they were written at the current revision
+        of the tree
+        """
+        Revision = Pool().get('product.tree_node.revision')
+
+        manifest_path = self._get_sitemap_path(website_id, '.json')
+        if not os.path.exists(manifest_path):
+            return 0, False
+        with open(manifest_path) as fileobj:
+            manifest = json.load(fileobj)
+        return manifest['pages'], (
+            manifest['revision'] ==
+            Revision.get_revision(node_scope(self.id))
+        )
+
+    @classmethod
+    def write_queued_sitemaps(cls, keys):
+        """
+        Write the product sitemaps of the trees. This is the handler of the
+        tree jobs queued by the sitemap index.
+
+        :param keys: The ids of the website and of the root node, separated
+                     by a comma
+        """
+        Revision = Pool().get('product.tree_node.revision')
+
+        for key in keys:
+            website_id, root_id = map(int, key.split(','))
+            roots = cls.search([('id', '=', root_id)])
+            template_path = get_url_template_path(website_id)
+            if not roots or not os.path.exists(template_path):
+                continue
+            root, = roots
+            with open(template_path) as fileobj:
+                url_template = fileobj.read()
+
+            # The revision is read first, so the sitemaps of a tree changed
+            # while they are written are written again
+            revision = Revision.get_revision(node_scope(root.id))
+            pages = root.write_product_sitemaps(website_id, url_template)
+            write_file(
+                root._get_sitemap_path(website_id, '.json'),
+                json.dumps({'revision': revision, 'pages': pages})
+            )
+
+    @classmethod
+    @route('/sitemaps/products-index.xml')
+    @instrumented
+    def product_sitemap_index(cls):
+        """
+        Renders the index of the product sitemaps of the trees of the
+        website, and queues the sitemaps of the trees changed since they
+        were written
+        """
+        pool = Pool()
+        WebsiteTreeNode = pool.get('nereid.website-product.tree_node')
+        Job = pool.get('product.tree_node.job')
+
+        website = request.nereid_website
+        url_template = url_for(
+            'product.product.render', uri='__uri__', path='__path__',
+            _external=True
+        )
+        template_path = get_url_template_path(website.id)
+        if not os.path.exists(template_path) or \
+                open(template_path).read() != url_template:
+            write_file(template_path, url_template)
+
+        roots = [
+            record.node for record in WebsiteTreeNode.search([
+                ('website', '=', website.id),
+                ('node.parent', '=', None),
+                ('node.active', '=', True),
+            ])
+        ]
+
+        urls, stale = [], []
+        for root in roots:
+            pages, current = root.get_product_sitemaps(website.id)
+            if not current:
+                stale.append('%d,%d' % (website.id, root.id))
+            urls.extend(
+                url_for(
+                    'product.tree_node.product_sitemap', active_id=root.id,
+                    page=page, _external=True
+                )
+                for page in xrange(1, pages + 1)
+            )
+        if stale:
+            # The jobs are queued without locking, crawlers never wait on
+            # the run writing the sitemaps
+            Job.enqueue(cls.__name__, 'write_queued_sitemaps', stale)
+
+        return current_app.response_class(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<sitemapindex '
+            'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n' +
+            ''.join(
+                '<sitemap><loc>%s</loc></sitemap>\n' % escape(url)
+                for url in urls
+            ) +
+            '</sitemapindex>\n',
+            mimetype='application/xml'
+        )
+
+    @route('/sitemaps/products-<int:active_id>-<int:page>.xml.gz')
+    @instrumented
+    def product_sitemap(self, page):
+        """
+        Sends a gzipped sitemap of the products of the tree
+
+        :param page: The number of the sitemap
+        """
+        website = request.nereid_website
+
+        try:
+            self.slug
+        except UserError:
+            abort(404)
+
+        if self.parent or self.type_ != 'catalog' or not self.active:
+            abort(404)
+        pages, _ = self.get_product_sitemaps(website.id)
+        if not 1 <= page <= pages:
+            abort(404)
+        return send_file(
+            self._get_sitemap_path(website.id, '-%d.xml.gz' % page),
+            mimetype='application/x-gzip', conditional=True
+        )
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Routing of the storefront catalog reads to a secondary database
+
+    The catalog routes only read, and can be served by a replica of the
+    database instead of the primary which also takes the backoffice
+    writes. The replica is the database named by the
+    `CATALOG_TREE_REPLICA_DATABASE` setting of the nereid application (a
+    streaming replica exposed under another name, or in tests a copy of the
+    database).
+
+    A replica which has not caught up with the primary would serve a stale
+    catalog, so the revisions of all the trees are compared on both
+    databases first. The route falls back to the primary when the replica
+    is more than `CATALOG_TREE_REPLICA_MAX_LAG` revisions (default 0) behind
+    on any tree, or when the replica cannot be reached. A replica which
+    could not be reached is not tried again for
+    `CATALOG_TREE_REPLICA_RETRY_DELAY` seconds (default 30), so that an
+    outage does not add a connection timeout to every request.
+
+    The transactions on the replica are read only, so a route writing by
+    mistake fails instead of diverging from the primary.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import time
+import logging
+from functools import wraps
+
+from flask import current_app
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from instrumentation import attach_probes
+
+
+logger = logging.getLogger('nereid_catalog_tree.replica')
+
+# The time of the last failed connection to each replica database
+_failures = {}
+
+
+def get_replica_cursor():
+    """
+    Return a new cursor in a read only transaction on the replica
+    database, or None if there is no replica or it cannot be reached
+    """
+    database_name = current_app.config.get('CATALOG_TREE_REPLICA_DATABASE')
+    if not database_name:
+        return None
+    retry_delay = current_app.config.get(
+        'CATALOG_TREE_REPLICA_RETRY_DELAY', 30
+    )
+    if time.time() - _failures.get(database_name, 0) < retry_delay:
+        return None
+
+    Database = backend.get('Database')
+    cursor = None
+    try:
+        cursor = Database(database_name).connect().cursor()
+        if database_name not in Pool.database_list():
+            with Transaction().set_cursor(cursor):
+                Pool(database_name).init()
+            cursor.rollback()
+        if backend.name() != 'sqlite':
+            cursor.execute('SET TRANSACTION READ ONLY')
+    except Exception:
+        logger.warning(
+            'Could not connect to the replica %s, retrying in %s seconds',
+            database_name, retry_delay, exc_info=True
+        )
+        _failures[database_name] = time.time()
+        if cursor is not None:
+            cursor.close()
+        return None
+    _failures.pop(database_name, None)
+    return cursor
+
+
+def is_replica_current(cursor):
+    """
+    Return True if the revision of every tree and website on the replica
+    is close enough to its revision on the primary
+
+    :param cursor: A cursor on the replica
+    """
+    max_lag = current_app.config.get('CATALOG_TREE_REPLICA_MAX_LAG', 0)
+
+    primary = Pool().get('product.tree_node.revision').get_state()
+    with Transaction().set_cursor(cursor):
+        replica = Pool().get('product.tree_node.revision').get_state()
+    return all(
+        revision - replica['revisions'].get(scope, 0) <= max_lag
+        for scope, revision in primary['revisions'].iteritems()
+    )
+
+
+def replica_read(function):
+    """
+    Run a read only route on the replica database when it is configured
+    and up to date. The response is rendered before the cursor is switched
+    back, so the queries of the templates run on the replica too. The
+    decorator must be applied below the route decorators.
+    """
+    @wraps(function)
+    def wrapper(self_or_cls, *args, **kwargs):
+        cursor = get_replica_cursor()
+        if cursor is None:
+            return function(self_or_cls, *args, **kwargs)
+
+        try:
+            try:
+                current = is_replica_current(cursor)
+            except Exception:
+                logger.warning(
+                    'Could not read the revision of the replica',
+                    exc_info=True
+                )
+                current = False
+            if not current:
+                return function(self_or_cls, *args, **kwargs)
+
+            with Transaction().set_cursor(cursor):
+                attach_probes(cursor)
+                return current_app.make_response(
+                    function(self_or_cls, *args, **kwargs)
+                )
+        finally:
+            cursor.close()
+    return wrapper
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Revisions of the catalog trees used to invalidate cached tree data
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+from bisect import bisect_right
+from datetime import datetime
+from weakref import WeakKeyDictionary
+
+from trytond import backend
+from trytond.model import ModelSQL, fields
+from trytond.cache import Cache
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from sql import Null, Table
+
+
+__all__ = ['TreeRevision']
+
+# The revisions read by a transaction, keyed by the cursor of the
+# transaction, so that they are read once per request
+_states = WeakKeyDictionary()
+
+
+def node_scope(root_id):
+    "Return the revision scope of the tree of the given root node"
+    return 'node,%d' % root_id
+
+
+def website_scope(website_id):
+    "Return the revision scope of the root nodes of the given website"
+    return 'website,%d' % website_id
+
+
+# Scope of the data which depends on all the trees, like the paths of
+# products. Its revision is not stored but is the sum of the revisions of
+# the trees, so the editors of different trees never update the same row.
+CATALOG_SCOPE = 'catalog'
+
+
+class TreeRevision(ModelSQL):
+    """
+    Catalog Tree Revision
+
+    Every write to the nodes of a tree, the products listed in them or the
+    root nodes of a website bumps the revision of the affected scope in
+    the writing transaction. Cached tree data is keyed by the revision of
+    its scope, so the other worker processes stop using stale entries as
+    soon as the transaction is committed, while the entries of the other
+    trees remain valid.
+
+    The rows of the scopes of the trees and websites are created with them,
+    so concurrent bumps of a scope only ever update its row.
+    """
+    __name__ = 'product.tree_node.revision'
+
+    scope = fields.Char('Scope', required=True, select=True)
+    revision = fields.Integer('Revision', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TreeRevision, cls).__setup__()
+        cls._sql_constraints += [
+            ('scope_uniq', 'UNIQUE(scope)', 'The scope must be unique.'),
+        ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(TreeRevision, cls).__register__(module_name)
+
+        # Migration: create the scopes of the trees and websites which
+        # existed before their scopes were created with them
+        scopes = []
+        if TableHandler.table_exist(cursor, 'product_tree_node'):
+            node = Table('product_tree_node')
+            cursor.execute(*node.select(
+                node.id, where=(node.parent == Null)
+            ))
+            scopes.extend(node_scope(row[0]) for row in cursor.fetchall())
+        if TableHandler.table_exist(cursor, 'nereid_website'):
+            website = Table('nereid_website')
+            cursor.execute(*website.select(website.id))
+            scopes.extend(website_scope(row[0]) for row in cursor.fetchall())
+        cls.create_scopes(scopes)
+
+    @staticmethod
+    def default_revision():
+        return 0
+
+    @classmethod
+    def create_scopes(cls, scopes):
+        """
+        Create the rows of the given scopes which do not exist yet, at
+        revision 0. A scope must be created by the transaction creating
+        its tree or website, which no other transaction can bump yet.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        scopes = sorted(set(scopes))
+        existing = set()
+        for i in range(0, len(scopes), cursor.IN_MAX):
+            sub_scopes = scopes[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.scope, where=table.scope.in_(sub_scopes)
+            ))
+            existing.update(row[0] for row in cursor.fetchall())
+        missing = [scope for scope in scopes if scope not in existing]
+        if missing:
+            now = datetime.now()
+            cursor.execute(*table.insert(
+                [table.scope, table.revision, table.create_uid,
+                    table.create_date],
+                [[scope, 0, Transaction().user, now] for scope in missing]
+            ))
+
+    @classmethod
+    def get_state(cls):
+        """
+        Return the state of the trees as seen by the current transaction.
+        This is a dictionary with
+
+            * `revisions`: a dictionary of the revision of each scope
+            * `catalog`: the revision of `CATALOG_SCOPE`
+            * `roots`: the sorted list of (left, right, id) of the root
+              nodes, to find the tree of a node without querying
+            * `dirty`: True if the transaction bumped a revision
+            * `rebuilding`: True if a rebuild of the nested set is pending,
+              in which case the roots cannot be trusted
+
+        The state is read with a few small queries the first time it is
+        needed in a transaction (i.e. once per request).
+        """
+        pool = Pool()
+        Node = pool.get('product.tree_node')
+        Job = pool.get('product.tree_node.job')
+        cursor = Transaction().cursor
+
+        state = _states.get(cursor)
+        if state is None:
+            table = cls.__table__()
+            node = Node.__table__()
+
+            cursor.execute(*table.select(table.scope, table.revision))
+            revisions = dict(cursor.fetchall())
+            # The revisions only ever grow, so the sum changes with any of
+            # them
+            catalog = sum(
+                revision for scope, revision in revisions.iteritems()
+                if scope.startswith('node,')
+            )
+            cursor.execute(*node.select(
+                node.left, node.right, node.id,
+                where=(node.parent == Null),
+                order_by=node.left.asc
+            ))
+            state = _states[cursor] = {
+                'revisions': revisions,
+                'catalog': catalog,
+                'roots': cursor.fetchall(),
+                'dirty': False,
+                'rebuilding': Job.is_pending(Node.__name__, 'rebuild_tree'),
+            }
+        return state
+
+    @classmethod
+    def get_revision(cls, scope):
+        "Return the current revision of the scope"
+        state = cls.get_state()
+        if scope == CATALOG_SCOPE:
+            return state['catalog']
+        return state['revisions'].get(scope, 0)
+
+    @classmethod
+    def get_root_scope(cls, node):
+        """
+        Return the revision scope of the tree to which the node belongs,
+        found from the nested set of the node, or from the parent links
+        while a rebuild of the nested set is pending
+        """
+        Node = Pool().get('product.tree_node')
+
+        state = cls.get_state()
+        if state['rebuilding']:
+            return node_scope(Node._get_ancestor_ids([node.id])[node.id][0])
+        roots = state['roots']
+        index = bisect_right(roots, (node.left, float('inf'), 0)) - 1
+        if index >= 0:
+            left, right, root_id = roots[index]
+            if left <= node.left and node.right <= right:
+                return node_scope(root_id)
+        return node_scope(node.id)
+
+    @classmethod
+    def bump(cls, scopes):
+        """
+        Increment the revision of the given scopes in the current
+        transaction. The revision of `CATALOG_SCOPE` follows the revisions
+        of the trees and is never bumped.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        scopes = sorted(set(scopes) - set([CATALOG_SCOPE]))
+        if not scopes:
+            return
+
+        # Only the scopes of the trees created by the transaction are
+        # missing, the others are created with their tree or website
+        cls.create_scopes(scopes)
+        for i in range(0, len(scopes), cursor.IN_MAX):
+            sub_scopes = scopes[i:i + cursor.IN_MAX]
+            cursor.execute(*table.update(
+                columns=[table.revision],
+                values=[table.revision + 1],
+                where=table.scope.in_(sub_scopes)
+            ))
+
+        # The roots are read again as the nested set may have changed,
+        # and nothing computed in this transaction is cached any more as
+        # it would be keyed by a revision which may be rolled back
+        _states.pop(cursor, None)
+        cls.get_state()['dirty'] = True
+
+
+class TreeCache(object):
+    """
+    A cache of tree data whose entries are scoped to a tree or a website
+    and dropped when the revision of the scope changes. The cache is not
+    used while a rebuild of the nested set is pending.
+    """
+
+    def __init__(self, name, size_limit=1024, context=True):
+        self._cache = Cache(name, size_limit=size_limit, context=context)
+
+    def get(self, scope, key, default=None):
+        Revision = Pool().get('product.tree_node.revision')
+
+        if Revision.get_state()['rebuilding']:
+            return default
+        revision = Revision.get_revision(scope)
+        return self._cache.get((scope, revision, key), default)
+
+    def set(self, scope, key, value):
+        Revision = Pool().get('product.tree_node.revision')
+
+        state = Revision.get_state()
+        if state['dirty'] or state['rebuilding']:
+            return
+        revision = Revision.get_revision(scope)
+        self._cache.set((scope, revision, key), value)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Nodes listing the products matched by a rule
+
+    The products of a node with a rule are not picked by hand: they are
+    the products created in the last `rule_days` days, or the products
+    matching the `rule_domain`, a PYSON domain on the product variants
+    like ``[["template.name", "ilike", "%holiday%"]]``. The domain can use
+    the fields added by the other modules installed, like an availability
+    date or attributes, and `Date()` to compare with the current date.
+
+    The products matched are stored as the relationships of the node, so
+    the listing is the usual indexed read. When products are created or
+    changed, a tree job matches the changed products only against the
+    rules and adds or removes their relationships. As the dates move on,
+    a daily cron matches all the products again.
+
+    The relationships of a node with a rule are managed by the rule:
+    products added by hand which do not match it are removed.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+from datetime import datetime, timedelta
+
+from sql import Null
+
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval, PYSONDecoder
+from trytond.transaction import Transaction
+
+from aggregate import written_fields
+
+
+__all__ = ['Node', 'Product', 'Template']
+__metaclass__ = PoolMeta
+
+# The fields of the nodes defining their rule
+RULE_FIELDS = set(['rule', 'rule_days', 'rule_domain'])
+
+
+def queue_rule_update(product_ids):
+    """
+    Queue the matching of the given products against the rules of the
+    nodes, if any node has a rule
+    """
+    pool = Pool()
+    Node = pool.get('product.tree_node')
+    Job = pool.get('product.tree_node.job')
+    cursor = Transaction().cursor
+    table = Node.__table__()
+
+    if not product_ids:
+        return
+    cursor.execute(*table.select(
+        table.id, where=(table.rule != Null), limit=1
+    ))
+    if cursor.fetchone():
+        Job.enqueue(
+            Node.__name__, 'update_rule_products', map(str, set(product_ids))
+        )
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    rule = fields.Selection([
+        (None, 'Manual'),
+        ('created', 'Created Recently'),
+        ('domain', 'Domain'),
+    ], 'Rule', select=True, help='Pick the products of the node with a rule')
+    rule_days = fields.Integer(
+        'Days', depends=['rule'], states={
+            'invisible': Eval('rule') != 'created',
+            'required': Eval('rule') == 'created',
+        },
+        help='List the products created in this number of days'
+    )
+    rule_domain = fields.Char(
+        'Product Domain', depends=['rule'], states={
+            'invisible': Eval('rule') != 'domain',
+            'required': Eval('rule') == 'domain',
+        },
+        help='List the products matching this PYSON domain'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(Node, cls).__setup__()
+        cls._error_messages.update({
+            'invalid_rule_domain': (
+                'The product domain of the node "%s" is not a valid domain.'
+            ),
+        })
+
+    @classmethod
+    def validate(cls, nodes):
+        super(Node, cls).validate(nodes)
+        for node in nodes:
+            if node.rule != 'domain':
+                continue
+            try:
+                domain = PYSONDecoder().decode(node.rule_domain)
+            except Exception:
+                domain = None
+            if not isinstance(domain, list):
+                cls.raise_user_error('invalid_rule_domain', (node.rec_name,))
+
+    @classmethod
+    def create(cls, vlist):
+        nodes = super(Node, cls).create(vlist)
+        cls.queue_rule_refresh([n for n in nodes if n.rule])
+        return nodes
+
+    @classmethod
+    def write(cls, nodes, values, *args):
+        super(Node, cls).write(nodes, values, *args)
+        if written_fields(values, args) & RULE_FIELDS:
+            cls.queue_rule_refresh([
+                n for n in cls.browse([
+                    n.id for n in nodes + sum(args[::2], [])
+                ]) if n.rule
+            ])
+
+    @classmethod
+    def queue_rule_refresh(cls, nodes):
+        """
+        Queue the matching of all the products against the rules of the
+        given nodes
+        """
+        Job = Pool().get('product.tree_node.job')
+
+        if nodes:
+            Job.enqueue(
+                cls.__name__, 'refresh_rule_nodes',
+                [str(n.id) for n in nodes]
+            )
+
+    def get_rule_domain(self):
+        """
+        Return the domain on the product variants of the products matched
+        by the rule of the node. This is separated for easy subclassing.
+        """
+        domain = [
+            ('active', '=', True),
+            ('displayed_on_eshop', '=', True),
+            ('template.active', '=', True),
+        ]
+        if self.rule == 'created':
+            domain.append((
+                'create_date', '>=',
+                datetime.now() - timedelta(days=self.rule_days or 0)
+            ))
+        elif self.rule == 'domain':
+            domain.append(PYSONDecoder().decode(self.rule_domain))
+        return domain
+
+    @classmethod
+    def update_rule_members(cls, nodes, product_ids=None):
+        """
+        Add the relationships of the products matched by the rules of the
+        nodes and remove the relationships of the products which no longer
+        match. Returns the number of relationships added and removed.
+
+        :param nodes: The list of active records of the nodes with a rule
+        :param product_ids: The ids of the products to match, all the
+                            products by default
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Relationship = pool.get('product.product-product.tree_node')
+
+        to_create, to_delete = [], []
+        with Transaction().set_context(active_test=False):
+            for node in nodes:
+                domain = node.get_rule_domain()
+                relationship_domain = [('node', '=', node.id)]
+                if product_ids is not None:
+                    domain.append(('id', 'in', product_ids))
+                    relationship_domain.append(('product', 'in', product_ids))
+
+                matched = set(p.id for p in Product.search(domain))
+                listed = set()
+                for relationship in Relationship.search(relationship_domain):
+                    if relationship.product.id in matched:
+                        listed.add(relationship.product.id)
+                    else:
+                        to_delete.append(relationship)
+                to_create.extend(
+                    {'node': node.id, 'product': product_id}
+                    for product_id in matched - listed
+                )
+
+        if to_delete:
+            Relationship.delete(to_delete)
+        if to_create:
+            Relationship.create(to_create)
+        return len(to_create) + len(to_delete)
+
+    @classmethod
+    def update_rule_products(cls, keys):
+        """
+        Match the given products against the rules of all the nodes. This is
+        the handler of the tree jobs queued by the changes of the products.
+
+        :param keys: The ids of the products, as strings
+        """
+        with Transaction().set_context(active_test=False):
+            nodes = cls.search([('rule', '!=', None)])
+        cls.update_rule_members(nodes, map(int, keys))
+
+    @classmethod
+    def refresh_rule_nodes(cls, keys):
+        """
+        Match all the products against the rules of the given nodes. This is
+        the handler of the tree jobs queued by the changes of the rules.
+
+        :param keys: The ids of the nodes, as strings
+        """
+        with Transaction().set_context(active_test=False):
+            nodes = cls.search([
+                ('id', 'in', map(int, keys)),
+                ('rule', '!=', None),
+            ])
+        cls.update_rule_members(nodes)
+
+    @classmethod
+    def refresh_all_rule_nodes(cls):
+        """
+        Match all the products against the rules of all the nodes, as the
+        rules depending on the date change with time. This is called by
+        cron.
+        """
+        with Transaction().set_context(active_test=False):
+            nodes = cls.search([('rule', '!=', None)])
+        cls.update_rule_members(nodes)
+
+
+class Product:
+    __name__ = 'product.product'
+
+    @classmethod
+    def create(cls, vlist):
+        products = super(Product, cls).create(vlist)
+        queue_rule_update([p.id for p in products])
+        return products
+
+    @classmethod
+    def write(cls, products, values, *args):
+        super(Product, cls).write(products, values, *args)
+        queue_rule_update([p.id for p in products + sum(args[::2], [])])
+
+
+class Template:
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, templates, values, *args):
+        super(Template, cls).write(templates, values, *args)
+        queue_rule_update([
+            p.id for t in templates + sum(args[::2], []) for p in t.products
+        ])
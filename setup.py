@@ -73,6 +73,133 @@ class PostgresTest(Command):
         sys.exit(-1)
 
 
+class Benchmark(Command):
+    """
+    Benchmark the tree operations on a synthetic catalog
+    """
+    description = "Benchmark tree operations on a synthetic catalog"
+
+    user_options = [
+        ('backend=', None, 'sqlite (default) or postgresql'),
+        ('nodes=', None, 'Number of tree nodes'),
+        ('depth=', None, 'Depth of the tree'),
+        ('products=', None, 'Number of products'),
+        ('relationships=', None, 'Number of product-node relationships'),
+        ('repeat=', None, 'Number of runs of each measure'),
+        ('output=', None, 'File to write the JSON results to'),
+        ('compare=', None, 'JSON results of a previous run to compare to'),
+    ]
+
+    def initialize_options(self):
+        self.backend = 'sqlite'
+        self.nodes = 1000
+        self.depth = 4
+        self.products = 1000
+        self.relationships = 10000
+        self.repeat = 5
+        self.output = 'benchmark.json'
+        self.compare = None
+
+    def finalize_options(self):
+        for option in ('nodes', 'depth', 'products', 'relationships',
+                       'repeat'):
+            setattr(self, option, int(getattr(self, option)))
+
+    def run(self):
+        from trytond.config import CONFIG
+        CONFIG['db_type'] = self.backend
+        if self.backend == 'postgresql':
+            CONFIG['db_host'] = 'localhost'
+            CONFIG['db_port'] = 5432
+            CONFIG['db_user'] = 'postgres'
+            CONFIG['db_password'] = 'test'
+            os.environ['DB_NAME'] = 'benchmark_' + str(int(time.time()))
+        else:
+            os.environ['DB_NAME'] = ':memory:'
+
+        from tests import benchmark
+        benchmark.OPTIONS.update({
+            'nodes': self.nodes,
+            'depth': self.depth,
+            'products': self.products,
+            'relationships': self.relationships,
+            'repeat': self.repeat,
+            'output': self.output,
+        })
+        test_result = unittest.TextTestRunner(verbosity=2).run(
+            unittest.TestLoader().loadTestsFromTestCase(
+                benchmark.CatalogBenchmark
+            )
+        )
+        if not test_result.wasSuccessful():
+            sys.exit(-1)
+        if self.compare:
+            benchmark.compare(self.compare, self.output)
+        sys.exit(0)
+
+
+class LoadTest(Command):
+    """
+    Load test the catalog routes on a synthetic catalog
+    """
+    description = "Load test the catalog routes on a synthetic catalog"
+
+    user_options = [
+        ('backend=', None, 'sqlite (default) or postgresql'),
+        ('nodes=', None, 'Number of tree nodes'),
+        ('depth=', None, 'Depth of the tree'),
+        ('products=', None, 'Number of products'),
+        ('relationships=', None, 'Number of product-node relationships'),
+        ('processes=', None, 'Number of worker processes'),
+        ('requests=', None, 'Number of requests to replay'),
+        ('output=', None, 'File to write the JSON report to'),
+    ]
+
+    def initialize_options(self):
+        self.backend = 'sqlite'
+        self.nodes = 1000
+        self.depth = 4
+        self.products = 1000
+        self.relationships = 10000
+        self.processes = 4
+        self.requests = 2000
+        self.output = 'loadtest.json'
+
+    def finalize_options(self):
+        for option in ('nodes', 'depth', 'products', 'relationships',
+                       'processes', 'requests'):
+            setattr(self, option, int(getattr(self, option)))
+
+    def run(self):
+        import tempfile
+        from trytond.config import CONFIG
+        CONFIG['db_type'] = self.backend
+        if self.backend == 'postgresql':
+            CONFIG['db_host'] = 'localhost'
+            CONFIG['db_port'] = 5432
+            CONFIG['db_user'] = 'postgres'
+            CONFIG['db_password'] = 'test'
+        else:
+            # The worker processes need a database on disk to share
+            CONFIG['data_path'] = tempfile.mkdtemp()
+        os.environ['DB_NAME'] = 'loadtest_' + str(int(time.time()))
+
+        from tests import loadtest
+        loadtest.OPTIONS.update({
+            'nodes': self.nodes,
+            'depth': self.depth,
+            'products': self.products,
+            'relationships': self.relationships,
+            'processes': self.processes,
+            'requests': self.requests,
+            'output': self.output,
+        })
+        report = loadtest.run()
+        if report['errors']:
+            sys.exit(-1)
+        sys.exit(0)
+
+
 config = ConfigParser.ConfigParser()
 config.readfp(open('tryton.cfg'))
 info = dict(config.items('tryton'))
@@ -142,5 +269,7 @@ setup(
     cmdclass={
         'test': SQLiteTest,
         'test_on_postgres': PostgresTest,
+        'benchmark': Benchmark,
+        'loadtest': LoadTest,
     },
 )
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Traffic statistics of the tree nodes
+
+    The statistics are enabled with the `CATALOG_TREE_HIT_COUNTERS` setting
+    of the nereid application.
+
+    Each rendering of a node page is counted in memory, by node, page and
+    language, along with the time of its queries. The counters of the
+    process are added to the statistics table by a background thread every
+    `HIT_FLUSH_INTERVAL` seconds, in a few batched queries, so requests
+    never write to the database.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import time
+import logging
+import threading
+from collections import defaultdict
+
+from flask import after_this_request, current_app
+from nereid import route
+from sql import Literal
+from sql.aggregate import Max, Sum
+from sql.conditionals import Case
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from instrumentation import Probe
+
+
+__all__ = ['NodeHit', 'NodeTraffic', 'Node']
+__metaclass__ = PoolMeta
+
+logger = logging.getLogger('nereid_catalog_tree.stats')
+
+# The number of seconds between two flushes of the counters of a process
+HIT_FLUSH_INTERVAL = 60
+
+# The number of most visited nodes warmed up first at startup
+WARMUP_HOT_NODES = 50
+
+
+class HitCounter(object):
+    """
+    The hits of the node pages counted in the process and not yet added to
+    the statistics table, by database
+    """
+
+    def __init__(self, interval=HIT_FLUSH_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+        self.thread = None
+
+    def add(self, database_name, key, query_time, hits=1):
+        """
+        Count hits of a page
+
+        :param database_name: The database of the node
+        :param key: A tuple of the node id, page and language
+        :param query_time: The time of the queries of the hits in seconds
+        """
+        with self.lock:
+            count = self.counts[database_name][key]
+            count[0] += hits
+            count[1] += query_time
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name='catalog-tree-hits'
+                )
+                self.thread.daemon = True
+                self.thread.start()
+
+    def pop(self, database_name):
+        """
+        Return the counts of the database and reset them
+        """
+        with self.lock:
+            return dict(self.counts.pop(database_name, {}))
+
+    def flush(self, database_name):
+        """
+        Add the counts of the database to the statistics table. The counts
+        are kept for the next flush if they cannot be written.
+        """
+        counts = self.pop(database_name)
+        if not counts:
+            return
+        with Transaction().start(database_name, 0) as transaction:
+            try:
+                Pool().get('product.tree_node.hit').add_hits(counts)
+                transaction.cursor.commit()
+            except Exception:
+                transaction.cursor.rollback()
+                logger.exception('Could not write the hits of the nodes')
+                for key, (hits, query_time) in counts.iteritems():
+                    self.add(database_name, key, query_time, hits)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                database_names = self.counts.keys()
+            for database_name in database_names:
+                self.flush(database_name)
+
+
+counter = HitCounter()
+
+
+class NodeHit(ModelSQL, ModelView):
+    "Tree Node Hits"
+    __name__ = 'product.tree_node.hit'
+
+    node = fields.Many2One(
+        'product.tree_node', 'Node', required=True, select=True,
+        readonly=True, ondelete='CASCADE'
+    )
+    page = fields.Integer('Page', required=True, readonly=True)
+    language = fields.Char('Language', readonly=True)
+    hits = fields.Integer('Hits', required=True, readonly=True)
+    query_time = fields.Float(
+        'Query Time', required=True, readonly=True,
+        help='Total time of the queries of the requests, in seconds'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(NodeHit, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'hit_uniq', 'UNIQUE(node, page, language)',
+                'The hits of a page are counted once per language.'
+            ),
+        ]
+        cls._order.insert(0, ('hits', 'DESC'))
+
+    @classmethod
+    def add_hits(cls, counts):
+        """
+        Add hits to the statistics: the existing rows are updated in one
+        query and the missing rows are inserted in another, per batch.
+
+        :param counts: A dictionary mapping (node id, page, language) to
+                       the number of hits and their query time
+        """
+        Node = Pool().get('product.tree_node')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        node_table = Node.__table__()
+
+        keys = counts.keys()
+        node_ids = list(set(key[0] for key in keys))
+        existing_nodes = set()
+        rows = {}
+        for i in xrange(0, len(node_ids), cursor.IN_MAX):
+            sub_ids = node_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*node_table.select(
+                node_table.id, where=node_table.id.in_(sub_ids)
+            ))
+            existing_nodes.update(row[0] for row in cursor.fetchall())
+            cursor.execute(*table.select(
+                table.id, table.node, table.page, table.language,
+                where=table.node.in_(sub_ids)
+            ))
+            for id_, node, page, language in cursor.fetchall():
+                rows[(node, page, language)] = id_
+
+        updated = [key for key in keys if key in rows]
+        for i in xrange(0, len(updated), cursor.IN_MAX):
+            sub_keys = updated[i:i + cursor.IN_MAX]
+            cursor.execute(*table.update(
+                columns=[table.hits, table.query_time],
+                values=[
+                    table.hits + Case(*[
+                        (table.id == rows[key], counts[key][0])
+                        for key in sub_keys
+                    ]),
+                    table.query_time + Case(*[
+                        (table.id == rows[key], counts[key][1])
+                        for key in sub_keys
+                    ]),
+                ],
+                where=table.id.in_([rows[key] for key in sub_keys])
+            ))
+
+        # Hits of the nodes deleted since they were counted are dropped
+        cls.create([{
+            'node': key[0],
+            'page': key[1],
+            'language': key[2],
+            'hits': counts[key][0],
+            'query_time': counts[key][1],
+        } for key in keys if key not in rows and key[0] in existing_nodes])
+
+    @classmethod
+    def get_hot_node_ids(cls, roots=None, limit=WARMUP_HOT_NODES):
+        """
+        Return the ids of the most visited nodes, the most visited first
+
+        :param roots: Active records of the roots of the trees in which the
+                      nodes are searched, all the trees by default
+        """
+        Node = Pool().get('product.tree_node')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        node = Node.__table__()
+
+        where = Literal(True)
+        if roots is not None:
+            where = Literal(False)
+            for root in roots:
+                where |= root._get_subtree_condition(node)
+        cursor.execute(*table.join(
+            node, condition=(table.node == node.id)
+        ).select(
+            table.node,
+            where=where,
+            group_by=[table.node],
+            order_by=[Sum(table.hits).desc],
+            limit=limit
+        ))
+        return [row[0] for row in cursor.fetchall()]
+
+
+class NodeTraffic(ModelSQL, ModelView):
+    "Tree Node Traffic"
+    __name__ = 'product.tree_node.traffic'
+
+    node = fields.Many2One('product.tree_node', 'Node', readonly=True)
+    hits = fields.Integer('Hits', readonly=True)
+    query_time = fields.Float(
+        'Average Query Time', readonly=True,
+        help='Average time of the queries of a request, in seconds'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(NodeTraffic, cls).__setup__()
+        cls._order.insert(0, ('hits', 'DESC'))
+
+    @staticmethod
+    def table_query():
+        NodeHit = Pool().get('product.tree_node.hit')
+        table = NodeHit.__table__()
+
+        return table.select(
+            table.node.as_('id'),
+            Max(table.create_uid).as_('create_uid'),
+            Max(table.create_date).as_('create_date'),
+            Max(table.write_uid).as_('write_uid'),
+            Max(table.write_date).as_('write_date'),
+            table.node,
+            Sum(table.hits).as_('hits'),
+            (Sum(table.query_time) / Sum(table.hits)).as_('query_time'),
+            group_by=[table.node]
+        )
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    @route('/nodes/<int:active_id>/<slug>/<int:page>')
+    @route('/nodes/<int:active_id>/<slug>')
+    def render(self, slug=None, page=1):
+        """
+        Count the hit of the page of the node. The queries of the request
+        are timed until the response is rendered, on the replica too when
+        the page is read from it.
+        """
+        if not current_app.config.get('CATALOG_TREE_HIT_COUNTERS'):
+            return super(Node, self).render(slug, page)
+
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+        key = (self.id, page, transaction.language)
+        probe = Probe('hits')
+        probe.start()
+        try:
+            rv = super(Node, self).render(slug, page)
+        except Exception:
+            probe.stop()
+            raise
+
+        @after_this_request
+        def count_hit(response):
+            probe.stop()
+            if response.status_code == 200:
+                counter.add(database_name, key, probe.query_time)
+            return response
+        return rv
+
+    @classmethod
+    def _get_warmup_nodes(cls, website):
+        """
+        Warm up the most visited nodes of the trees of the website first
+        """
+        pool = Pool()
+        NodeHit = pool.get('product.tree_node.hit')
+        WebsiteTreeNode = pool.get('nereid.website-product.tree_node')
+
+        roots = [
+            record.node for record in WebsiteTreeNode.search([
+                ('website', '=', website.id),
+            ])
+        ]
+        return cls.browse(NodeHit.get_hot_node_ids(roots)) + super(
+            Node, cls
+        )._get_warmup_nodes(website)
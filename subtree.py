@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Set based operations on whole subtrees
+
+    Copying a subtree through `copy` creates the nodes one by one, each
+    insert renumbering the nested set, and then their relationships one by
+    one. Deleting one has to go bottom up, as the parent of a node cannot be
+    deleted before it. The operations of this module work on the
+    `left`..`right` range of the subtree instead, with a handful of queries
+    whatever its size.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+from sql import Column, Literal, Null
+from sql.aggregate import Max
+from sql.conditionals import Case
+from sql.functions import Now
+
+from trytond.model import ModelSQL
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from revision import website_scope
+
+
+__all__ = ['Node']
+__metaclass__ = PoolMeta
+
+# The columns filled by the insert queries themselves
+AUDIT_COLUMNS = ('id', 'create_uid', 'create_date', 'write_uid', 'write_date')
+
+
+def get_copy_columns(Model):
+    """
+    Return the names of the stored columns of the model copied by the
+    insert queries
+    """
+    return [
+        name for name, field in Model._fields.iteritems()
+        if name not in AUDIT_COLUMNS and not hasattr(field, 'set')
+    ]
+
+
+def get_translation_names(Model):
+    """
+    Return the names of the translations of the translated fields of the
+    model
+    """
+    return [
+        '%s,%s' % (Model.__name__, name)
+        for name, field in Model._fields.iteritems()
+        if getattr(field, 'translate', False)
+    ]
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    @classmethod
+    def __setup__(cls):
+        super(Node, cls).__setup__()
+        cls._error_messages.update({
+            'clone_into_itself': (
+                'The node "%s" cannot be copied into its own branches.'
+            ),
+            'delete_subtree_restricted': (
+                'The branches of the node "%s" cannot be deleted as they '
+                'are used by "%s".'
+            ),
+        })
+
+    @classmethod
+    def _get_nested_set(cls, node_id):
+        """
+        Return the current left and right of the node, read from the
+        database rather than from a record which may be stale
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.select(
+            table.left, table.right, where=(table.id == node_id)
+        ))
+        return cursor.fetchone()
+
+    @classmethod
+    def _open_gap(cls, position, size):
+        """
+        Shift the nested set to free `size` numbers from `position`
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.update(
+            columns=[table.left], values=[table.left + size],
+            where=(table.left >= position)
+        ))
+        cursor.execute(*table.update(
+            columns=[table.right], values=[table.right + size],
+            where=(table.right >= position)
+        ))
+
+    @classmethod
+    def clone_subtree(cls, node, parent=None, name=None):
+        """
+        Copy the node and all of its branches, with their translations and
+        their products, as the last child of the parent or as a new tree.
+        Returns the copy of the node.
+
+        The nodes are copied with a single INSERT ... SELECT, numbered in
+        the nested set by shifting the numbers of the subtree, and the
+        links to their parents are fixed from the numbers of the copies.
+        The translations and the relationships are copied with one
+        INSERT ... SELECT each.
+
+        :param node: Active record of the node to copy
+        :param parent: Active record of the parent of the copy
+        :param name: The name of the copy, the name of the node by default
+        """
+        pool = Pool()
+        Job = pool.get('product.tree_node.job')
+        Revision = pool.get('product.tree_node.revision')
+        Relationship = pool.get('product.product-product.tree_node')
+        Translation = pool.get('ir.translation')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+
+        if Job.is_pending(cls.__name__, 'rebuild_tree'):
+            cls.rebuild_tree(['parent'])
+
+        left, right = cls._get_nested_set(node.id)
+        size = right - left + 1
+        if parent is not None:
+            parent_left, parent_right = cls._get_nested_set(parent.id)
+            if left <= parent_left and parent_right <= right:
+                cls.raise_user_error('clone_into_itself', (node.rec_name,))
+            cls._open_gap(parent_right, size)
+            # The subtree moves along if it is after the parent
+            left, right = cls._get_nested_set(node.id)
+            position = parent_right
+        else:
+            cursor.execute(*table.select(Max(table.right)))
+            position = cursor.fetchone()[0] + 1
+        delta = position - left
+        in_subtree = (table.left >= left) & (table.right <= right)
+
+        cursor.execute(*table.select(
+            table.id, table.left, table.parent, where=in_subtree
+        ))
+        old_nodes = cursor.fetchall()
+
+        names = get_copy_columns(cls)
+        values = {
+            'left': table.left + delta,
+            'right': table.right + delta,
+            'parent': Case(
+                (table.id == node.id,
+                    Literal(parent.id) if parent is not None else Null),
+                else_=table.parent
+            ),
+        }
+        if name is not None:
+            values['name'] = Case(
+                (table.id == node.id, Literal(name)), else_=table.name
+            )
+        cursor.execute(*table.insert(
+            columns=[Column(table, n) for n in names] + [
+                table.create_uid, table.create_date
+            ],
+            values=table.select(*(
+                [values.get(n, Column(table, n)) for n in names] +
+                [Literal(transaction.user), Now()]
+            ), where=in_subtree)
+        ))
+
+        cursor.execute(*table.select(
+            table.left, table.id, where=(
+                (table.left >= position) & (table.right <= right + delta)
+            )
+        ))
+        new_ids = dict(cursor.fetchall())
+        copies = dict(
+            (old_id, new_ids[old_left + delta])
+            for old_id, old_left, _ in old_nodes
+        )
+
+        changes = [
+            (copies[old_id], copies[old_parent])
+            for old_id, _, old_parent in old_nodes if old_id != node.id
+        ]
+        for i in range(0, len(changes), cursor.IN_MAX):
+            sub_changes = changes[i:i + cursor.IN_MAX]
+            cursor.execute(*table.update(
+                columns=[table.parent],
+                values=[Case(*[
+                    (table.id == id_, parent_id)
+                    for id_, parent_id in sub_changes
+                ])],
+                where=table.id.in_([id_ for id_, _ in sub_changes])
+            ))
+
+        # The copies are found from the old nodes by their numbers
+        old = cls.__table__()
+        new = cls.__table__()
+        old_in_subtree = (old.left >= left) & (old.right <= right)
+
+        relation = Relationship.__table__()
+        names = get_copy_columns(Relationship)
+        cursor.execute(*relation.insert(
+            columns=[Column(relation, n) for n in names] + [
+                relation.create_uid, relation.create_date
+            ],
+            values=relation.join(
+                old, condition=(relation.node == old.id)
+            ).join(
+                new, condition=(new.left == old.left + delta)
+            ).select(*(
+                [
+                    new.id if n == 'node' else Column(relation, n)
+                    for n in names
+                ] + [Literal(transaction.user), Now()]
+            ), where=old_in_subtree)
+        ))
+
+        translation = Translation.__table__()
+        names = get_copy_columns(Translation)
+        where = (
+            old_in_subtree & (translation.type == 'model') &
+            translation.name.in_(get_translation_names(cls))
+        )
+        if name is not None:
+            # The copy has a new name in every language
+            where &= ~(
+                (translation.res_id == node.id) &
+                (translation.name == '%s,name' % cls.__name__)
+            )
+        cursor.execute(*translation.insert(
+            columns=[Column(translation, n) for n in names] + [
+                translation.create_uid, translation.create_date
+            ],
+            values=translation.join(
+                old, condition=(translation.res_id == old.id)
+            ).join(
+                new, condition=(new.left == old.left + delta)
+            ).select(*(
+                [
+                    new.id if n == 'res_id' else Column(translation, n)
+                    for n in names
+                ] + [Literal(transaction.user), Now()]
+            ), where=where)
+        ))
+
+        if parent is not None:
+            cls.update_child_count([parent.id])
+
+        clone = cls(copies[node.id])
+        Revision.bump(cls.get_tree_scopes([clone.id]))
+        return clone
+
+    @classmethod
+    def _get_subtree_ranges(cls, nodes):
+        """
+        Return the sorted list of (left, right, id) of the subtrees of the
+        nodes, leaving out the nodes in the branches of another one
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        ids = [n.id for n in nodes]
+        rows = []
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.left, table.right, table.id,
+                where=table.id.in_(sub_ids)
+            ))
+            rows.extend(cursor.fetchall())
+
+        ranges = []
+        for left, right, id_ in sorted(rows):
+            if not ranges or left > ranges[-1][1]:
+                ranges.append((left, right, id_))
+        return ranges
+
+    @classmethod
+    def _get_references(cls):
+        """
+        Return the list of (model, field name, ondelete) of the stored
+        fields linking to the nodes, other than the parent of the nodes
+        """
+        result = []
+        for _, Model in Pool().iterobject():
+            if not issubclass(Model, ModelSQL) or Model.table_query():
+                continue
+            for name, field in Model._fields.iteritems():
+                if (field._type != 'many2one'
+                        or field.model_name != cls.__name__
+                        or (Model.__name__, name) == (cls.__name__, 'parent')):
+                    continue
+                result.append((Model, name, field.ondelete))
+        return result
+
+    @classmethod
+    def delete_subtree(cls, nodes):
+        """
+        Delete the nodes and all of their branches, with the records linked
+        to them, and close the gap in the nested set once per subtree.
+
+        The links to the parents are cleared first so that the nodes can
+        be deleted all at once despite the restricted deletion of their
+        parent. The records linking to the nodes are handled as their
+        `ondelete` says with one query per model, without the checks and
+        the side effects of their own `delete`.
+
+        :param nodes: The list of active records of the nodes to delete
+        """
+        pool = Pool()
+        Job = pool.get('product.tree_node.job')
+        Revision = pool.get('product.tree_node.revision')
+        Translation = pool.get('ir.translation')
+        WebsiteTreeNode = pool.get('nereid.website-product.tree_node')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        if Job.is_pending(cls.__name__, 'rebuild_tree'):
+            cls.rebuild_tree(['parent'])
+
+        ranges = cls._get_subtree_ranges(nodes)
+        if not ranges:
+            return
+        scopes = cls.get_tree_scopes([id_ for _, _, id_ in ranges])
+        parent_ids = [
+            n.parent.id for n in cls.browse([id_ for _, _, id_ in ranges])
+            if n.parent
+        ]
+
+        references = cls._get_references()
+        website_link = WebsiteTreeNode.__table__()
+        translation = Translation.__table__()
+        # Closing a gap shifts the subtrees on the right, so they are
+        # deleted from the right
+        for left, right, id_ in reversed(ranges):
+            in_subtree = (table.left >= left) & (table.right <= right)
+            node_ids = table.select(table.id, where=in_subtree)
+
+            for Model, name, ondelete in references:
+                if ondelete != 'RESTRICT':
+                    continue
+                linked = Model.__table__()
+                cursor.execute(*linked.select(
+                    linked.id,
+                    where=Column(linked, name).in_(node_ids), limit=1
+                ))
+                if cursor.fetchone():
+                    cls.raise_user_error('delete_subtree_restricted', (
+                        cls(id_).rec_name, Model.__name__
+                    ))
+
+            cursor.execute(*website_link.select(
+                website_link.website,
+                where=website_link.node.in_(node_ids), distinct=True
+            ))
+            scopes.update(website_scope(row[0]) for row in cursor.fetchall())
+
+            for Model, name, ondelete in references:
+                linked = Model.__table__()
+                column = Column(linked, name)
+                if ondelete == 'CASCADE':
+                    cursor.execute(*linked.delete(
+                        where=column.in_(node_ids)
+                    ))
+                elif ondelete == 'SET NULL':
+                    cursor.execute(*linked.update(
+                        columns=[column], values=[Null],
+                        where=column.in_(node_ids)
+                    ))
+            cursor.execute(*translation.delete(
+                where=translation.name.in_(get_translation_names(cls)) &
+                (translation.type == 'model') &
+                translation.res_id.in_(node_ids)
+            ))
+
+            cursor.execute(*table.update(
+                columns=[table.parent], values=[Null], where=in_subtree
+            ))
+            cursor.execute(*table.delete(where=in_subtree))
+
+            size = right - left + 1
+            cursor.execute(*table.update(
+                columns=[table.left], values=[table.left - size],
+                where=(table.left > right)
+            ))
+            cursor.execute(*table.update(
+                columns=[table.right], values=[table.right - size],
+                where=(table.right > right)
+            ))
+
+        cls.update_child_count(parent_ids)
+        Revision.bump(scopes)
+
+    @classmethod
+    def archive_subtree(cls, nodes, active=False):
+        """
+        Deactivate the nodes and all of their branches with a single
+        UPDATE per subtree
+
+        :param nodes: The list of active records of the nodes
+        :param active: True to activate the subtrees again instead
+        """
+        pool = Pool()
+        Job = pool.get('product.tree_node.job')
+        Revision = pool.get('product.tree_node.revision')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        if Job.is_pending(cls.__name__, 'rebuild_tree'):
+            cls.rebuild_tree(['parent'])
+
+        ranges = cls._get_subtree_ranges(nodes)
+        for left, right, _ in ranges:
+            cursor.execute(*table.update(
+                columns=[table.active], values=[active],
+                where=(table.left >= left) & (table.right <= right)
+            ))
+        if ranges:
+            Revision.bump(
+                cls.get_tree_scopes([id_ for _, _, id_ in ranges])
+            )
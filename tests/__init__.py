@@ -11,6 +11,7 @@ import trytond.tests.test_tryton
 
 from .test_tree import TestTree
 from .test_view_depends import TestViewsDepends
+from .test_query_plan import TestQueryPlan
 
 
 def suite():
@@ -21,6 +22,7 @@ def suite():
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestViewsDepends),
         unittest.TestLoader().loadTestsFromTestCase(TestTree),
+        unittest.TestLoader().loadTestsFromTestCase(TestQueryPlan),
     ])
 
     return test_suite
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark
+
+    Benchmarks of the tree operations on a synthetic catalog.
+
+    The benchmark is not part of the test suite. It is run with::
+
+        python setup.py benchmark --nodes=100000 --relationships=1000000
+
+    and writes the timings as JSON, which can be compared with the results
+    of another commit using the `--compare` option.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import subprocess
+from decimal import Decimal
+from itertools import cycle
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+from nereid.testing import NereidTestCase
+from sql.conditionals import Case
+from sql.functions import Now
+
+# Options of the benchmark, set by the setup command
+OPTIONS = {
+    'nodes': 1000,
+    'depth': 4,
+    'products': 1000,
+    'relationships': 10000,
+    'repeat': 5,
+    'output': 'benchmark.json',
+}
+
+
+def generate_tree(nodes, depth):
+    """
+    Return a list of (parent index, left, right) of a tree with the given
+    number of nodes, as wide as needed to reach the given depth. The nodes
+    are listed in depth first order with the root first.
+    """
+    fanout = max(2, int(math.ceil(nodes ** (1.0 / max(depth, 1)))))
+    children = {}
+    parents = [None]
+    # Breadth first so that the tree is balanced
+    for index in xrange(1, nodes):
+        parent = (index - 1) // fanout
+        parents.append(parent)
+        children.setdefault(parent, []).append(index)
+
+    result = [None] * nodes
+    counter = [0]
+
+    def walk(index):
+        left = counter[0]
+        counter[0] += 1
+        for child in children.get(index, []):
+            walk(child)
+        result[index] = (parents[index], left, counter[0])
+        counter[0] += 1
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), depth * 10 + 1000))
+    walk(0)
+    return result
+
+
+class QueryCounter(object):
+    """
+    Count the queries executed on the cursor of the current transaction
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        self.cursor = Transaction().cursor
+        execute = self.cursor.execute
+
+        def counting_execute(*args, **kwargs):
+            self.count += 1
+            return execute(*args, **kwargs)
+        self.cursor.execute = counting_execute
+        return self
+
+    def __exit__(self, *args):
+        del self.cursor.execute
+
+
+class CatalogGenerator(object):
+    """
+    Generates a synthetic catalog. Mixed into the test cases which need a
+    catalog bigger than a handful of records.
+    """
+
+    def setup_generator(self):
+        self.Node = POOL.get('product.tree_node')
+        self.Relationship = POOL.get('product.product-product.tree_node')
+        self.Template = POOL.get('product.template')
+        self.PackedListing = POOL.get('product.tree_node.packed')
+
+    def setup_website(self):
+        """
+        Create the website on which the routes are benchmarked
+        """
+        Currency = POOL.get('currency.currency')
+        Party = POOL.get('party.party')
+        Company = POOL.get('company.company')
+        UrlMap = POOL.get('nereid.url_map')
+        Language = POOL.get('ir.lang')
+        Locale = POOL.get('nereid.website.locale')
+        Site = POOL.get('nereid.website')
+
+        usd, = Currency.create([{
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        }])
+        with Transaction().set_context(company=None):
+            party, = Party.create([{'name': 'Openlabs'}])
+            company, = Company.create([{
+                'party': party.id,
+                'currency': usd.id
+            }])
+        url_map, = UrlMap.search([], limit=1)
+        en_us, = Language.search([('code', '=', 'en_US')])
+        locale, = Locale.create([{
+            'code': 'en_US',
+            'language': en_us.id,
+            'currency': usd.id
+        }])
+        Site.create([{
+            'name': 'localhost',
+            'url_map': url_map.id,
+            'company': company.id,
+            'application_user': USER,
+            'default_locale': locale.id,
+            'currencies': [('add', [usd.id])],
+        }])
+
+    def generate_products(self, count):
+        """
+        Create products through the ORM in batches and return their ids
+        """
+        Category = POOL.get('product.category')
+        Uom = POOL.get('product.uom')
+
+        category, = Category.create([{'name': 'Benchmark'}])
+        uom, = Uom.search([], limit=1)
+
+        ids = []
+        for start in xrange(0, count, 500):
+            templates = self.Template.create([{
+                'name': 'Product-%d' % x,
+                'category': category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [('create', [{
+                    'uri': 'product-%d' % x,
+                    'displayed_on_eshop': True,
+                }])],
+            } for x in xrange(start, min(start + 500, count))])
+            ids.extend(t.products[0].id for t in templates)
+        return ids
+
+    def generate_nodes(self, count, depth):
+        """
+        Insert the nodes of a synthetic tree with SQL, with the nested set
+        already numbered, and return their ids in depth first order
+        """
+        cursor = Transaction().cursor
+        table = self.Node.__table__()
+
+        tree = generate_tree(count, depth)
+        for start in xrange(0, count, 1000):
+            cursor.execute(*table.insert(
+                columns=[
+                    table.name, table.slug, table.type_, table.display,
+                    table.active, table.products_per_page, table.sequence,
+                    table.left, table.right, table.create_uid,
+                    table.create_date,
+                ],
+                values=[[
+                    'Node %d' % i, 'node-%d' % i, 'catalog', 'product.product',
+                    True, 10, 10, left, right, USER, Now(),
+                ] for i, (_, left, right) in enumerate(
+                    tree[start:start + 1000], start
+                )]
+            ))
+
+        cursor.execute(*table.select(
+            table.left, table.id, where=table.name.like('Node %')
+        ))
+        ids_by_left = dict(cursor.fetchall())
+        ids = [ids_by_left[left] for _, left, _ in tree]
+
+        for start in xrange(1, count, 1000):
+            chunk = range(start, min(start + 1000, count))
+            cursor.execute(*table.update(
+                columns=[table.parent],
+                values=[Case(*[
+                    (table.id == ids[i], ids[tree[i][0]]) for i in chunk
+                ])],
+                where=table.id.in_([ids[i] for i in chunk])
+            ))
+        self.Node.update_child_count(ids)
+        return ids
+
+    def generate_relationships(self, node_ids, product_ids, count):
+        """
+        Insert relationships between random leaves and products with SQL
+        """
+        cursor = Transaction().cursor
+        table = self.Relationship.__table__()
+
+        leaves = node_ids[len(node_ids) // 2:]
+        rng = random.Random(42)
+        for start in xrange(0, count, 1000):
+            cursor.execute(*table.insert(
+                columns=[
+                    table.node, table.product, table.sequence,
+                    table.create_uid, table.create_date,
+                ],
+                values=[[
+                    rng.choice(leaves), rng.choice(product_ids),
+                    rng.randint(1, 1000), USER, Now(),
+                ] for _ in xrange(start, min(start + 1000, count))]
+            ))
+
+
+class CatalogBenchmark(CatalogGenerator, NereidTestCase):
+    """
+    Benchmark the tree operations on a synthetic catalog
+    """
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_catalog_tree')
+
+        self.setup_generator()
+        self.results = {}
+        self.templates = {
+            'catalog/node.html': '{{ products.count }}',
+            'product.jinja': '{{ product.name }}',
+        }
+
+    def measure(self, name, func, repeat=None):
+        """
+        Time the function, keeping the median, the minimum and the number
+        of queries of a run
+        """
+        timings = []
+        for _ in xrange(repeat or OPTIONS['repeat']):
+            with QueryCounter() as counter:
+                start = time.time()
+                func()
+                timings.append(time.time() - start)
+        timings.sort()
+        self.results[name] = {
+            'median': timings[len(timings) // 2],
+            'min': timings[0],
+            'queries': counter.count,
+        }
+        sys.stdout.write('%-40s %10.4fs %6d queries\n' % (
+            name, self.results[name]['median'], counter.count
+        ))
+
+    def test_benchmark(self):
+        """
+        Generate the catalog and benchmark the tree operations
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_website()
+
+            start = time.time()
+            product_ids = self.generate_products(OPTIONS['products'])
+            node_ids = self.generate_nodes(OPTIONS['nodes'], OPTIONS['depth'])
+            self.generate_relationships(
+                node_ids, product_ids, OPTIONS['relationships']
+            )
+            self.results['generate'] = {'median': time.time() - start}
+
+            root = self.Node(node_ids[0])
+            deepest = self.Node(node_ids[-1])
+            count = root.get_products().count
+            pages = max(1, int(math.ceil(count / 10.0)))
+
+            self.measure('get_products.count', lambda: root.get_products(
+            ).count)
+            for page in sorted(set([1, pages // 2 or 1, pages])):
+                self.measure(
+                    'get_products.items.page_%d' % page,
+                    lambda: root.get_products(page=page).items()
+                )
+            self.measure('get_rec_name.deepest', lambda: self.Node(
+                deepest.id
+            ).get_rec_name(None))
+
+            app = self.get_app()
+            with app.test_request_context('/'):
+                self.measure(
+                    'make_tree_crumbs.deepest',
+                    lambda: self.Node.make_tree_crumbs(deepest.id)
+                )
+
+            with app.test_client() as c:
+                self.measure(
+                    'route.node.page_1',
+                    lambda: c.get('/nodes/%d/_/1' % root.id)
+                )
+                self.measure(
+                    'route.sitemap_index',
+                    lambda: c.get('/sitemaps/tree-index.xml')
+                )
+                self.measure(
+                    'route.sitemap.page_1',
+                    lambda: c.get('/sitemaps/tree-1.xml')
+                )
+
+            parent = self.Node(node_ids[1])
+            self.measure('node.create', lambda: self.Node.create([{
+                'name': 'New Node',
+                'slug': 'new-node',
+                'parent': parent.id,
+            }]))
+            moved = self.Node(node_ids[-1])
+            targets = cycle([node_ids[2], node_ids[1]])
+            self.measure('node.move', lambda: self.Node.write([moved], {
+                'parent': next(targets),
+            }))
+            self.measure(
+                'relationship.bulk_create.1000',
+                lambda: self.Relationship.create([{
+                    'node': deepest.id,
+                    'product': product_id,
+                } for product_id in product_ids[:1000]]),
+                repeat=1
+            )
+            self.Node.write([root], {'pack_products': True})
+            self.measure(
+                'packed.pack', lambda: self.PackedListing.pack([
+                    self.Node(root.id)
+                ]), repeat=1
+            )
+            packed_ids = self.Node(root.id).get_packed_ids()
+            self.results['packed.overhead'] = {
+                'storage': len(packed_ids) * packed_ids.itemsize,
+                'memory': sys.getsizeof(packed_ids),
+            }
+            sys.stdout.write('%-40s %10d bytes %6d bytes in memory\n' % (
+                'packed.overhead', self.results['packed.overhead']['storage'],
+                self.results['packed.overhead']['memory'],
+            ))
+            for page in sorted(set([1, pages // 2 or 1, pages])):
+                self.measure(
+                    'get_products.packed.page_%d' % page,
+                    lambda: self.Node(root.id).get_products(
+                        page=page
+                    ).items()
+                )
+            self.Node.write([root], {'pack_products': False})
+            self.measure(
+                'node.clone_subtree',
+                lambda: self.Node.clone_subtree(parent, self.Node(root.id)),
+                repeat=1
+            )
+
+        with open(OPTIONS['output'], 'w') as output:
+            json.dump({
+                'meta': {
+                    'backend': CONFIG['db_type'],
+                    'commit': git_commit(),
+                    'time': time.time(),
+                    'options': OPTIONS,
+                },
+                'results': self.results,
+            }, output, indent=2, sort_keys=True)
+
+
+def git_commit():
+    "Return the commit of the working tree, if it is a git repository"
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    """
+    Print the change of the median timings and query counts between two
+    results
+    """
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old = json.load(old_file)['results']
+        new = json.load(new_file)['results']
+
+    for name in sorted(set(old) & set(new)):
+        if 'median' not in new[name]:
+            continue
+        before, after = old[name]['median'], new[name]['median']
+        change = (after - before) / before * 100 if before else 0
+        sys.stdout.write('%-40s %10.4fs %10.4fs %+8.1f%% %6s -> %s\n' % (
+            name, before, after, change,
+            old[name].get('queries', '-'), new[name].get('queries', '-'),
+        ))
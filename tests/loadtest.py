@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+    loadtest
+
+    Load test of the catalog routes on a synthetic catalog.
+
+    The catalog of the benchmark is seeded and committed in a database, then
+    a pool of processes, each running its own nereid application, replays a
+    mix of node pages, deep pages, product pages and sitemaps against it.
+    Everything runs locally. It is run with::
+
+        python setup.py loadtest --processes=4 --requests=20000
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import tempfile
+import multiprocessing
+from collections import defaultdict
+
+from trytond import backend
+from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+
+from .benchmark import CatalogBenchmark
+
+# Options of the load test, set by the setup command
+OPTIONS = {
+    'nodes': 1000,
+    'depth': 4,
+    'products': 1000,
+    'relationships': 10000,
+    'processes': 4,
+    'requests': 2000,
+    'seed': 42,
+    'output': 'loadtest.json',
+}
+
+# The share of each kind of request in the replayed traffic
+MIX = [
+    ('node', 0.5),
+    ('node_deep_page', 0.15),
+    ('product', 0.3),
+    ('sitemap', 0.05),
+]
+
+TEMPLATES = {
+    'catalog/node.html':
+    '{{ products.count }}'
+    '{% for product in products %}{{ product.name }}{% endfor %}'
+    '{{ make_tree_crumbs(node=node)|join(", ", attribute="1") }}',
+    'product.jinja': "{{ product.name }} {{ node and node.name }}",
+}
+
+
+def seed():
+    """
+    Install the module, seed the synthetic catalog and commit it. Returns
+    the data needed to build the urls.
+    """
+    benchmark = CatalogBenchmark('test_benchmark')
+    benchmark.setUp()
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        benchmark.setup_website()
+        product_ids = benchmark.generate_products(OPTIONS['products'])
+        node_ids = benchmark.generate_nodes(
+            OPTIONS['nodes'], OPTIONS['depth']
+        )
+        benchmark.generate_relationships(
+            node_ids, product_ids, OPTIONS['relationships']
+        )
+
+        pages = {}
+        for node in benchmark.Node.browse(node_ids):
+            pages[node.id] = int(math.ceil(
+                node.get_products().count / float(node.products_per_page)
+            ))
+        listed = dict(
+            (r.product.id, (r.product.uri, r.node.id))
+            for r in benchmark.Relationship.search([])
+        )
+        Transaction().cursor.commit()
+    return pages, listed.values()
+
+
+def build_urls(pages, listed, count, rng):
+    """
+    Return a list of (kind, url) following the mix of requests
+    """
+    nodes = [node_id for node_id, _ in sorted(pages.items())]
+    deep = [node_id for node_id in nodes if pages[node_id] > 1]
+    sitemap_pages = int(math.ceil(len(nodes) / 50000.0)) or 1
+
+    urls = []
+    for _ in xrange(count):
+        kind = rng.random()
+        for name, share in MIX:
+            kind -= share
+            if kind <= 0:
+                break
+        if name == 'node_deep_page' and not deep:
+            name = 'node'
+
+        if name == 'node':
+            # Top categories are the most visited
+            node_id = nodes[int(len(nodes) * rng.random() ** 3)]
+            url = '/nodes/%d/_/1' % node_id
+        elif name == 'node_deep_page':
+            node_id = rng.choice(deep)
+            url = '/nodes/%d/_/%d' % (
+                node_id, rng.randint(2, pages[node_id])
+            )
+        elif name == 'product':
+            uri, node_id = rng.choice(listed)
+            url = '/product/%s?node=%d' % (uri, node_id)
+        else:
+            url = rng.choice(
+                ['/sitemaps/tree-index.xml'] + [
+                    '/sitemaps/tree-%d.xml' % page
+                    for page in xrange(1, sitemap_pages + 1)
+                ]
+            )
+        urls.append((name, url))
+    return urls
+
+
+def replay(args):
+    """
+    Replay the urls on a nereid application of its own, in a worker
+    process. Returns a list of (kind, status code, seconds).
+    """
+    from nereid import Nereid
+
+    template_folder, urls = args
+    app = Nereid(template_folder=template_folder)
+    app.config.update({
+        'DATABASE_NAME': DB_NAME,
+        'SECRET_KEY': 'load-test',
+        'TEMPLATE_PREFIX_WEBSITE_NAME': False,
+    })
+    app.initialise()
+
+    results = []
+    with app.test_client() as c:
+        for kind, url in urls:
+            start = time.time()
+            rv = c.get(url)
+            results.append((kind, rv.status_code, time.time() - start))
+    return results
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return dict(
+        ('p%d' % p, timings[min(len(timings) - 1, len(timings) * p // 100)])
+        for p in (50, 95, 99)
+    )
+
+
+def run():
+    """
+    Seed the catalog, replay the traffic and report the throughput and
+    latencies
+    """
+    rng = random.Random(OPTIONS['seed'])
+    pages, listed = seed()
+    urls = build_urls(pages, listed, OPTIONS['requests'], rng)
+
+    template_folder = tempfile.mkdtemp()
+    try:
+        for name, source in TEMPLATES.iteritems():
+            path = os.path.join(template_folder, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as template:
+                template.write(source)
+
+        processes = OPTIONS['processes']
+        chunks = [
+            (template_folder, urls[i::processes]) for i in xrange(processes)
+        ]
+        # The workers connect to the database themselves, the connections
+        # used to seed the catalog must not be inherited through the fork
+        backend.get('Database')(DB_NAME).close()
+        pool = multiprocessing.Pool(processes)
+        start = time.time()
+        try:
+            results = sum(pool.map(replay, chunks), [])
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(template_folder)
+
+    timings = defaultdict(list)
+    errors = 0
+    for kind, status, seconds in results:
+        timings[kind].append(seconds)
+        timings['all'].append(seconds)
+        if status >= 500:
+            errors += 1
+
+    report = {
+        'options': OPTIONS,
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed,
+        'errors': errors,
+        'latency': dict(
+            (kind, percentiles(values))
+            for kind, values in timings.iteritems()
+        ),
+    }
+    sys.stdout.write(
+        '%d requests in %.2fs: %.1f requests/s, %d errors\n' % (
+            len(results), elapsed, report['throughput'], errors
+        )
+    )
+    for kind, values in sorted(report['latency'].iteritems()):
+        sys.stdout.write('%-16s p50 %.4fs p95 %.4fs p99 %.4fs\n' % (
+            kind, values['p50'], values['p95'], values['p99']
+        ))
+    with open(OPTIONS['output'], 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    return report
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+    test_query_plan
+
+    Query plan regression tests of the subtree listing SQL.
+
+    The SQL of `Node._get_products` is explained on a seeded catalog and
+    the plan must keep using the indexes. The routes must also stay within
+    their budget of queries.
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+from nereid.testing import NereidTestCase
+
+from .benchmark import CatalogGenerator
+
+# Tables which must never be read in full by the listing
+INDEXED_TABLES = [
+    'product_product', 'product_template',
+    'product_product-product_tree_node',
+]
+
+# The maximum number of queries of each route, on a cold cache. Raise
+# them deliberately, in the commit which needs more queries.
+QUERY_BUDGETS = {
+    'node': 30,
+    'node_last_page': 30,
+    'product': 40,
+    'sitemap_index': 10,
+    'sitemap': 10,
+}
+
+
+def sqlite_plan(cursor, query):
+    """
+    Return the details of the steps of the SQLite plan of the query
+    """
+    sql, params = tuple(query)
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def postgresql_plan(cursor, query):
+    """
+    Return the flattened list of nodes of the PostgreSQL plan of the query.
+    The tables are analyzed first, so that the planner chooses with the
+    statistics of the seeded catalog and its default settings.
+    """
+    sql, params = tuple(query)
+    for table in INDEXED_TABLES + ['product_tree_node']:
+        cursor.execute('ANALYZE "%s"' % table)
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+
+    nodes = []
+    stack = [plan[0]['Plan']]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.get('Plans', []))
+    return nodes
+
+
+class TestQueryPlan(CatalogGenerator, NereidTestCase):
+    """
+    Test the plans of the listing queries
+    """
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_catalog_tree')
+
+        self.setup_generator()
+        self.templates = {
+            'catalog/node.html':
+            '{{ products.count }}'
+            '{% for product in products %}{{ product.name }}{% endfor %}'
+            '{{ make_tree_crumbs(node=node)|join(", ", attribute="1") }}',
+            'product.jinja': "{{ node and node.name or 'no-node' }}",
+        }
+
+    def setup_catalog(self):
+        """
+        Seed a catalog big enough for the planner to care
+        """
+        self.setup_website()
+        self.product_ids = self.generate_products(200)
+        self.node_ids = self.generate_nodes(300, 4)
+        self.generate_relationships(self.node_ids, self.product_ids, 3000)
+        self.root = self.Node(self.node_ids[0])
+
+    def get_plan(self, query):
+        """
+        Return the steps of the plan of the query
+        """
+        cursor = Transaction().cursor
+
+        if CONFIG['db_type'] == 'sqlite':
+            return sqlite_plan(cursor, query)
+        return postgresql_plan(cursor, query)
+
+    def assert_no_full_scan(self, plan):
+        """
+        Assert that the plan does not read the product and relationship
+        tables in full
+        """
+        for step in plan:
+            for table in INDEXED_TABLES:
+                if CONFIG['db_type'] == 'sqlite':
+                    full_scan = (
+                        step.startswith('SCAN') and
+                        ' %s' % table in step and 'INDEX' not in step
+                    )
+                else:
+                    full_scan = (
+                        step['Node Type'] == 'Seq Scan' and
+                        step.get('Relation Name') == table
+                    )
+                self.assertFalse(full_scan, 'Full scan in plan: %s' % plan)
+
+    def assert_plan(self, query):
+        """
+        Assert that the plan of the query does not read the product and
+        relationship tables in full, and sorts only for the ORDER BY
+        """
+        plan = self.get_plan(query)
+        self.assert_no_full_scan(plan)
+
+        for step in plan:
+            if CONFIG['db_type'] == 'sqlite':
+                self.assertFalse(
+                    'TEMP B-TREE FOR GROUP BY' in step or
+                    'TEMP B-TREE FOR DISTINCT' in step,
+                    'Unexpected sort in plan: %s' % plan
+                )
+            elif step['Node Type'] == 'Sort':
+                self.assertTrue(
+                    all('sequence' in key for key in step['Sort Key']),
+                    'Unexpected sort in plan: %s' % plan
+                )
+
+    def test_0010_listing_plan(self):
+        """
+        The listing SQL of both display modes uses the indexes
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_catalog()
+            leaf = self.Node(self.node_ids[-1])
+
+            for display in ('product.product', 'product.template'):
+                self.Node.write([self.root, leaf], {'display': display})
+                for node in (self.root, leaf):
+                    _, query, _ = self.Node(node.id)._get_products()
+                    self.assert_plan(query)
+
+    def test_0015_sample_plan(self):
+        """
+        The queries of a sample of products use the indexes
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_catalog()
+            leaf = self.Node(self.node_ids[-1])
+
+            for display in ('product.product', 'product.template'):
+                self.Node.write([self.root, leaf], {'display': display})
+                for node in (self.root, leaf):
+                    node = self.Node(node.id)
+                    _, boundaries = node._get_sample_boundaries()
+                    _, query, table = node._get_sample_query()
+                    boundary = boundaries[-1] if boundaries else 0
+                    query.where &= (table.id >= boundary)
+                    query.offset = 10
+                    self.assert_no_full_scan(self.get_plan(query))
+
+    def test_0020_route_query_budget(self):
+        """
+        The routes stay within their query budget
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_catalog()
+            app = self.get_app(CATALOG_TREE_INSTRUMENTATION=True)
+
+            pages = self.root.get_products().pages
+            product = self.Relationship.search([], limit=1)[0].product
+            urls = {
+                'node': '/nodes/%d/_/1' % self.root.id,
+                'node_last_page': '/nodes/%d/_/%d' % (self.root.id, pages),
+                'product': '/product/%s?node=%d' % (
+                    product.uri, self.root.id
+                ),
+                'sitemap_index': '/sitemaps/tree-index.xml',
+                'sitemap': '/sitemaps/tree-1.xml',
+            }
+
+            with app.test_client() as c:
+                for name, url in sorted(urls.iteritems()):
+                    rv = c.get(url)
+                    self.assertEqual(rv.status_code, 200, url)
+                    metrics = dict(
+                        item.split('=') for item in
+                        rv.headers['X-Catalog-Tree-Metrics'].split(', ')
+                    )
+                    self.assertTrue(
+                        int(metrics['queries']) <= QUERY_BUDGETS[name],
+                        '%s took %s queries, the budget is %d' % (
+                            url, metrics['queries'], QUERY_BUDGETS[name]
+                        )
+                    )
+
+
+def suite():
+    "Query plan test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestQueryPlan)
+    )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
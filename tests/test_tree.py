@@ -5,9 +5,15 @@ test_tree
 :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
 :license: BSD, see LICENSE for more details.
 """
+import gzip
+import os
+import json
+import time
+import shutil
 from decimal import Decimal
 import unittest
 from itertools import chain
+from StringIO import StringIO
 
 from lxml import objectify
 import trytond.tests.test_tryton
@@ -16,6 +22,9 @@ from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT, \
 from nereid.testing import NereidTestCase
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
+from trytond.modules.nereid_catalog_tree import (
+    export, product_sitemap, replica, revision, stats, thumbnail, tree,
+)
 
 
 class TestTree(NereidTestCase):
@@ -40,7 +49,7 @@ class TestTree(NereidTestCase):
                 'name': 'Openlabs',
             }])
 
-            company, = self.Company.create([{
+            self.company, = self.Company.create([{
                 'party': party1.id,
                 'currency': usd.id
             }])
@@ -70,7 +79,7 @@ class TestTree(NereidTestCase):
         self.Site.create([{
             'name': 'localhost',
             'url_map': url_map.id,
-            'company': company.id,
+            'company': self.company.id,
             'application_user': USER,
             'default_locale': self.locale_en_us.id,
             'currencies': [('add', [usd.id])],
@@ -398,6 +407,13 @@ class TestTree(NereidTestCase):
 
             self.assert_(node1)
 
+            node2, = Node.create([{
+                'name': 'Node2',
+                'type_': 'catalog',
+                'slug': 'node2',
+            }])
+            product, = template1.products
+
             app = self.get_app()
 
             with app.test_client() as c:
@@ -413,6 +429,11 @@ class TestTree(NereidTestCase):
                 self.assertEqual(rv.status_code, 200)
                 self.assertEqual(rv.data, node1.name)
 
+                # With a node which does not list the product
+                rv = c.get('%s?node=%d' % (url, node2.id))
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'no-node')
+
                 # With one invalid node
                 rv = c.get('%s?node=999999' % url)
                 self.assertEqual(rv.status_code, 200)
@@ -772,6 +793,1621 @@ class TestTree(NereidTestCase):
             self.assertEqual(len(node1.get_products().all_items()), 10)
             self.assertEqual(len(node1.get_products().items()), 10)
 
+    def test_0110_iter_products(self):
+        """
+        Ensure that products of a subtree can be streamed in chunks
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            templates = self.Template.create([{
+                'name': 'Product-%s' % x,
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [
+                        {
+                            'uri': 'product-%s-%s' % (x, v),
+                            'displayed_on_eshop': True
+                        } for v in xrange(0, 5)
+                    ])
+                ]
+            } for x in xrange(0, 5)])
+            products = list(chain(*[t.products for t in templates]))
+
+            node1, = Node.create([{
+                'name': 'Node 1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'products': [
+                    ('create', [{'product': p.id} for p in products])
+                ]
+            }])
+            # The first ten products are also in a child node and must
+            # still be returned only once
+            Node.create([{
+                'name': 'Node 2',
+                'type_': 'catalog',
+                'slug': 'node2',
+                'parent': node1.id,
+                'products': [
+                    ('create', [{'product': p.id} for p in products[:10]])
+                ]
+            }])
+
+            streamed = list(node1.iter_products(chunk_size=7))
+            self.assertEqual(len(streamed), 25)
+            self.assertEqual(
+                sorted(p.id for p in streamed),
+                sorted(p.id for p in products)
+            )
+
+            node1.display = 'product.template'
+            node1.save()
+
+            streamed = list(node1.iter_products(chunk_size=2))
+            self.assertEqual(
+                sorted(t.id for t in streamed),
+                sorted(t.id for t in templates)
+            )
+
+    def test_0120_product_feed(self):
+        """
+        Render the product feed of a node as XML and CSV
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 3)])
+                ]
+            }])
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'products': [('create', [
+                    {'product': product} for product in template1.products
+                ])]
+            }])
+
+            app = self.get_app()
+
+            with app.test_client() as c:
+                rv = c.get('/nodes/%d/node1/feed.xml' % node1.id)
+                self.assertEqual(rv.status_code, 200)
+                xml = objectify.fromstring(rv.data)
+                self.assertEqual(len(xml.channel.findall('item')), 3)
+
+                rv = c.get('/nodes/%d/node1/feed.csv' % node1.id)
+                self.assertEqual(rv.status_code, 200)
+                lines = rv.data.splitlines()
+                self.assertEqual(len(lines), 4)
+                self.assertTrue(lines[0].startswith('id,title,link,price'))
+                self.assertTrue('10 USD' in lines[1])
+
+                rv = c.get('/nodes/%d/node1/feed.pdf' % node1.id)
+                self.assertEqual(rv.status_code, 404)
+
+            # A template is listed with its first variant on the eshop
+            self.Product.write(
+                [template1.products[0]], {'displayed_on_eshop': False}
+            )
+            Node.write([node1], {'display': 'product.template'})
+
+            with app.test_client() as c:
+                rv = c.get('/nodes/%d/node1/feed.csv' % node1.id)
+                self.assertEqual(rv.status_code, 200)
+                lines = rv.data.splitlines()
+                self.assertEqual(len(lines), 2)
+                self.assertTrue(
+                    lines[1].startswith(str(template1.products[1].id))
+                )
+
+    def test_0130_product_node_paths(self):
+        """
+        Check the canonical category and paths of a product
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-1',
+                        'displayed_on_eshop': True
+                    }])
+                ]
+            }])
+            product, = template1.products
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'parent': self.default_node,
+            }])
+            node2, = Node.create([{
+                'name': 'Node2',
+                'type_': 'catalog',
+                'slug': 'node2',
+                'parent': node1,
+                'products': [('create', [{'product': product.id}])],
+            }])
+            self.assertEqual(
+                self.Product.get_node_paths([product]),
+                {product.id: [[self.default_node.id, node1.id, node2.id]]}
+            )
+            self.assertEqual(product.get_canonical_node(), node2)
+
+            # A shallower path becomes the canonical category
+            node3, = Node.create([{
+                'name': 'Node3',
+                'type_': 'catalog',
+                'slug': 'node3',
+                'products': [('create', [{'product': product.id}])],
+            }])
+            self.assertEqual(
+                self.Product.get_node_paths([product.id])[product.id],
+                [[node3.id], [self.default_node.id, node1.id, node2.id]]
+            )
+            self.assertEqual(product.get_canonical_node(), node3)
+
+            # Inactive nodes are not part of any path
+            Node.write([node3], {'active': False})
+            self.assertEqual(product.get_canonical_node(), node2)
+
+    def test_0140_tree_revisions(self):
+        """
+        Writes to a tree only bump the revision of that tree and
+        invalidate its cached data
+        """
+        Node = POOL.get('product.tree_node')
+        Revision = POOL.get('product.tree_node.revision')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'parent': self.default_node,
+            }])
+            other_root, = Node.create([{
+                'name': 'Other',
+                'type_': 'catalog',
+                'slug': 'other',
+            }])
+            scope = 'node,%d' % self.default_node.id
+            other_scope = 'node,%d' % other_root.id
+
+            revision = Revision.get_revision(scope)
+            other_revision = Revision.get_revision(other_scope)
+            self.assertTrue(revision > 0)
+            self.assertEqual(Revision.get_root_scope(node1), scope)
+
+            Node.write([node1], {'name': 'Node One'})
+            self.assertEqual(Revision.get_revision(scope), revision + 1)
+            self.assertEqual(
+                Revision.get_revision(other_scope), other_revision
+            )
+
+            with app.test_request_context('/'):
+                crumbs = Node.make_tree_crumbs(node1.id)
+            self.assertEqual(
+                [name for _, name in crumbs], ['Home', 'root', 'Node One']
+            )
+
+            # Moving a node to another tree bumps both trees
+            Node.write([node1], {'parent': other_root.id})
+            self.assertEqual(Revision.get_revision(scope), revision + 2)
+            self.assertEqual(
+                Revision.get_revision(other_scope), other_revision + 1
+            )
+
+            # The catalog scope follows the trees without a row of its own
+            self.assertEqual(
+                Revision.get_revision('catalog'),
+                Revision.get_revision(scope) +
+                Revision.get_revision(other_scope)
+            )
+            self.assertFalse(
+                Revision.search([('scope', '=', 'catalog')])
+            )
+
+            # The scope of a website is created with it
+            website, = self.Site.search([])
+            website_scope = 'website,%d' % website.id
+            self.assertEqual(Revision.get_revision(website_scope), 0)
+            self.assertTrue(
+                Revision.search([('scope', '=', website_scope)])
+            )
+
+    def test_0150_deferred_tree_rebuild(self):
+        """
+        Listings stay consistent while a rebuild of the nested set is
+        pending and the rebuild is coalesced into a single job
+        """
+        Node = POOL.get('product.tree_node')
+        Job = POOL.get('product.tree_node.job')
+        Revision = POOL.get('product.tree_node.revision')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-1',
+                        'displayed_on_eshop': True
+                    }])
+                ]
+            }])
+
+            with Transaction().set_context(defer_tree_rebuild=True):
+                node1, = Node.create([{
+                    'name': 'Node1',
+                    'type_': 'catalog',
+                    'slug': 'node1',
+                    'parent': self.default_node,
+                }])
+                node2, = Node.create([{
+                    'name': 'Node2',
+                    'type_': 'catalog',
+                    'slug': 'node2',
+                    'parent': node1,
+                    'products': [
+                        ('create', [{'product': template1.products[0].id}])
+                    ],
+                }])
+
+            self.assertEqual(Job.search([], count=True), 1)
+            self.assertTrue(Job.is_pending(Node.__name__, 'rebuild_tree'))
+            self.assertEqual(
+                self.default_node.get_products().all_items(),
+                list(template1.products)
+            )
+            # The paths and the trees are found from the parent links
+            product_id = template1.products[0].id
+            path = [self.default_node.id, node1.id, node2.id]
+            self.assertEqual(
+                self.Product.get_node_paths([product_id])[product_id],
+                [path]
+            )
+            self.assertEqual(
+                Node.get_tree_scopes([node2.id]),
+                set([revision.node_scope(self.default_node.id)])
+            )
+            self.assertEqual(
+                Revision.get_root_scope(Node(node2.id)),
+                revision.node_scope(self.default_node.id)
+            )
+
+            Job.process()
+            self.assertFalse(Job.is_pending(Node.__name__, 'rebuild_tree'))
+            self.assertEqual(
+                self.Product.get_node_paths([product_id])[product_id],
+                [path]
+            )
+
+            node1 = Node(node1.id)
+            node2 = Node(node2.id)
+            self.assertTrue(node1.left < node2.left < node2.right)
+            self.assertTrue(node2.right < node1.right)
+            self.assertEqual(
+                self.default_node.get_products().all_items(),
+                list(template1.products)
+            )
+
+    def test_0160_route_instrumentation(self):
+        """
+        Instrumented routes report their queries when enabled
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+            }])
+
+            app = self.get_app()
+            with app.test_client() as c:
+                rv = c.get('/nodes/%d/node1' % node1.id)
+                self.assertFalse('X-Catalog-Tree-Metrics' in rv.headers)
+                rv = c.get('/catalog-tree/metrics')
+                self.assertEqual(rv.status_code, 404)
+
+            app = self.get_app(CATALOG_TREE_INSTRUMENTATION=True)
+            with app.test_client() as c:
+                rv = c.get('/nodes/%d/node1' % node1.id)
+                self.assertEqual(rv.status_code, 200)
+                self.assertTrue(
+                    'queries=' in rv.headers['X-Catalog-Tree-Metrics']
+                )
+
+                rv = c.get('/catalog-tree/metrics')
+                self.assertEqual(rv.status_code, 200)
+                summary = json.loads(rv.data)
+                self.assertTrue(
+                    summary['product.tree_node.render']['requests'] >= 1
+                )
+
+    def test_0170_node_thumbnail(self):
+        """
+        Nodes without image have no thumbnail
+        """
+        Node = POOL.get('product.tree_node')
+
+        self.assertEqual(thumbnail.get_bucket(10), 64)
+        self.assertEqual(thumbnail.get_bucket(128), 128)
+        self.assertEqual(thumbnail.get_bucket(129), 256)
+        self.assertEqual(thumbnail.get_bucket(5000), 512)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+            }])
+            self.assertEqual(node1.image_preview, None)
+            self.assertEqual(node1.get_thumbnail(128), None)
+
+            app = self.get_app()
+            with app.test_client() as c:
+                rv = c.get('/nodes/%d/node1/thumbnail-128.png' % node1.id)
+                self.assertEqual(rv.status_code, 404)
+
+    @unittest.skipIf(thumbnail.Image is None, 'PIL is not installed')
+    def test_0175_node_thumbnail_image(self):
+        """
+        Serve the resized thumbnail of the image of a node
+        """
+        Node = POOL.get('product.tree_node')
+        StaticFolder = POOL.get('nereid.static.folder')
+        StaticFile = POOL.get('nereid.static.file')
+
+        def make_image(color):
+            data = StringIO()
+            thumbnail.Image.new('RGB', (400, 200), color).save(data, 'PNG')
+            return buffer(data.getvalue())
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            shutil.rmtree(
+                thumbnail.get_thumbnail_directory(), ignore_errors=True
+            )
+
+            folder, = StaticFolder.create([{
+                'folder_name': 'nodes',
+                'description': 'Node Images',
+            }])
+            image, = StaticFile.create([{
+                'name': 'node1.png',
+                'folder': folder.id,
+                'file_binary': make_image('red'),
+            }])
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'image': image.id,
+            }])
+
+            app = self.get_app()
+            with app.test_request_context('/'):
+                url = node1.get_thumbnail_url(100)
+            self.assertTrue('thumbnail-128.png' in url)
+
+            with app.test_client() as c:
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.mimetype, 'image/png')
+                resized = thumbnail.Image.open(StringIO(rv.data))
+                self.assertEqual(resized.size, (128, 64))
+
+                etag = rv.headers['ETag']
+                rv = c.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(rv.status_code, 304)
+
+            # The write dates of the transaction are all the same, the
+            # checksums cached for them are dropped
+            StaticFile.write([image], {'file_binary': make_image('blue')})
+            Node._image_checksum_cache.clear()
+            with app.test_request_context('/'):
+                self.assertNotEqual(
+                    Node(node1.id).get_thumbnail_url(100), url
+                )
+
+    def test_0180_prefetch_next_page(self):
+        """
+        Pages are the same whether the next page is prefetched or not
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 25)])
+                ]
+            }])
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'products': [('create', [
+                    {'product': product.id, 'sequence': 100 - i}
+                    for i, product in enumerate(template1.products)
+                ])]
+            }])
+            pages = [
+                node1.get_products(page=page).items()
+                for page in (1, 2, 3)
+            ]
+            self.assertEqual(
+                sum(pages, []), list(reversed(template1.products))
+            )
+
+            Node.write([node1], {'prefetch_next_page': True})
+            # A transaction which changed the trees fills no cache, start
+            # afresh as the next request would
+            revision._states.pop(Transaction().cursor, None)
+
+            calls = []
+            get_product_ids = Node._get_product_ids.im_func
+
+            def counted_get_product_ids(node, *args, **kwargs):
+                calls.append(node.id)
+                return get_product_ids(node, *args, **kwargs)
+
+            Node._get_product_ids = counted_get_product_ids
+            try:
+                node1 = Node(node1.id)
+                for page in (1, 2, 3):
+                    self.assertEqual(
+                        node1.get_products(page=page).items(),
+                        pages[page - 1]
+                    )
+            finally:
+                Node._get_product_ids = get_product_ids
+            # Page 2 was fetched along with page 1 and runs no listing query
+            self.assertEqual(calls, [node1.id, node1.id])
+
+    def test_0190_json_listing(self):
+        """
+        Page through the JSON listing of a node with its cursor
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 5)])
+                ]
+            }])
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'products': [('create', [
+                    {'product': product.id, 'sequence': 10 - i}
+                    for i, product in enumerate(template1.products)
+                ])]
+            }])
+            expected = [p.id for p in reversed(template1.products)]
+
+            app = self.get_app()
+
+            with app.test_client() as c:
+                url = '/nodes/%d/node1/products.json' % node1.id
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                data = json.loads(rv.data)
+                self.assertEqual(
+                    [item['id'] for item in data['products']], expected
+                )
+                self.assertEqual(data['next'], None)
+                self.assertEqual(data['currency'], 'USD')
+                self.assertEqual(data['products'][0]['price'], '10')
+                self.assertEqual(
+                    data['products'][0]['url'], '/product/product-4'
+                )
+
+                ids, after = [], None
+                while True:
+                    rv = c.get(url, query_string=dict(
+                        limit=2, **(after and {'after': after} or {})
+                    ))
+                    data = json.loads(rv.data)
+                    self.assertTrue(len(data['products']) <= 2)
+                    ids.extend(item['id'] for item in data['products'])
+                    after = data['next']
+                    if after is None:
+                        break
+                self.assertEqual(ids, expected)
+
+                self.assertEqual(c.get(url + '?after=x').status_code, 400)
+                self.assertEqual(c.get(url + '?after=1').status_code, 400)
+                self.assertEqual(
+                    c.get(url + '?after=1.2.3').status_code, 400
+                )
+                self.assertEqual(c.get(url + '?limit=0').status_code, 400)
+
+    def test_0200_static_export_pages(self):
+        """
+        Render the pages of the static export of a tree
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+            app = self.get_app()
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 3)])
+                ]
+            }])
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'parent': self.default_node,
+                'products_per_page': 2,
+                'products': [('create', [
+                    {'product': product.id}
+                    for product in template1.products
+                ])]
+            }])
+
+            self.assertEqual(
+                export.get_subtrees([self.default_node.id]),
+                [(self.default_node.id, [self.default_node.id]),
+                 (node1.id, [node1.id])]
+            )
+
+            # Only the subtrees changed are exported again
+            fingerprint = export.get_fingerprint(node1.id)
+            Node.create([{
+                'name': 'Node2',
+                'type_': 'catalog',
+                'slug': 'node2',
+                'parent': self.default_node,
+            }])
+            self.assertEqual(export.get_fingerprint(node1.id), fingerprint)
+            Node.create([{
+                'name': 'Node3',
+                'type_': 'catalog',
+                'slug': 'node3',
+                'parent': node1,
+            }])
+            self.assertNotEqual(
+                export.get_fingerprint(node1.id), fingerprint
+            )
+
+            with app.test_request_context('/'):
+                urls = export.get_node_pages([node1.id])
+            # The pages are requested through the application
+            pages = list(export.iter_pages(app, urls))
+
+            base = 'nodes/%d/node1/' % node1.id
+            self.assertEqual([path for path, _ in pages], [
+                base + '1/index.html', base + 'index.html',
+                base + '2/index.html',
+            ])
+            self.assertTrue(all(data.startswith('3||') for _, data in pages))
+            self.assertEqual(pages[0][1], pages[1][1])
+
+    def test_0210_warmup(self):
+        """
+        Warm up the caches of the roots of a website and their children
+        """
+        Node = POOL.get('product.tree_node')
+        WebsiteTreeNode = POOL.get('nereid.website-product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            website, = self.Site.search([])
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'parent': self.default_node,
+            }])
+            Node.create([{
+                'name': 'Node2',
+                'type_': 'catalog',
+                'slug': 'node2',
+                'parent': node1,
+            }])
+            WebsiteTreeNode.create([{
+                'website': website.id,
+                'node': self.default_node.id,
+            }])
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    Node._get_warmup_nodes(website),
+                    [self.default_node, node1]
+                )
+                self.assertEqual(
+                    Node.warmup_website(website, time.time() + 30), 2
+                )
+                # Nothing is warmed up past the deadline
+                self.assertEqual(Node.warmup_website(website, 0), 0)
+
+    def test_0220_node_hit_counters(self):
+        """
+        Count the hits of the node pages and rank the nodes by traffic
+        """
+        Node = POOL.get('product.tree_node')
+        NodeHit = POOL.get('product.tree_node.hit')
+        NodeTraffic = POOL.get('product.tree_node.traffic')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(CATALOG_TREE_HIT_COUNTERS=True)
+            website, = self.Site.search([])
+
+            node1, node2 = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+            }, {
+                'name': 'Node2',
+                'type_': 'catalog',
+                'slug': 'node2',
+            }])
+
+            stats.counter.pop(DB_NAME)
+            with app.test_client() as c:
+                for url in ('/nodes/%d/node1', '/nodes/%d/node1/2'):
+                    rv = c.get(url % node1.id)
+                    self.assertEqual(rv.status_code, 200)
+                    rv = c.get(url % node1.id)
+            counts = stats.counter.pop(DB_NAME)
+            self.assertEqual(
+                sorted((key[:2], value[0]) for key, value in
+                       counts.iteritems()),
+                [((node1.id, 1), 2), ((node1.id, 2), 2)]
+            )
+
+            NodeHit.add_hits(counts)
+            NodeHit.add_hits(counts)
+            NodeHit.add_hits({(node2.id, 1, 'en_US'): (1, 0.5)})
+            self.assertEqual(
+                sorted((h.node, h.page, h.hits) for h in NodeHit.search([])),
+                [(node1, 1, 4), (node1, 2, 4), (node2, 1, 1)]
+            )
+
+            traffic = NodeTraffic.search([])
+            self.assertEqual(
+                [(t.node, t.hits) for t in traffic], [(node1, 8), (node2, 1)]
+            )
+            self.assertEqual(traffic[1].query_time, 0.5)
+
+            self.assertEqual(
+                NodeHit.get_hot_node_ids(), [node1.id, node2.id]
+            )
+            self.assertEqual(NodeHit.get_hot_node_ids([node2]), [node2.id])
+
+            # Only the nodes of the trees of the website are warmed up
+            WebsiteTreeNode = POOL.get('nereid.website-product.tree_node')
+            WebsiteTreeNode.create([{
+                'website': website.id,
+                'node': node2.id,
+            }])
+            self.assertEqual(Node._get_warmup_nodes(website), [node2, node2])
+
+    def test_0230_resequence_products(self):
+        """
+        Reorder the products of a node changing only the misplaced rows
+        """
+        Node = POOL.get('product.tree_node')
+        Relationship = POOL.get('product.product-product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 5)])
+                ]
+            }])
+            products = list(template1.products)
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'products': [('create', [
+                    {'product': product.id} for product in products
+                ])]
+            }])
+
+            def listing():
+                return Node(node1.id).get_products().items()
+
+            # All the sequences default to the same value
+            products.reverse()
+            self.assertEqual(
+                Relationship.resequence(node1, [p.id for p in products]), 4
+            )
+            self.assertEqual(listing(), products)
+
+            # Moving a product changes its relationship only
+            products.insert(1, products.pop())
+            self.assertEqual(
+                Relationship.resequence(node1, [p.id for p in products]), 1
+            )
+            self.assertEqual(listing(), products)
+
+            # The products missing from the list keep their order, after
+            self.assertEqual(
+                Relationship.resequence(node1, [products[-1].id]), 1
+            )
+            self.assertEqual(listing(), products[-1:] + products[:-1])
+
+            self.assertEqual(
+                Relationship.resequence(node1, [products[-1].id]), 0
+            )
+
+    def test_0240_subtree_aggregates(self):
+        """
+        Compute the aggregates of the subtrees through the tree jobs
+        """
+        Node = POOL.get('product.tree_node')
+        Job = POOL.get('product.tree_node.job')
+        Aggregate = POOL.get('product.tree_node.aggregate')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            # The list prices are properties of the company of the website
+            with Transaction().set_context(company=self.company.id):
+                template1, template2 = self.Template.create([{
+                    'name': 'Product-%d' % x,
+                    'category': self.category.id,
+                    'type': 'goods',
+                    'list_price': Decimal(price),
+                    'cost_price': Decimal('5'),
+                    'default_uom': uom.id,
+                    'products': [
+                        ('create', [{
+                            'uri': 'product-%d' % x,
+                            'displayed_on_eshop': True
+                        }])
+                    ]
+                } for x, price in ((1, '10'), (2, '20'))])
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'parent': self.default_node,
+                'products': [('create', [
+                    {'product': t.products[0].id}
+                    for t in (template1, template2)
+                ])]
+            }])
+
+            # Computed on the fly until the jobs are run
+            self.assertEqual(Aggregate.search([], count=True), 0)
+            root = Node(self.default_node.id)
+            self.assertEqual(root.subtree_product_count, 2)
+
+            # The jobs are run by cron, without a company
+            with Transaction().set_context(company=None):
+                Job.process()
+            self.assertEqual(Aggregate.search([], count=True), 2)
+            for node in Node.browse([self.default_node.id, node1.id]):
+                self.assertEqual(node.subtree_product_count, 2)
+                self.assertEqual(node.subtree_min_price, Decimal('10'))
+                self.assertEqual(node.subtree_max_price, Decimal('20'))
+                self.assertEqual(
+                    node.subtree_newest_date,
+                    template2.products[0].create_date
+                )
+
+            with Transaction().set_context(company=self.company.id):
+                self.Template.write(
+                    [template2], {'list_price': Decimal('30')}
+                )
+            with Transaction().set_context(company=None):
+                Job.process()
+            self.assertEqual(
+                Node(self.default_node.id).subtree_max_price, Decimal('30')
+            )
+
+            # Moving the node away empties the aggregates of its old parent
+            Node.write([node1], {'parent': None})
+            Job.process()
+            self.assertEqual(
+                Node(self.default_node.id).subtree_product_count, 0
+            )
+
+    def test_0250_sample_products(self):
+        """
+        Sample products of a subtree with and without a seed
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 10)])
+                ]
+            }])
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'products': [('create', [
+                    {'product': product.id}
+                    for product in template1.products
+                ])]
+            }])
+
+            sample = node1.sample_products(4, seed=42)
+            self.assertEqual(len(sample), 4)
+            self.assertEqual(len(set(sample)), 4)
+            self.assertTrue(set(sample) <= set(template1.products))
+            self.assertEqual(node1.sample_products(4, seed=42), sample)
+
+            self.assertEqual(
+                set(node1.sample_products(20)), set(template1.products)
+            )
+
+            # Every product is found from the cached ids before it
+            step = tree.SAMPLE_STEP
+            tree.SAMPLE_STEP = 3
+            try:
+                node1 = Node(node1.id)
+                count, boundaries = node1._get_sample_boundaries()
+                self.assertEqual(count, 10)
+                self.assertEqual(len(boundaries), 4)
+                self.assertEqual(
+                    set(node1.sample_products(20)), set(template1.products)
+                )
+            finally:
+                tree.SAMPLE_STEP = step
+
+            # A packed listing is sampled from its packed ids
+            Job = POOL.get('product.tree_node.job')
+            Node.write([node1], {'pack_products': True})
+            Job.process()
+            node1 = Node(node1.id)
+            self.assertEqual(len(node1.get_packed_ids()), 10)
+            self.assertEqual(
+                set(node1.sample_products(20)), set(template1.products)
+            )
+            self.assertEqual(
+                node1.sample_products(4, seed=42),
+                node1.sample_products(4, seed=42)
+            )
+
+    def test_0260_replica_reads(self):
+        """
+        Fall back to the primary database when the replica is not usable
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 3)])
+                ]
+            }])
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'products': [('create', [
+                    {'product': product.id}
+                    for product in template1.products
+                ])]
+            }])
+
+            replica._failures.clear()
+            app = self.get_app(
+                CATALOG_TREE_REPLICA_DATABASE='catalog-tree-missing-replica'
+            )
+            with app.test_client() as c:
+                rv = c.get('/nodes/%d/node1' % node1.id)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data[0], '3')
+
+                rv = c.get('/sitemaps/tree-index.xml')
+                self.assertEqual(rv.status_code, 200)
+
+            # The replica is not tried again until the retry delay is over
+            self.assertTrue(
+                'catalog-tree-missing-replica' in replica._failures
+            )
+            with app.test_request_context('/'):
+                self.assertTrue(replica.get_replica_cursor() is None)
+                self.assertTrue(
+                    replica.is_replica_current(Transaction().cursor)
+                )
+
+    def test_0265_replica_reads_current(self):
+        """
+        Read from the replica database when it is up to date
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            # The test database is its own replica, which may not see the
+            # data of this uncommitted transaction
+            replica._failures.clear()
+            app = self.get_app(
+                CATALOG_TREE_REPLICA_DATABASE=DB_NAME,
+                CATALOG_TREE_REPLICA_MAX_LAG=10 ** 6,
+            )
+            with app.test_request_context('/'):
+                cursor = replica.get_replica_cursor()
+                self.assertTrue(cursor is not None)
+                try:
+                    self.assertTrue(replica.is_replica_current(cursor))
+                finally:
+                    cursor.close()
+
+            with app.test_client() as c:
+                rv = c.get('/sitemaps/tree-index.xml')
+                self.assertEqual(rv.status_code, 200)
+            self.assertFalse(DB_NAME in replica._failures)
+
+    def test_0270_product_sitemaps(self):
+        """
+        Serve the gzipped product sitemaps of a tree
+        """
+        Node = POOL.get('product.tree_node')
+        Job = POOL.get('product.tree_node.job')
+        WebsiteTreeNode = POOL.get('nereid.website-product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            website, = self.Site.search([])
+            uom, = self.Uom.search([], limit=1)
+            shutil.rmtree(
+                product_sitemap.get_sitemap_directory(), ignore_errors=True
+            )
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 3)])
+                ]
+            }])
+
+            Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'parent': self.default_node,
+                'products': [('create', [
+                    {'product': product.id}
+                    for product in template1.products
+                ])]
+            }, {
+                # A root which is not on the website is not listed
+                'name': 'Other',
+                'type_': 'catalog',
+                'slug': 'other',
+                'products': [('create', [
+                    {'product': product.id}
+                    for product in template1.products
+                ])]
+            }])
+            WebsiteTreeNode.create([{
+                'website': website.id,
+                'node': self.default_node.id,
+            }])
+
+            app = self.get_app()
+            with app.test_client() as c:
+                # The sitemaps are written by the job queued by the index
+                rv = c.get('/sitemaps/products-index.xml')
+                self.assertEqual(rv.status_code, 200)
+                self.assertFalse('<sitemap>' in rv.data)
+                self.assertTrue(
+                    Job.is_pending(Node.__name__, 'write_queued_sitemaps')
+                )
+                self.assertTrue(os.path.exists(
+                    product_sitemap.get_url_template_path(website.id)
+                ))
+                Job.process()
+
+                # The sitemaps are current, nothing is queued again
+                rv = c.get('/sitemaps/products-index.xml')
+                self.assertEqual(rv.status_code, 200)
+                self.assertFalse(
+                    Job.is_pending(Node.__name__, 'write_queued_sitemaps')
+                )
+                xml = objectify.fromstring(rv.data)
+                self.assertEqual(len(xml.sitemap), 1)
+                url = '/sitemaps/products-%d-1.xml.gz' % self.default_node.id
+                self.assertTrue(xml.sitemap[0].loc.text.endswith(url))
+
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                xml = objectify.fromstring(
+                    gzip.GzipFile(fileobj=StringIO(rv.data)).read()
+                )
+                self.assertEqual(len(xml.url), 3)
+                self.assertTrue(xml.url[0].loc.text.endswith(
+                    '/product/root/node1/product-0'
+                ))
+
+                rv = c.get(
+                    '/sitemaps/products-%d-2.xml.gz' % self.default_node.id
+                )
+                self.assertEqual(rv.status_code, 404)
+
+    def test_0280_clone_subtree(self):
+        """
+        Copy a subtree with its products in a few queries
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 3)])
+                ]
+            }])
+            product1, product2, product3 = template1.products
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'parent': self.default_node,
+                'products': [('create', [{'product': product1.id}])],
+            }])
+            node2, node3 = Node.create([{
+                'name': 'Node2',
+                'type_': 'catalog',
+                'slug': 'node2',
+                'parent': node1,
+                'products': [('create', [{'product': product2.id}])],
+            }, {
+                'name': 'Node3',
+                'type_': 'catalog',
+                'slug': 'node3',
+                'parent': self.default_node,
+                'products': [('create', [{'product': product3.id}])],
+            }])
+
+            clone = Node.clone_subtree(
+                node1, Node(node3.id), name='Node1 Copy'
+            )
+            self.assertEqual(clone.name, 'Node1 Copy')
+            self.assertEqual(clone.slug, 'node1')
+            self.assertEqual(clone.parent, node3)
+            child, = clone.children
+            self.assertEqual(child.name, 'Node2')
+            self.assertNotEqual(child, node2)
+
+            # The nested set of the whole tree is consistent
+            root = Node(self.default_node.id)
+            node3 = Node(node3.id)
+            self.assertTrue(root.left < node3.left < clone.left)
+            self.assertTrue(clone.left < child.left < child.right)
+            self.assertTrue(child.right < clone.right < node3.right)
+            self.assertTrue(node3.right < root.right)
+
+            self.assertEqual(
+                clone.get_products().all_items(), [product1, product2]
+            )
+            self.assertEqual(
+                node3.get_products().all_items(),
+                [product1, product2, product3]
+            )
+            self.assertEqual(
+                Node(node1.id).get_products().all_items(),
+                [product1, product2]
+            )
+
+            # A copy as a new tree
+            tree = Node.clone_subtree(root)
+            self.assertEqual(tree.parent, None)
+            self.assertTrue(tree.left > root.right)
+            self.assertEqual(
+                Node.search([
+                    ('left', '>', tree.left), ('right', '<', tree.right),
+                ], count=True), 5
+            )
+
+            self.assertRaises(
+                UserError, Node.clone_subtree, Node(node1.id), Node(node2.id)
+            )
+
+    def test_0290_delete_subtree(self):
+        """
+        Archive and delete a subtree with its relationships at once
+        """
+        Node = POOL.get('product.tree_node')
+        Relationship = POOL.get('product.product-product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 2)])
+                ]
+            }])
+            product1, product2 = template1.products
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'parent': self.default_node,
+            }])
+            node2, node3 = Node.create([{
+                'name': 'Node2',
+                'type_': 'catalog',
+                'slug': 'node2',
+                'parent': node1,
+                'products': [('create', [{'product': product1.id}])],
+            }, {
+                'name': 'Node3',
+                'type_': 'catalog',
+                'slug': 'node3',
+                'parent': self.default_node,
+                'products': [('create', [{'product': product2.id}])],
+            }])
+            site, = self.Site.search([])
+            self.Site.write([site], {'latest_products_node': node2.id})
+
+            Node.archive_subtree([node1])
+            self.assertEqual(
+                Node.search([('id', 'in', [node1.id, node2.id])]), []
+            )
+            Node.archive_subtree([node1], active=True)
+            self.assertEqual(
+                Node.search([('id', 'in', [node1.id, node2.id])], count=True),
+                2
+            )
+
+            # The nested branches are deleted along with their parent
+            Node.delete_subtree([node1, node2])
+            self.assertEqual(
+                Node.search([
+                    ('id', 'in', [node1.id, node2.id]),
+                    ('active', 'in', [True, False]),
+                ]), []
+            )
+            self.assertEqual(
+                Relationship.search([('product', '=', product1.id)]), []
+            )
+            self.assertEqual(self.Site(site.id).latest_products_node, None)
+
+            # The gap in the nested set is closed
+            root = Node(self.default_node.id)
+            node3 = Node(node3.id)
+            self.assertEqual(node3.left, root.left + 1)
+            self.assertEqual(node3.right, root.right - 1)
+            self.assertEqual(root.get_products().all_items(), [product2])
+
+    def test_0300_packed_listing(self):
+        """
+        Page the listing of a node from its packed product ids
+        """
+        Node = POOL.get('product.tree_node')
+        Job = POOL.get('product.tree_node.job')
+        Relationship = POOL.get('product.product-product.tree_node')
+        PackedListing = POOL.get('product.tree_node.packed')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 5)])
+                ]
+            }])
+            products = list(template1.products)
+
+            node1, = Node.create([{
+                'name': 'Node1',
+                'type_': 'catalog',
+                'slug': 'node1',
+                'parent': self.default_node,
+                'pack_products': True,
+                'products_per_page': 2,
+                'products': [('create', [
+                    {'product': product.id} for product in products[:4]
+                ])]
+            }])
+            self.assertEqual(Node(node1.id).get_packed_ids(), None)
+
+            Job.process()
+            node1 = Node(node1.id)
+            self.assertEqual(list(node1.get_packed_ids()), [
+                p.id for p in products[:4]
+            ])
+            pagination = node1.get_products(page=2)
+            self.assertEqual(pagination.count, 4)
+            self.assertEqual(pagination.items(), products[2:4])
+            self.assertEqual(pagination.all_items(), products[:4])
+
+            # A stale array is not used until it is packed again
+            Relationship.create([{
+                'node': node1.id, 'product': products[4].id,
+            }])
+            node1 = Node(node1.id)
+            self.assertEqual(node1.get_packed_ids(), None)
+            self.assertEqual(node1.get_products().count, 5)
+
+            Job.process()
+            node1 = Node(node1.id)
+            self.assertEqual(len(node1.get_packed_ids()), 5)
+            self.assertEqual(node1.get_products(page=3).items(), products[4:])
+
+            # A packed node edited while a run holds its job is queued
+            # again for the next run
+            Node.write([node1], {'name': 'Node1 edited'})
+            run_id, calls = Job.claim()
+            self.assertTrue((PackedListing.__name__, 'rebuild') in calls)
+            Node.write([node1], {'name': 'Node1 edited again'})
+            self.assertEqual(Job.search([
+                ('method', '=', 'rebuild'), ('run', '=', None),
+            ], count=True), 1)
+            for (model, method), keys in calls.iteritems():
+                Job.run_call(run_id, model, method, keys)
+            self.assertTrue(Job.is_pending(PackedListing.__name__, 'rebuild'))
+            Job.process()
+            self.assertFalse(
+                Job.is_pending(PackedListing.__name__, 'rebuild')
+            )
+            self.assertEqual(len(Node(node1.id).get_packed_ids()), 5)
+
+    def test_0310_rule_nodes(self):
+        """
+        Materialize the products matched by the rules of the nodes
+        """
+        Node = POOL.get('product.tree_node')
+        Job = POOL.get('product.tree_node.job')
+        Relationship = POOL.get('product.product-product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            uom, = self.Uom.search([], limit=1)
+
+            template1, = self.Template.create([{
+                'name': 'Product-1',
+                'category': self.category.id,
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'default_uom': uom.id,
+                'products': [
+                    ('create', [{
+                        'uri': 'product-%s' % x,
+                        'displayed_on_eshop': True
+                    } for x in xrange(0, 3)])
+                ]
+            }])
+            product1, product2, product3 = template1.products
+
+            latest, selection = Node.create([{
+                'name': 'Latest',
+                'type_': 'catalog',
+                'slug': 'latest',
+                'rule': 'created',
+                'rule_days': 30,
+            }, {
+                'name': 'Selection',
+                'type_': 'catalog',
+                'slug': 'selection',
+                'rule': 'domain',
+                'rule_domain': '[["uri", "in", ["product-0", "product-1"]]]',
+            }])
+            Job.process()
+            self.assertEqual(
+                set(Node(latest.id).get_products().all_items()),
+                set([product1, product2, product3])
+            )
+            self.assertEqual(
+                set(Node(selection.id).get_products().all_items()),
+                set([product1, product2])
+            )
+
+            # The changed products only are matched again
+            self.Product.write([product1], {'uri': 'product-x'})
+            self.Product.write([product3], {'uri': 'product-1'})
+            Job.process()
+            self.assertEqual(
+                set(Node(selection.id).get_products().all_items()),
+                set([product2, product3])
+            )
+
+            Node.write([selection], {'rule_domain': '[]'})
+            Job.process()
+            self.assertEqual(
+                Node(selection.id).get_products().count, 3
+            )
+
+            # Inactive variants do not match the rules
+            self.Product.write([product3], {'active': False})
+            Job.process()
+            self.assertEqual(Relationship.search([
+                ('node', '=', selection.id),
+            ], count=True), 2)
+
+            self.assertRaises(UserError, Node.create, [{
+                'name': 'Invalid',
+                'type_': 'catalog',
+                'slug': 'invalid',
+                'rule': 'domain',
+                'rule_domain': 'uri',
+            }])
+
+    def test_0320_child_counts(self):
+        """
+        Keep the number of children and descendants of the nodes
+        """
+        Node = POOL.get('product.tree_node')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            node1, node2 = Node.create([{
+                'name': 'Node%d' % x,
+                'type_': 'catalog',
+                'slug': 'node%d' % x,
+                'parent': self.default_node,
+            } for x in (1, 2)])
+            node3, = Node.create([{
+                'name': 'Node3',
+                'type_': 'catalog',
+                'slug': 'node3',
+                'parent': node1,
+            }])
+
+            def counts(node):
+                node = Node(node.id)
+                return (
+                    node.child_count, node.descendant_count,
+                    node.has_children
+                )
+
+            self.assertEqual(counts(self.default_node), (2, 3, True))
+            self.assertEqual(counts(node1), (1, 1, True))
+            self.assertEqual(counts(node3), (0, 0, False))
+
+            Node.write([node3], {'parent': node2})
+            self.assertEqual(counts(node1), (0, 0, False))
+            self.assertEqual(counts(node2), (1, 1, True))
+
+            Node.clone_subtree(Node(node2.id), Node(node1.id))
+            self.assertEqual(counts(node1), (1, 2, True))
+            self.assertEqual(counts(self.default_node), (2, 5, True))
+
+            Node.delete([Node(node3.id)])
+            self.assertEqual(counts(node2), (0, 0, False))
+
+            Node.delete_subtree([Node(node1.id)])
+            self.assertEqual(counts(self.default_node), (1, 1, True))
+
+            # Counted from the parent links while the rebuild is pending
+            with Transaction().set_context(defer_tree_rebuild=True):
+                node4, = Node.create([{
+                    'name': 'Node4',
+                    'type_': 'catalog',
+                    'slug': 'node4',
+                    'parent': node2,
+                }])
+            self.assertEqual([
+                n.descendant_count
+                for n in Node.browse([self.default_node.id, node2.id])
+            ], [2, 1])
+
+    def test_0330_job_queued_during_run(self):
+        """
+        Jobs queued while a run holds them are kept for the next run
+        """
+        Node = POOL.get('product.tree_node')
+        Job = POOL.get('product.tree_node.job')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            def rebuild_tree(cls, field_names):
+                # A node written while the nested set is rebuilt
+                Job.enqueue(cls.__name__, 'rebuild_tree', field_names)
+
+            Job.enqueue(Node.__name__, 'rebuild_tree', ['parent'])
+            Node.rebuild_tree = classmethod(rebuild_tree)
+            try:
+                Job.process()
+            finally:
+                del Node.rebuild_tree
+            self.assertTrue(Job.is_pending(Node.__name__, 'rebuild_tree'))
+
+            Job.process()
+            self.assertFalse(Job.is_pending(Node.__name__, 'rebuild_tree'))
+
+            # A key claimed by a run is queued again, not coalesced
+            Job.enqueue(Node.__name__, 'rebuild_tree', ['parent'])
+            run_id, calls = Job.claim()
+            self.assertEqual(
+                calls, {(Node.__name__, 'rebuild_tree'): ['parent']}
+            )
+            Job.enqueue(Node.__name__, 'rebuild_tree', ['parent'])
+            self.assertEqual(Job.search([], count=True), 2)
+
+            # The jobs of a failed call are released for the next run
+            Job.release(run_id, Node.__name__, 'rebuild_tree')
+            self.assertEqual(Job.search([('run', '=', None)], count=True), 2)
+            self.assertEqual(
+                sorted(job.attempts for job in Job.search([])), [0, 1]
+            )
+            Job.process()
+            self.assertEqual(Job.search([], count=True), 0)
+
 
 def suite():
     "Node test suite"
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Thumbnails of the images of tree nodes
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import os
+import hashlib
+import tempfile
+from StringIO import StringIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from flask import send_file
+from nereid import abort, route, url_for
+
+from trytond.cache import Cache
+from trytond.config import CONFIG
+from trytond.exceptions import UserError
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+from instrumentation import instrumented
+
+
+__all__ = ['Node']
+__metaclass__ = PoolMeta
+
+# Thumbnails are generated in these sizes (the longest side, in pixels)
+# only, a requested size is rounded up to the next bucket
+THUMBNAIL_SIZES = (64, 128, 256, 512)
+
+# The size of the thumbnail returned as the image preview of a node
+PREVIEW_SIZE = 128
+
+# Thumbnail urls change with the image, so they can be cached for long
+THUMBNAIL_CACHE_TIMEOUT = 365 * 24 * 60 * 60
+
+
+def get_bucket(size):
+    """
+    Return the thumbnail size to use for the requested size
+    """
+    for bucket in THUMBNAIL_SIZES:
+        if size <= bucket:
+            return bucket
+    return THUMBNAIL_SIZES[-1]
+
+
+def get_thumbnail_directory():
+    """
+    Return the directory of the thumbnails of the current database
+    """
+    return os.path.join(
+        CONFIG['data_path'], Transaction().cursor.database_name,
+        'nereid_catalog_tree', 'thumbnails'
+    )
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    # (static file id, write date) -> checksum of the content of the file
+    _image_checksum_cache = Cache(
+        'product.tree_node.image_checksum', context=False
+    )
+
+    def get_image_checksum(self):
+        """
+        Return the checksum of the content of the image of the node. The
+        checksum is cached for each version of the image, so the image is
+        read only once to find its thumbnails.
+        """
+        image = self.image
+        key = (image.id, image.write_date or image.create_date)
+        checksum = self._image_checksum_cache.get(key)
+        if checksum is None:
+            checksum = hashlib.sha1(str(image.file_binary)).hexdigest()
+            self._image_checksum_cache.set(key, checksum)
+        return checksum
+
+    def get_thumbnail(self, size):
+        """
+        Return the path of the thumbnail of the image of the node, which is
+        generated the first time it is needed. Returns None if the node has
+        no image or the thumbnail cannot be generated.
+
+        :param size: Size of the longest side of the thumbnail in pixels,
+                     rounded up to one of `THUMBNAIL_SIZES`
+        """
+        if not self.image or Image is None:
+            return None
+
+        size = get_bucket(size)
+        checksum = self.get_image_checksum()
+        directory = get_thumbnail_directory()
+        path = os.path.join(directory, '%s-%d.png' % (checksum, size))
+        if os.path.exists(path):
+            return path
+
+        try:
+            image = Image.open(StringIO(str(self.image.file_binary)))
+            image.thumbnail((size, size), Image.ANTIALIAS)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+        except IOError:
+            return None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Written to a temporary file renamed in place, so that concurrent
+        # requests never serve a partial thumbnail
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.png')
+        with os.fdopen(fd, 'wb') as thumbnail:
+            image.save(thumbnail, 'PNG')
+        os.rename(temp_path, path)
+        return path
+
+    def get_thumbnail_url(self, size=PREVIEW_SIZE, **kwargs):
+        """
+        Return the url of the thumbnail of the image of the node. The url
+        changes with the image, so the thumbnail can be cached by clients.
+        """
+        if not self.image:
+            return None
+        return url_for(
+            'product.tree_node.render_thumbnail', active_id=self.id,
+            slug=self.slug, size=get_bucket(size),
+            v=self.get_image_checksum()[:8], **kwargs
+        )
+
+    @route('/nodes/<int:active_id>/<slug>/thumbnail-<int:size>.png')
+    @instrumented
+    def render_thumbnail(self, slug=None, size=PREVIEW_SIZE):
+        """
+        Send the thumbnail of the image of the node
+
+        :param slug: slug of the browse node
+        :param size: size of the thumbnail
+        """
+        try:
+            self.slug
+        except UserError:
+            abort(404)
+
+        path = self.get_thumbnail(size)
+        if path is None:
+            abort(404)
+        return send_file(
+            path, mimetype='image/png', conditional=True,
+            cache_timeout=THUMBNAIL_CACHE_TIMEOUT
+        )
+
+    def get_image_preview(self, name=None):
+        """
+        Return a small thumbnail of the image instead of the full image.
+        Falls back to the image when thumbnails cannot be generated.
+        """
+        path = self.get_thumbnail(PREVIEW_SIZE)
+        if path is None:
+            return super(Node, self).get_image_preview(name)
+        with open(path, 'rb') as thumbnail:
+            return buffer(thumbnail.read())
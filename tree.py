@@ -8,6 +8,11 @@
     :license: GPLv3, see LICENSE for more details
 
 '''
+import time
+import random
+from bisect import bisect_left
+from collections import defaultdict
+
 from werkzeug.exceptions import NotFound
 from nereid import abort, render_template, route, url_for, request
 from nereid.helpers import slugify, context_processor
@@ -20,11 +25,17 @@ from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.transaction import Transaction
 from trytond import backend
-from sql import Literal
+from sql import Literal, Null
+from sql.aggregate import Count, Min
+from sql.conditionals import Case
+
+from revision import TreeCache, node_scope, website_scope, CATALOG_SCOPE
+from instrumentation import instrumented
+from replica import replica_read
 
 
 __all__ = [
-    'Product', 'Node', 'ProductNodeRelationship',
+    'Product', 'Template', 'Node', 'ProductNodeRelationship',
     'Website', 'WebsiteTreeNode'
 ]
 __metaclass__ = PoolMeta
@@ -39,26 +50,259 @@ class Product:
         'product', 'Tree Nodes'
     )
 
+    _node_paths_cache = TreeCache(
+        'product.product.node_paths', context=False
+    )
+
+    @classmethod
+    def get_node_paths(cls, products):
+        """
+        Return a dictionary mapping the id of each product to the paths of
+        the active catalog nodes in which the product is listed. Each path
+        is a list of node ids starting from the root of the tree. The paths
+        are sorted shallowest first, so the first path is the canonical
+        category of the product.
+
+        The paths are kept in a cache which is invalidated whenever a tree
+        or the products in it change. The paths missing from the cache are
+        looked up for all the given products at once.
+
+        :param products: List of products (or ids), for example a page of
+                         products being displayed
+        """
+        Revision = Pool().get('product.tree_node.revision')
+
+        result = {}
+        missing = []
+        for product in products:
+            paths = cls._node_paths_cache.get(
+                CATALOG_SCOPE, int(product)
+            )
+            if paths is None:
+                missing.append(int(product))
+            else:
+                result[int(product)] = paths
+        if not missing:
+            return result
+
+        if Revision.get_state()['rebuilding']:
+            leaves = cls._get_leaf_paths_from_parents(missing)
+        else:
+            leaves = cls._get_leaf_paths(missing)
+
+        for product_id in missing:
+            paths = [
+                path for _, path in sorted(
+                    leaves[product_id].items(),
+                    key=lambda item: (len(item[1]), item[0])
+                )
+            ]
+            cls._node_paths_cache.set(CATALOG_SCOPE, product_id, paths)
+            result[product_id] = paths
+        return result
+
+    @classmethod
+    def _get_leaf_paths(cls, product_ids):
+        """
+        Return a dictionary mapping the id of each product to a dictionary
+        of the paths of the active catalog nodes listing it, keyed by the
+        left of the node, read from the nested set
+        """
+        pool = Pool()
+        Node = pool.get('product.tree_node')
+        Relationship = pool.get('product.product-product.tree_node')
+        cursor = Transaction().cursor
+
+        relation = Relationship.__table__()
+        leaf = Node.__table__()
+        ancestor = Node.__table__()
+
+        # product id -> left of the leaf node -> ids of the nodes in path
+        leaves = defaultdict(dict)
+        for i in range(0, len(product_ids), cursor.IN_MAX):
+            sub_ids = product_ids[i:i + cursor.IN_MAX]
+            query = relation.join(
+                leaf, condition=(relation.node == leaf.id)
+            ).join(
+                ancestor, condition=(
+                    (ancestor.left <= leaf.left) &
+                    (ancestor.right >= leaf.right)
+                )
+            ).select(
+                relation.product, leaf.left, ancestor.left, ancestor.id,
+                where=(
+                    relation.product.in_(sub_ids) &
+                    (leaf.type_ == 'catalog') &
+                    leaf.active & ancestor.active
+                ),
+                order_by=[relation.product, leaf.left, ancestor.left],
+                distinct=True,
+            )
+            cursor.execute(*query)
+            for product_id, leaf_left, _, node_id in cursor.fetchall():
+                leaves[product_id].setdefault(leaf_left, []).append(node_id)
+        return leaves
+
+    @classmethod
+    def _get_leaf_paths_from_parents(cls, product_ids):
+        """
+        Return the paths of the active catalog nodes listing the products
+        like `_get_leaf_paths`, keyed by the id of the node, found from the
+        parent links while a deferred rebuild of the nested set is pending
+        """
+        pool = Pool()
+        Node = pool.get('product.tree_node')
+        Relationship = pool.get('product.product-product.tree_node')
+        cursor = Transaction().cursor
+
+        relation = Relationship.__table__()
+        node = Node.__table__()
+
+        listed = defaultdict(set)
+        for i in range(0, len(product_ids), cursor.IN_MAX):
+            sub_ids = product_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*relation.join(
+                node, condition=(relation.node == node.id)
+            ).select(
+                relation.product, node.id,
+                where=(
+                    relation.product.in_(sub_ids) &
+                    (node.type_ == 'catalog') & node.active
+                ),
+            ))
+            for product_id, node_id in cursor.fetchall():
+                listed[product_id].add(node_id)
+
+        ancestors = Node._get_ancestor_ids(
+            list(set().union(*listed.values()))
+        )
+        path_ids = list(set().union(*ancestors.values()))
+        active = set()
+        for i in range(0, len(path_ids), cursor.IN_MAX):
+            sub_ids = path_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*node.select(
+                node.id, where=node.id.in_(sub_ids) & node.active
+            ))
+            active.update(row[0] for row in cursor.fetchall())
+
+        leaves = defaultdict(dict)
+        for product_id, node_ids in listed.iteritems():
+            for node_id in node_ids:
+                leaves[product_id][node_id] = [
+                    i for i in ancestors[node_id] if i in active
+                ]
+        return leaves
+
+    @classmethod
+    def write(cls, products, values, *args):
+        Revision = Pool().get('product.tree_node.revision')
+        Relationship = Pool().get('product.product-product.tree_node')
+
+        super(Product, cls).write(products, values, *args)
+        # The listings of the nodes in which the products are displayed
+        # depend on the products
+        Revision.bump(Relationship.get_product_scopes([
+            p.id for p in products + sum(args[::2], [])
+        ]))
+
+    def get_canonical_node(self):
+        """
+        Return the active record of the node of the canonical category of
+        the product, or None if the product is not listed in any node.
+        """
+        Node = Pool().get('product.tree_node')
+
+        paths = self.get_node_paths([self])[self.id]
+        if paths:
+            return Node(paths[0][-1])
+
+    def get_tree_crumbs(self, add_home=True):
+        """
+        Return the breadcrumbs of the canonical category of the product
+        """
+        Node = Pool().get('product.tree_node')
+
+        node = self.get_canonical_node()
+        if node is None:
+            return []
+        return Node.make_tree_crumbs(node.id, add_home=add_home)
+
     @classmethod
     @route('/product/<uri>')
     @route('/product/<path:path>/<uri>')
+    @replica_read
+    @instrumented
     def render(cls, uri, path=None):
         """
-        If node is in the url arguments, translate that into an active record
-        of the node and send it in the context
+        If node is in the url arguments and the product is listed in the
+        tree of the node, translate that into an active record of the node
+        and send it in the context
         """
+        Node = Pool().get('product.tree_node')
+
         rv = super(Product, cls).render(uri, path)
 
         node = request.args.get('node', type=int)
         if node and not isinstance(rv, NotFound):
-            try:
-                rv.context['node'], = Node.search([('id', '=', node)])
-            except ValueError:
-                pass
+            product = rv.context['product']
+            paths = cls.get_node_paths([product])[product.id]
+            if any(node in path for path in paths):
+                rv.context['node'] = Node(node)
 
         return rv
 
 
+# The number of seconds for which a prefetched next page is used
+NEXT_PAGE_TTL = 60
+
+# The number of products between the ids cached to sample a listing
+SAMPLE_STEP = 256
+
+
+class NodePagination(QueryPagination):
+    """
+    Pagination of the products of a node, with the count of products served
+    from the cache of the tree
+    """
+
+    def __init__(self, node, *args, **kwargs):
+        self.node = node
+        super(NodePagination, self).__init__(*args, **kwargs)
+
+    @property
+    def count(self):
+        Revision = Pool().get('product.tree_node.revision')
+
+        scope = Revision.get_root_scope(self.node)
+        key = (self.node.id, self.node.display)
+        count = self.node._count_cache.get(scope, key)
+        if count is None:
+            count = super(NodePagination, self).count
+            self.node._count_cache.set(scope, key, count)
+        return count
+
+    def items(self):
+        if not self.node.prefetch_next_page:
+            return super(NodePagination, self).items()
+        return self.obj.browse(
+            self.node.get_page_ids(self.page, self.per_page)
+        )
+
+
+class Template:
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, templates, values, *args):
+        Revision = Pool().get('product.tree_node.revision')
+        Relationship = Pool().get('product.product-product.tree_node')
+
+        super(Template, cls).write(templates, values, *args)
+        Revision.bump(Relationship.get_product_scopes([
+            p.id for t in templates + sum(args[::2], []) for p in t.products
+        ]))
+
+
 class Node(ModelSQL, ModelView):
     """
     Tree Node
@@ -104,17 +348,198 @@ class Node(ModelSQL, ModelView):
         ('product.product', 'Product Variants'),
         ('product.template', 'Product Templates'),
     ], 'Display', required=True)
+    child_count = fields.Integer(
+        'Children', readonly=True,
+        help='The number of nodes right below the node'
+    )
+    descendant_count = fields.Function(
+        fields.Integer('Descendants'), 'get_descendant_count'
+    )
+    has_children = fields.Function(
+        fields.Boolean('Has Children'), 'get_has_children'
+    )
+    prefetch_next_page = fields.Boolean(
+        'Prefetch Next Page',
+        help='Fetch the products of the next page along with each page, '
+        'for listings browsed page after page like infinite scroll.'
+    )
+
+    # The crumbs depend on the language only, the other keys of the
+    # context of the requests would keep the warmed up entries from being
+    # used
+    _crumbs_cache = TreeCache('product.tree_node.crumbs', context=False)
+    _count_cache = TreeCache('product.tree_node.count', context=False)
+    _next_page_cache = TreeCache(
+        'product.tree_node.next_page', context=False
+    )
+    _sample_cache = TreeCache('product.tree_node.sample', context=False)
 
     @classmethod
     def __setup__(cls):
         super(Node, cls).__setup__()
         cls._order.insert(0, ('sequence', 'ASC'))
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        count_children = not table.column_exist('child_count')
+
+        super(Node, cls).__register__(module_name)
+
+        if count_children:
+            node = cls.__table__()
+            cursor.execute(*node.select(node.id))
+            cls.update_child_count([row[0] for row in cursor.fetchall()])
+
     @classmethod
     def validate(cls, nodes):
         super(Node, cls).validate(nodes)
         cls.check_recursion(nodes, rec_name='name')
 
+    @classmethod
+    def create(cls, vlist):
+        Revision = Pool().get('product.tree_node.revision')
+
+        nodes = super(Node, cls).create(vlist)
+        cls.update_child_count([n.parent.id for n in nodes if n.parent])
+        Revision.bump(cls.get_tree_scopes([n.id for n in nodes]))
+        return nodes
+
+    @classmethod
+    def write(cls, nodes, values, *args):
+        Revision = Pool().get('product.tree_node.revision')
+
+        all_nodes = nodes + sum(args[::2], [])
+        ids = [n.id for n in all_nodes]
+        moved = any('parent' in v for v in (values,) + args[1::2])
+        if moved:
+            parent_ids = [n.parent.id for n in all_nodes if n.parent]
+        # Nodes may move to another tree, so both the trees before and
+        # after the write are affected
+        scopes = cls.get_tree_scopes(ids)
+        super(Node, cls).write(nodes, values, *args)
+        if moved:
+            cls.update_child_count(parent_ids + [
+                n.parent.id for n in cls.browse(ids) if n.parent
+            ])
+        Revision.bump(scopes | cls.get_tree_scopes(ids))
+
+    @classmethod
+    def delete(cls, nodes):
+        Revision = Pool().get('product.tree_node.revision')
+
+        parent_ids = [n.parent.id for n in nodes if n.parent]
+        scopes = cls.get_tree_scopes([n.id for n in nodes])
+        super(Node, cls).delete(nodes)
+        cls.update_child_count(parent_ids)
+        Revision.bump(scopes)
+
+    @classmethod
+    def update_child_count(cls, ids):
+        """
+        Store the number of children of the given node ids, counted with a
+        single query and written with a single UPDATE per batch
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        ids = list(set(ids))
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.parent, Count(Literal(1)),
+                where=table.parent.in_(sub_ids),
+                group_by=[table.parent]
+            ))
+            counts = dict(cursor.fetchall())
+            if counts:
+                value = Case(*[
+                    (table.id == id_, count)
+                    for id_, count in counts.iteritems()
+                ], else_=0)
+            else:
+                value = 0
+            cursor.execute(*table.update(
+                columns=[table.child_count], values=[value],
+                where=table.id.in_(sub_ids)
+            ))
+
+    @classmethod
+    def get_descendant_count(cls, nodes, name):
+        """
+        Return the number of nodes in the branches of the nodes, derived
+        from their nested set. While a deferred rebuild of the nested set
+        is pending, the descendants of all the nodes are found from the
+        parent links one level at a time, and counted from their paths.
+        """
+        Revision = Pool().get('product.tree_node.revision')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        if Revision.get_state()['rebuilding']:
+            parents = {}
+            level = [n.id for n in nodes]
+            while level:
+                children = []
+                for i in range(0, len(level), cursor.IN_MAX):
+                    sub_ids = level[i:i + cursor.IN_MAX]
+                    cursor.execute(*table.select(
+                        table.id, table.parent,
+                        where=table.parent.in_(sub_ids)
+                    ))
+                    for child_id, parent_id in cursor.fetchall():
+                        if child_id not in parents:
+                            parents[child_id] = parent_id
+                            children.append(child_id)
+                level = children
+
+            counts = dict((n.id, 0) for n in nodes)
+            for parent_id in parents.itervalues():
+                while parent_id is not None:
+                    if parent_id in counts:
+                        counts[parent_id] += 1
+                    parent_id = parents.get(parent_id)
+            return counts
+        return dict(
+            (n.id, max((n.right - n.left - 1) // 2, 0)) for n in nodes
+        )
+
+    def get_has_children(self, name):
+        return bool(self.child_count)
+
+    @classmethod
+    def get_tree_scopes(cls, ids):
+        """
+        Return the set of revision scopes of the trees to which the given
+        node ids belong
+        """
+        Revision = Pool().get('product.tree_node.revision')
+        cursor = Transaction().cursor
+        node = cls.__table__()
+        root = cls.__table__()
+
+        if Revision.get_state()['rebuilding']:
+            return set(
+                node_scope(path[0])
+                for path in cls._get_ancestor_ids(ids).itervalues()
+            )
+        scopes = set()
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*node.join(
+                root, condition=(
+                    (root.left <= node.left) & (root.right >= node.right)
+                )
+            ).select(
+                root.id,
+                where=node.id.in_(sub_ids) & (root.parent == Null),
+                distinct=True,
+            ))
+            scopes.update(node_scope(row[0]) for row in cursor.fetchall())
+        return scopes
+
     @fields.depends('name', 'slug', 'parent')
     def on_change_with_slug(self):
         """
@@ -142,6 +567,127 @@ class Node(ModelSQL, ModelView):
     def default_products_per_page():
         return 10
 
+    @staticmethod
+    def default_child_count():
+        return 0
+
+    @classmethod
+    def _update_tree(cls, record_id, field_name, left, right):
+        Job = Pool().get('product.tree_node.job')
+
+        if Transaction().context.get('defer_tree_rebuild'):
+            Job.enqueue(cls.__name__, 'rebuild_tree', [field_name])
+            return
+        super(Node, cls)._update_tree(record_id, field_name, left, right)
+
+    @classmethod
+    def _rebuild_tree(cls, parent, parent_id, left):
+        Job = Pool().get('product.tree_node.job')
+
+        if parent_id is None and \
+                Transaction().context.get('defer_tree_rebuild'):
+            Job.enqueue(cls.__name__, 'rebuild_tree', [parent])
+            return left
+        return super(Node, cls)._rebuild_tree(parent, parent_id, left)
+
+    @classmethod
+    def rebuild_tree(cls, field_names):
+        """
+        Renumber the nested set of the trees. This is the job queued by
+        writes made with `defer_tree_rebuild` in the context.
+        """
+        Revision = Pool().get('product.tree_node.revision')
+
+        with Transaction().set_context(defer_tree_rebuild=False):
+            for field_name in field_names:
+                cls._rebuild_tree(field_name, None, 0)
+        Revision.bump(
+            cls.get_tree_scopes([n.id for n in cls.search([
+                ('parent', '=', None),
+            ])])
+        )
+
+    def _get_descendant_ids(self):
+        """
+        Return the ids of the node and all of its branches by walking the
+        parent links one level at a time. Unlike the nested set, the parent
+        links are always up to date.
+        """
+        cursor = Transaction().cursor
+        table = self.__table__()
+
+        ids = [self.id]
+        level = [self.id]
+        while level:
+            children = []
+            for i in range(0, len(level), cursor.IN_MAX):
+                sub_ids = level[i:i + cursor.IN_MAX]
+                cursor.execute(*table.select(
+                    table.id, where=table.parent.in_(sub_ids)
+                ))
+                children.extend(row[0] for row in cursor.fetchall())
+            ids.extend(children)
+            level = children
+        return ids
+
+    @classmethod
+    def _get_ancestor_ids(cls, ids):
+        """
+        Return a dictionary mapping each of the node ids to the ids of the
+        nodes in its path, starting from the root of its tree, by walking
+        the parent links one level at a time
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        parents = {}
+        level = list(set(ids))
+        while level:
+            for i in range(0, len(level), cursor.IN_MAX):
+                sub_ids = level[i:i + cursor.IN_MAX]
+                cursor.execute(*table.select(
+                    table.id, table.parent, where=table.id.in_(sub_ids)
+                ))
+                parents.update(cursor.fetchall())
+            level = list(set(
+                p for p in parents.itervalues() if p is not None
+            ) - set(parents))
+
+        paths = {}
+        for id_ in ids:
+            path = [id_]
+            while parents.get(path[-1]) is not None:
+                path.append(parents[path[-1]])
+            paths[id_] = path[::-1]
+        return paths
+
+    def _get_subtree_domain(self):
+        """
+        Return the domain matching the node and all of its branches. While
+        a deferred rebuild of the nested set is pending, the descendants are
+        found from the parent links.
+        """
+        Revision = Pool().get('product.tree_node.revision')
+
+        if Revision.get_state()['rebuilding']:
+            return [('id', 'in', self._get_descendant_ids())]
+        return [('left', '>=', self.left), ('right', '<=', self.right)]
+
+    def _get_subtree_condition(self, table):
+        """
+        Return the SQL condition matching the node and all of its branches
+        in the given node table. While a deferred rebuild of the nested set
+        is pending, the descendants are found from the parent links.
+        """
+        Revision = Pool().get('product.tree_node.revision')
+
+        if Revision.get_state()['rebuilding']:
+            return table.id.in_(self._get_descendant_ids())
+        return (
+            (table.left >= Literal(self.left)) &
+            (table.right <= Literal(self.right))
+        )
+
     def _get_products(self):
         """
         Return a query based on the node settings. This is separated for
@@ -177,8 +723,7 @@ class Node(ModelSQL, ModelView):
                 where=(
                     TemplateTable.active &
                     ProductTable.displayed_on_eshop &
-                    (NodeTable.left >= Literal(self.left)) &
-                    (NodeTable.right <= Literal(self.right))
+                    self._get_subtree_condition(NodeTable)
                 ),
                 order_by=RelTable.sequence.asc
             )
@@ -198,13 +743,71 @@ class Node(ModelSQL, ModelView):
                 where=(
                     TemplateTable.active &
                     ProductTable.displayed_on_eshop &
-                    (NodeTable.left >= Literal(self.left)) &
-                    (NodeTable.right <= Literal(self.right))
+                    self._get_subtree_condition(NodeTable)
                 ),
                 order_by=RelTable.sequence.asc
             )
             return ProductTemplate, query, TemplateTable
 
+    def _get_product_ids_query(self):
+        """
+        Return the query of the ids of the products listed by the node, in
+        the order of the listing. A product listed more than once in the
+        tree is returned once, at its first position.
+        """
+        Model, query, table = self._get_products()
+
+        query.columns = [table.id]
+        query.group_by = [table.id]
+        query.order_by = [
+            order.__class__(Min(order.expression))
+            for order in query.order_by
+        ] + [table.id.asc]
+        return query
+
+    def _get_product_ids(self, offset=0, limit=None):
+        """
+        Return the ids of a slice of the products listed by the node, in
+        the order of the listing
+
+        :param offset: The number of products to skip
+        :param limit: The maximum number of ids to return
+        """
+        cursor = Transaction().cursor
+
+        query = self._get_product_ids_query()
+        query.offset = offset
+        query.limit = limit
+        cursor.execute(*query)
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_page_ids(self, page, per_page):
+        """
+        Return the ids of the products of a page of the listing.
+
+        The ids of the page and of the next page are fetched in a single
+        query, and the next page is kept for `NEXT_PAGE_TTL` seconds, so
+        that the request of the next page, which usually follows right
+        away, does not query the listing.
+        """
+        Revision = Pool().get('product.tree_node.revision')
+
+        scope = Revision.get_root_scope(self)
+        cached = self._next_page_cache.get(
+            scope, (self.id, self.display, page, per_page)
+        )
+        if cached is not None and time.time() - cached[0] < NEXT_PAGE_TTL:
+            return cached[1]
+
+        ids = self._get_product_ids(
+            offset=(page - 1) * per_page, limit=2 * per_page
+        )
+        self._next_page_cache.set(
+            scope, (self.id, self.display, page + 1, per_page),
+            (time.time(), ids[per_page:])
+        )
+        return ids[:per_page]
+
     def get_products(self, page=1, per_page=None):
         """
         Return a pagination object of active records of products in the tree
@@ -231,13 +834,148 @@ class Node(ModelSQL, ModelView):
         if per_page is None:
             per_page = self.products_per_page
 
-        return QueryPagination(
-            *self._get_products(),
+        return NodePagination(
+            self, *self._get_products(),
             page=page, per_page=per_page
         )
 
+    def iter_products(self, chunk_size=1000):
+        """
+        Iterate over the active records of products in the tree and all of
+        its branches without loading the whole subtree into memory.
+
+        The ids are fetched in chunks ordered by id (keyset pagination), so
+        each chunk is a cheap query no matter how far into the subtree the
+        iteration is. Records are instantiated one chunk at a time and
+        released before the next chunk is fetched.
+
+        Unlike :meth:`get_products` the products are not returned in the
+        sequence of the node. This is meant for feeds and exports which
+        walk the whole subtree.
+
+        Example usage::
+
+            for product in node.iter_products(chunk_size=500):
+                writer.write(product)
+
+        :param chunk_size: The number of records fetched from the database
+                           in each round trip
+        """
+        Model = self._get_products()[0]
+
+        for ids in self.iter_product_ids(chunk_size):
+            for record in Model.browse(ids):
+                yield record
+
+    def iter_product_ids(self, chunk_size=1000):
+        """
+        Iterate over chunks of the ids of the products in the tree and all
+        of its branches, as listed by :meth:`_get_products`, fetched in
+        keyset chunks ordered by id
+
+        :param chunk_size: The number of ids fetched in each round trip
+        """
+        cursor = Transaction().cursor
+        Model, query, table = self._get_products()
+
+        where = query.where
+        query.columns = [table.id]
+        query.group_by = [table.id]
+        query.order_by = [table.id.asc]
+        query.limit = chunk_size
+
+        last_id = None
+        while True:
+            if last_id is not None:
+                query.where = where & (table.id > last_id)
+            cursor.execute(*query)
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            yield ids
+            if len(ids) < chunk_size:
+                break
+            last_id = ids[-1]
+
+    def _get_sample_boundaries(self):
+        """
+        Return the number of products in the tree and all of its branches,
+        and the id of every `SAMPLE_STEP`th product in the order of the
+        ids, cached until the tree changes
+        """
+        Revision = Pool().get('product.tree_node.revision')
+
+        scope = Revision.get_root_scope(self)
+        key = (self.id, self.display, SAMPLE_STEP)
+        cached = self._sample_cache.get(scope, key)
+        if cached is None:
+            count, boundaries = 0, []
+            for ids in self.iter_product_ids(chunk_size=SAMPLE_STEP):
+                boundaries.append(ids[0])
+                count += len(ids)
+            cached = count, boundaries
+            self._sample_cache.set(scope, key, cached)
+        return cached
+
+    def _get_sample_query(self):
+        """
+        Return the model, the query of the ids of the products in the order
+        of the ids, one at a time, and the table of the ids
+        """
+        Model, query, table = self._get_products()
+
+        query.columns = [table.id]
+        query.group_by = [table.id]
+        query.order_by = [table.id.asc]
+        query.limit = 1
+        return Model, query, table
+
+    def sample_products(self, size, seed=None):
+        """
+        Return up to `size` active records of products picked at random,
+        uniformly, in the tree and all of its branches.
+
+        The products are picked at random positions of the listing ordered
+        by id. The number of products and the id at every `SAMPLE_STEP`th
+        position are cached until the tree changes, so each product is
+        read by a query starting at the id before its position, which
+        skips less than `SAMPLE_STEP` products. The same seed returns the
+        same products until the tree changes, which makes pages showing a
+        sample cacheable.
+
+        Example usage::
+
+            {% for product in node.sample_products(4, seed=node.id) %}
+            <li>{{ product.name }}</li>
+            {% endfor %}
+
+        :param size: The number of products to return
+        :param seed: The seed of the random choice, or None for a new
+                     sample on every call
+        """
+        cursor = Transaction().cursor
+
+        count, boundaries = self._get_sample_boundaries()
+        rng = random.Random(seed)
+        positions = rng.sample(xrange(count), min(size, count))
+
+        Model, query, table = self._get_sample_query()
+        where = query.where
+        ids = []
+        for position in positions:
+            boundary = boundaries[position // SAMPLE_STEP]
+            query.where = where & (table.id >= boundary)
+            query.offset = position % SAMPLE_STEP
+            cursor.execute(*query)
+            row = cursor.fetchone()
+            if row is not None:
+                ids.append(row[0])
+        return Model.browse(ids)
+
     @route('/nodes/<int:active_id>/<slug>/<int:page>')
     @route('/nodes/<int:active_id>/<slug>')
+    @replica_read
+    @instrumented
     def render(self, slug=None, page=1):
         """
         Renders a page of products in the tree and all of its branches
@@ -280,22 +1018,36 @@ class Node(ModelSQL, ModelView):
     def default_display():
         return 'product.product'
 
+    @staticmethod
+    def default_prefetch_next_page():
+        return False
+
     @classmethod
     @context_processor('make_tree_crumbs')
     def make_tree_crumbs(cls, node, add_home=True):
         """
         Make breadcrumb for tree node.
         """
+        Revision = Pool().get('product.tree_node.revision')
+
         leaf = cls(int(node))
-        crumbs = []
-        while leaf:
-            crumbs.append(
-                (url_for(
-                    'product.tree_node.render',
-                    active_id=leaf.id, slug=leaf.slug
-                ), leaf.name)
-            )
-            leaf = leaf.parent
+        scope = Revision.get_root_scope(leaf)
+        key = (leaf.id, Transaction().language)
+        path = cls._crumbs_cache.get(scope, key)
+        if path is None:
+            path = []
+            ancestor = leaf
+            while ancestor:
+                path.append((ancestor.id, ancestor.slug, ancestor.name))
+                ancestor = ancestor.parent
+            cls._crumbs_cache.set(scope, key, path)
+
+        crumbs = [
+            (url_for(
+                'product.tree_node.render', active_id=id_, slug=slug
+            ), name)
+            for id_, slug, name in path
+        ]
         if add_home:
             crumbs.append((url_for('nereid.website.home'), 'Home'))
         crumbs.reverse()
@@ -303,6 +1055,8 @@ class Node(ModelSQL, ModelView):
 
     @classmethod
     @route('/sitemaps/tree-index.xml')
+    @replica_read
+    @instrumented
     def sitemap_index(cls):
         index = SitemapIndex(cls, [
             ('active', '=', True),
@@ -311,6 +1065,8 @@ class Node(ModelSQL, ModelView):
 
     @classmethod
     @route('/sitemaps/tree-<int:page>.xml')
+    @replica_read
+    @instrumented
     def sitemap(cls, page):
         sitemap_section = SitemapSection(
             cls, [
@@ -333,15 +1089,79 @@ class Node(ModelSQL, ModelView):
             title: <display name>,
             link: <url>,
             record: <instance of record> # if type_ is `record`
+            has_children: <True if the node has children>
         }
         """
         return {
             'record': self,
             'title': self.name,
             'link': self.get_absolute_url(),
+            'has_children': self.has_children,
         }
 
 
+def increasing_subsequence(values):
+    """
+    Return the set of indexes of a longest strictly increasing subsequence
+    of the values
+    """
+    # The smallest last value of the increasing subsequences of each length
+    # found so far, and the index of that value
+    tail_values, tails = [], []
+    previous = [None] * len(values)
+    for index, value in enumerate(values):
+        position = bisect_left(tail_values, value)
+        if position:
+            previous[index] = tails[position - 1]
+        if position == len(tails):
+            tail_values.append(value)
+            tails.append(index)
+        else:
+            tail_values[position] = value
+            tails[position] = index
+
+    result = set()
+    index = tails[-1] if tails else None
+    while index is not None:
+        result.add(index)
+        index = previous[index]
+    return result
+
+
+def fill_sequences(sequences, keep, gap):
+    """
+    Return new sequences in which the indexes to keep are unchanged and
+    the others are spread in the gaps between them, or None when there is
+    not enough room between the kept sequences
+    """
+    result = list(sequences)
+    index = 0
+    while index < len(result):
+        if index in keep:
+            index += 1
+            continue
+        end = index
+        while end < len(result) and end not in keep:
+            end += 1
+        count = end - index
+        low = result[index - 1] if index else None
+        high = result[end] if end < len(result) else None
+        if low is None and high is None:
+            low = 0
+        if high is None:
+            step = gap
+        else:
+            if low is None:
+                low = max(min(0, high - count - 1), high - gap * (count + 1))
+            step = (high - low) // (count + 1)
+            if step < 1:
+                return None
+        for offset in xrange(count):
+            result[index + offset] = low + step * (offset + 1)
+        index = end
+    return result
+
+
 class ProductNodeRelationship(ModelSQL, ModelView):
     """
     This is the relation between a node in a tree
@@ -375,6 +1195,145 @@ class ProductNodeRelationship(ModelSQL, ModelView):
 
         # TODO: Add unique constraint for product, node
 
+    @classmethod
+    def get_tree_scopes(cls, relationships):
+        """
+        Return the set of revision scopes affected by a change to the given
+        relationships
+        """
+        Node = Pool().get('product.tree_node')
+
+        return Node.get_tree_scopes(
+            list(set(r.node.id for r in relationships))
+        )
+
+    @classmethod
+    def get_product_node_ids(cls, product_ids):
+        """
+        Return the ids of the nodes in which the given product ids are
+        listed
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        node_ids = set()
+        for i in range(0, len(product_ids), cursor.IN_MAX):
+            sub_ids = product_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.node, where=table.product.in_(sub_ids), distinct=True
+            ))
+            node_ids.update(row[0] for row in cursor.fetchall())
+        return list(node_ids)
+
+    @classmethod
+    def get_product_scopes(cls, product_ids):
+        """
+        Return the set of revision scopes of the trees in which the given
+        product ids are listed
+        """
+        Node = Pool().get('product.tree_node')
+
+        return Node.get_tree_scopes(cls.get_product_node_ids(product_ids))
+
+    @classmethod
+    def resequence(cls, node, product_ids, gap=10):
+        """
+        Order the products of the node as in the given list. The products
+        of the node missing from the list come after, in their current
+        order. Returns the number of relationships changed.
+
+        Only the relationships which are out of order are changed: the
+        longest run of sequences already in the right order is kept and the
+        other relationships get sequences in the gaps between them. All the
+        changes are applied with a single UPDATE per batch.
+
+        :param node: Active record of the node
+        :param product_ids: The ordered list of product ids
+        :param gap: The difference between sequences given when there is
+                    room for it
+        """
+        pool = Pool()
+        Node = pool.get('product.tree_node')
+        Revision = pool.get('product.tree_node.revision')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.select(
+            table.id, table.product, table.sequence,
+            where=(table.node == node.id),
+            order_by=[table.sequence.asc, table.id.asc]
+        ))
+        rows = cursor.fetchall()
+
+        positions = {}
+        for position, product_id in enumerate(product_ids):
+            positions.setdefault(product_id, position)
+        rows = [
+            row for _, row in sorted(
+                enumerate(rows), key=lambda item: (
+                    positions.get(item[1][1], len(product_ids)), item[0]
+                )
+            )
+        ]
+
+        sequences = [row[2] for row in rows]
+        new_sequences = fill_sequences(
+            sequences, increasing_subsequence(sequences), gap
+        )
+        if new_sequences is None:
+            # Not enough room between the sequences, renumber them all
+            new_sequences = [gap * (index + 1) for index in xrange(len(rows))]
+
+        changes = [
+            (row[0], sequence)
+            for row, sequence in zip(rows, new_sequences)
+            if row[2] != sequence
+        ]
+        for i in range(0, len(changes), cursor.IN_MAX):
+            sub_changes = changes[i:i + cursor.IN_MAX]
+            cursor.execute(*table.update(
+                columns=[table.sequence],
+                values=[Case(*[
+                    (table.id == id_, sequence)
+                    for id_, sequence in sub_changes
+                ])],
+                where=table.id.in_([id_ for id_, _ in sub_changes])
+            ))
+        if changes:
+            Revision.bump(Node.get_tree_scopes([node.id]))
+        return len(changes)
+
+    @classmethod
+    def create(cls, vlist):
+        Revision = Pool().get('product.tree_node.revision')
+
+        relationships = super(ProductNodeRelationship, cls).create(vlist)
+        Revision.bump(cls.get_tree_scopes(relationships))
+        return relationships
+
+    @classmethod
+    def write(cls, relationships, values, *args):
+        Revision = Pool().get('product.tree_node.revision')
+
+        all_relationships = relationships + sum(args[::2], [])
+        scopes = cls.get_tree_scopes(all_relationships)
+        super(ProductNodeRelationship, cls).write(
+            relationships, values, *args
+        )
+        Revision.bump(
+            scopes | cls.get_tree_scopes(
+                cls.browse([r.id for r in all_relationships])
+            )
+        )
+
+    @classmethod
+    def delete(cls, relationships):
+        Revision = Pool().get('product.tree_node.revision')
+
+        scopes = cls.get_tree_scopes(relationships)
+        super(ProductNodeRelationship, cls).delete(relationships)
+        Revision.bump(scopes)
+
 
 class Website:
     """
@@ -407,6 +1366,14 @@ class Website:
         if table.column_exist('root_tree_node'):
             table.not_null_action('root_tree_node', action='remove')
 
+    @classmethod
+    def create(cls, vlist):
+        Revision = Pool().get('product.tree_node.revision')
+
+        websites = super(Website, cls).create(vlist)
+        Revision.create_scopes([website_scope(w.id) for w in websites])
+        return websites
+
 
 class WebsiteTreeNode(ModelSQL):
     "Root Tree Nodes on a Website"
@@ -422,3 +1389,34 @@ class WebsiteTreeNode(ModelSQL):
         domain=[('type_', '=', 'catalog')],
         ondelete='CASCADE', select=True, required=True
     )
+
+    @classmethod
+    def get_website_scopes(cls, records):
+        return set(website_scope(r.website.id) for r in records)
+
+    @classmethod
+    def create(cls, vlist):
+        Revision = Pool().get('product.tree_node.revision')
+
+        records = super(WebsiteTreeNode, cls).create(vlist)
+        Revision.bump(cls.get_website_scopes(records))
+        return records
+
+    @classmethod
+    def write(cls, records, values, *args):
+        Revision = Pool().get('product.tree_node.revision')
+
+        all_records = records + sum(args[::2], [])
+        scopes = cls.get_website_scopes(all_records)
+        super(WebsiteTreeNode, cls).write(records, values, *args)
+        Revision.bump(scopes | cls.get_website_scopes(
+            cls.browse([r.id for r in all_records])
+        ))
+
+    @classmethod
+    def delete(cls, records):
+        Revision = Pool().get('product.tree_node.revision')
+
+        scopes = cls.get_website_scopes(records)
+        super(WebsiteTreeNode, cls).delete(records)
+        Revision.bump(scopes)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+    Nereid Catalog Tree
+
+    Warmup of the caches of the most visited nodes at worker startup
+
+    After a deploy every worker starts with empty caches, and the first
+    visitors of the top categories pay for the counts and the crumbs. The
+    application can warm the caches before it takes traffic::
+
+        app.initialise()
+        start_warmup(app).join()
+
+    The time spent warming up is limited by the `CATALOG_TREE_WARMUP_BUDGET`
+    setting of the application, in seconds (default 30).
+
+    :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+
+'''
+import time
+import logging
+import threading
+
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+
+__all__ = ['Node']
+__metaclass__ = PoolMeta
+
+logger = logging.getLogger('nereid_catalog_tree.warmup')
+
+# The default time budget of the warmup, in seconds
+WARMUP_BUDGET = 30
+
+
+class Node:
+    __name__ = 'product.tree_node'
+
+    @classmethod
+    def _get_warmup_nodes(cls, website):
+        """
+        Return the nodes whose caches are warmed up for the website, the
+        most important first. These are the roots of the website and the
+        nodes right below them, as shown in the menus. This is separated
+        for easy subclassing.
+
+        :param website: Active record of the website
+        """
+        WebsiteTreeNode = Pool().get('nereid.website-product.tree_node')
+
+        roots = [
+            record.node for record in WebsiteTreeNode.search([
+                ('website', '=', website.id),
+            ])
+        ]
+        return roots + cls.search([
+            ('parent', 'in', [root.id for root in roots]),
+            ('type_', '=', 'catalog'),
+        ])
+
+    def warmup(self):
+        """
+        Fill the caches used to render the first page of the node: the
+        count of products, the first page of the listing when it is
+        prefetched, and the crumbs
+        """
+        products = self.get_products()
+        # Reading the count puts it in the cache
+        products.count
+        if self.prefetch_next_page:
+            products.items()
+        self.make_tree_crumbs(self.id)
+
+    @classmethod
+    def warmup_website(cls, website, deadline):
+        """
+        Warm up the caches of the nodes of the website until the deadline.
+        Returns the number of nodes warmed up.
+
+        :param website: Active record of the website
+        :param deadline: The time at which the warmup stops
+        """
+        done = set()
+        for node in cls._get_warmup_nodes(website):
+            if time.time() >= deadline:
+                break
+            if node.id in done or not node.active:
+                continue
+            node.warmup()
+            done.add(node.id)
+        return len(done)
+
+
+def warmup(app, budget=None):
+    """
+    Warm up the caches of the nodes of every website within the budget
+
+    :param app: The initialised nereid application
+    :param budget: The time budget in seconds, the setting of the
+                   application by default
+    """
+    if budget is None:
+        budget = app.config.get('CATALOG_TREE_WARMUP_BUDGET', WARMUP_BUDGET)
+    start = time.time()
+    deadline = start + budget
+    count = 0
+
+    with Transaction().start(app.database_name, 0):
+        Website = Pool().get('nereid.website')
+        Node = Pool().get('product.tree_node')
+
+        for website in Website.search([]):
+            if time.time() >= deadline:
+                break
+            # The crumbs are cached per language, so the warmup runs in
+            # the language of the requests of the website
+            language = website.default_locale.language.code
+            with app.test_request_context(
+                    base_url='http://%s/' % website.name):
+                with Transaction().set_user(website.application_user.id), \
+                        Transaction().set_context(language=language):
+                    count += Node.warmup_website(website, deadline)
+
+    logger.info(
+        'Warmed up the caches of %d nodes in %.2fs',
+        count, time.time() - start
+    )
+    return count
+
+
+def start_warmup(app, budget=None):
+    """
+    Warm up the caches in a background thread, which is returned. Join the
+    thread to wait for the warmup before taking traffic.
+    """
+    def run():
+        try:
+            warmup(app, budget)
+        except Exception:
+            logger.exception('Warmup of the catalog tree caches failed')
+
+    thread = threading.Thread(target=run, name='catalog-tree-warmup')
+    thread.daemon = True
+    thread.start()
+    return thread